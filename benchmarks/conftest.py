@@ -22,6 +22,9 @@ import pytest
 
 def pytest_addoption(parser):
     parser.addoption("--embedding_server", default="", help="Embedding server URI")
+    parser.addoption(
+        "--embedding_model", default="", help="Embedding model to quantize"
+    )
     parser.addoption("--mining_server", default="", help="Mining server URI")
     parser.addoption("--mysql_server", default="", help="MySQL server URI")
     parser.addoption("--search_server", default="", help="Search server URI")
@@ -30,6 +33,7 @@ def pytest_addoption(parser):
 @pytest.fixture(scope="session")
 def benchmark_parameters(request):
     return {
+        "embedding_model": request.config.getoption("--embedding_model"),
         "embedding_server": request.config.getoption("--embedding_server"),
         "mining_server": request.config.getoption("--mining_server"),
         "mysql_server": request.config.getoption("--mysql_server"),
@@ -0,0 +1,69 @@
+"""Benchmark the loading of embeddings for several HDF5 storage layouts."""
+
+# Blue Brain Search is a text mining toolbox focused on scientific use cases.
+#
+# Copyright (C) 2020  Blue Brain Project, EPFL.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from typing import Any, Dict
+
+import numpy as np
+import pytest
+
+from bluesearch.utils import H5
+
+N_ROWS = 50_000
+DIM = 768
+LAYOUTS: Dict[str, Dict[str, Any]] = {
+    "contiguous": {},
+    "chunked": {"chunks": (1024, DIM)},
+    "lzf": {"chunks": (1024, DIM), "compression": "lzf", "shuffle": True},
+    "gzip": {"chunks": (1024, DIM), "compression": "gzip", "shuffle": True},
+}
+
+
+@pytest.fixture(scope="module")
+def embeddings_path(tmp_path_factory):
+    """Embeddings stored with each of the layouts."""
+    path = tmp_path_factory.mktemp("h5_layouts") / "embeddings.h5"
+    rng = np.random.default_rng(0)
+    # Round the embeddings to make them compressible like real ones
+    embeddings = rng.normal(size=(N_ROWS, DIM)).round(2).astype("f4")
+
+    for name, layout in LAYOUTS.items():
+        H5.create(path, name, shape=(N_ROWS, DIM), **layout)
+        H5.write(path, name, embeddings, np.arange(N_ROWS))
+
+    return path
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_load_full(benchmark, embeddings_path, layout):
+    """Load the whole dataset."""
+    embeddings = benchmark(H5.load, embeddings_path, layout)
+
+    assert embeddings.shape == (N_ROWS, DIM)
+
+
+@pytest.mark.parametrize("fraction", [0.01, 0.5])
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_load_indices(benchmark, embeddings_path, layout, fraction):
+    """Load a random subset of the rows."""
+    rng = np.random.default_rng(1)
+    indices = rng.choice(N_ROWS, size=int(fraction * N_ROWS), replace=False)
+
+    embeddings = benchmark(H5.load, embeddings_path, layout, indices=indices)
+
+    assert embeddings.shape == (len(indices), DIM)
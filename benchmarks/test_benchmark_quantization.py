@@ -0,0 +1,84 @@
+"""Benchmark the int8 quantization of the embedding models."""
+
+# Blue Brain Search is a text mining toolbox focused on scientific use cases.
+#
+# Copyright (C) 2020  Blue Brain Project, EPFL.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+from bluesearch.embedding_models import get_embedding_model
+
+SENTENCES = [
+    "Glucose is a sugar.",
+    "The coronavirus binds to the ACE2 receptor of the host cells.",
+    "Hydroxychloroquine was tested in several randomized controlled trials.",
+    "Smoking increases the risk of severe forms of the disease.",
+    "Neurons communicate with each other through synapses.",
+    "The incubation period of the virus is estimated to be around five days.",
+    "Masks reduce the transmission of respiratory droplets.",
+    "Interleukin-6 is a cytokine involved in the inflammatory response.",
+]
+
+
+@pytest.fixture(scope="module")
+def models(benchmark_parameters):
+    model_name = benchmark_parameters["embedding_model"]
+
+    if not model_name:
+        pytest.skip("Embedding model not provided.")
+
+    return {
+        quantize: get_embedding_model(model_name, quantize=quantize)
+        for quantize in (False, True)
+    }
+
+
+@pytest.mark.parametrize("quantize", [False, True], ids=["fp32", "int8"])
+def test_embed_many(benchmark, models, quantize):
+    """Measure the speed of the embedding."""
+    model = models[quantize]
+    preprocessed_sentences = model.preprocess_many(SENTENCES * 4)
+
+    embeddings = benchmark(model.embed_many, preprocessed_sentences)
+
+    assert embeddings.shape == (len(preprocessed_sentences), model.dim)
+
+
+def test_accuracy(benchmark, models):
+    """Compare the embeddings of the quantized model to the original ones."""
+    embeddings = {
+        quantize: model.embed_many(model.preprocess_many(SENTENCES))
+        for quantize, model in models.items()
+    }
+    original, quantized = embeddings[False], embeddings[True]
+
+    similarities = np.sum(original * quantized, axis=1) / (
+        np.linalg.norm(original, axis=1) * np.linalg.norm(quantized, axis=1)
+    )
+    benchmark.extra_info["min_cosine_similarity"] = float(similarities.min())
+    benchmark.extra_info["mean_cosine_similarity"] = float(similarities.mean())
+
+    # Does the quantization preserve the ranking of the sentences?
+    original_ranking = np.argsort(-original @ original[0])
+    quantized_ranking = np.argsort(-quantized @ quantized[0])
+    benchmark.extra_info["same_ranking"] = bool(
+        np.array_equal(original_ranking[:5], quantized_ranking[:5])
+    )
+
+    benchmark(models[True].embed, SENTENCES[0])
+
+    assert similarities.min() > 0.95
@@ -76,6 +76,24 @@ class TestEmbedding:
 
         assert response.ok
 
+    @pytest.mark.parametrize("output_type", ["json", "npy"])
+    @pytest.mark.parametrize("model", EMBEDDING_MODELS)
+    def test_embed_batch(self, benchmark, benchmark_parameters, model, output_type):
+        """Embed 100 sentences at once with different models and outputs."""
+        embedding_server = benchmark_parameters["embedding_server"]
+
+        if not embedding_server:
+            pytest.skip("Embedding server address not provided.")
+
+        url = f"{embedding_server}/v1/embed_batch/{output_type}"
+
+        texts = [f"Glucose is a risk factor for COVID-19 ({i})" for i in range(100)]
+        payload_json = {"texts": texts, "model": model}
+
+        response = benchmark(requests.post, url, json=payload_json)
+
+        assert response.ok
+
 
 class TestMining:
     @pytest.mark.parametrize("entity_type", ENTITY_TYPES)
@@ -151,8 +169,11 @@ class TestMining:
 
         assert response.ok
 
+    @pytest.mark.parametrize("output_format", ["json", "csv", "ndjson"])
     @pytest.mark.parametrize("n_articles", [50, 100, 200, 400, 800, 1600])
-    def test_mine_many_articles(self, benchmark, benchmark_parameters, n_articles):
+    def test_mine_many_articles(
+        self, benchmark, benchmark_parameters, n_articles, output_format
+    ):
         """Mine big number of articles in cache mode and for all entity types."""
         use_cache = True
         mining_server = benchmark_parameters["mining_server"]
@@ -194,6 +215,7 @@ class TestMining:
             "identifiers": identifiers,
             "schema": schema_request,
             "use_cache": use_cache,
+            "format": output_format,
         }
 
         response = benchmark(requests.post, url, json=payload_json)
@@ -201,7 +223,14 @@ class TestMining:
         assert response.ok
 
         # check nonempty
-        table_extractions = pd.read_csv(StringIO(response.json()["csv_extractions"]))
+        if output_format == "json":
+            table_extractions = pd.read_csv(
+                StringIO(response.json()["csv_extractions"])
+            )
+        elif output_format == "csv":
+            table_extractions = pd.read_csv(StringIO(response.text))
+        else:
+            table_extractions = pd.read_json(StringIO(response.text), lines=True)
 
         assert len(table_extractions) > 1
 
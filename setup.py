@@ -67,17 +67,28 @@ INSTALL_REQUIRES = [
     "python-dotenv",
     "requests",
     "scikit-learn",
+    "scipy",
     "sentence-transformers",
     # >= 3.0.6 to include the fix for https://github.com/explosion/spaCy/pull/7603.
     "spacy[transformers]>=3.0.6",
+    "threadpoolctl",
     # torch==1.9.0 contains patch allowing reproducible saving of models
     "torch>=1.9.0",
 ]
 
 EXTRAS_REQUIRE = {
+    "async": [
+        "aiosqlite",
+        "asyncmy",
+    ],
+    "compression": [
+        "hdf5plugin",
+    ],
     "dev": [
         "Sphinx",
+        "aiosqlite",
         "docker",
+        "gunicorn",
         "pytest-benchmark",
         "pytest-cov",
         "pytest>=4.6",
@@ -98,6 +109,9 @@ EXTRAS_REQUIRE = {
         # Installed with spaCy. Only for the temporary pipelines/ner/preprocess.py.
         "typer",
     ],
+    "server": [
+        "gunicorn",
+    ],
 }
 
 CONSOLE_SCRIPTS = [
@@ -28,7 +28,7 @@ import sqlalchemy
 import torch
 
 from bluesearch.mining.pipeline import run_pipeline
-from bluesearch.sql import retrieve_articles
+from bluesearch.sql import iter_articles
 from bluesearch.utils import load_spacy_model
 
 
@@ -174,21 +174,20 @@ class Miner:
         """
         if isinstance(article_ids, int):
             article_ids = [article_ids]
-        df_articles = retrieve_articles(article_ids, self.engine)
-
-        for _, row in df_articles.iterrows():
-            text = row["text"]
-            article_id = row["article_id"]
-            section_name = row["section_name"]
-            paragraph_pos = row["paragraph_pos_in_article"]
-
-            metadata = {
-                "article_id": article_id,
-                "paragraph_pos_in_article": paragraph_pos,
-                "paper_id": f"{article_id}:{section_name}:{paragraph_pos}",
-            }
-
-            yield text, metadata
+        for df_article in iter_articles(article_ids, self.engine):
+            for _, row in df_article.iterrows():
+                text = row["text"]
+                article_id = row["article_id"]
+                section_name = row["section_name"]
+                paragraph_pos = row["paragraph_pos_in_article"]
+
+                metadata = {
+                    "article_id": article_id,
+                    "paragraph_pos_in_article": paragraph_pos,
+                    "paper_id": f"{article_id}:{section_name}:{paragraph_pos}",
+                }
+
+                yield text, metadata
 
     def _mine(self, article_id):
         """Perform one mining task.
@@ -0,0 +1,457 @@
+"""Persistent cache of sentence embeddings."""
+
+# Blue Brain Search is a text mining toolbox focused on scientific use cases.
+#
+# Copyright (C) 2020  Blue Brain Project, EPFL.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import pathlib
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+import sqlalchemy
+
+from bluesearch.embedding_models import (
+    EmbeddingModel,
+    LazyEmbeddingModel,
+    SentTransformer,
+    SklearnVectorizer,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def compute_fingerprint(model_name_or_path):
+    """Compute the fingerprint of a model checkpoint.
+
+    Parameters
+    ----------
+    model_name_or_path : str or pathlib.Path
+        The name or the path of the checkpoint. If it is a file, the
+        fingerprint is the hash of its content. If it is a directory, the
+        fingerprint is the hash of the relative paths and of the content of
+        all its files. Otherwise, it is considered as a name, e.g. of a
+        model of the Hugging Face hub, and the fingerprint is the name.
+
+    Returns
+    -------
+    str
+        The fingerprint of the checkpoint.
+    """
+    path = pathlib.Path(model_name_or_path)
+    if path.is_file():
+        paths = [path]
+    elif path.is_dir():
+        paths = sorted(p for p in path.rglob("*") if p.is_file())
+    else:
+        return str(model_name_or_path)
+
+    sha256 = hashlib.sha256()
+    for file_path in paths:
+        sha256.update(str(file_path.relative_to(path)).encode("utf-8"))
+        with file_path.open("rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def get_model_fingerprint(model):
+    """Compute the fingerprint of an embedding model.
+
+    Parameters
+    ----------
+    model : EmbeddingModel
+        The embedding model.
+
+    Returns
+    -------
+    str
+        The fingerprint of the checkpoint of the model, see
+        `compute_fingerprint`. For models whose checkpoint is unknown, it is
+        the name of their class. A `LazyEmbeddingModel` is loaded to compute
+        it.
+    """
+    if isinstance(model, LazyEmbeddingModel):
+        return get_model_fingerprint(model.load())
+    elif isinstance(model, SentTransformer):
+        fingerprint = compute_fingerprint(model.model_name_or_path)
+        if model.quantize:
+            fingerprint += "+int8"
+        return fingerprint
+    elif isinstance(model, SklearnVectorizer):
+        return compute_fingerprint(model.checkpoint_path)
+    else:
+        return model.__class__.__name__
+
+
+class EmbeddingCache:
+    """Persistent cache of sentence embeddings in an SQLite database.
+
+    The embeddings are keyed by the model name, the fingerprint of the model
+    checkpoint and the SHA-256 hash of the preprocessed sentence. They are
+    stored as float32.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        Path to the SQLite database. It is created if it does not exist.
+    max_entries : int or None
+        Maximum number of embeddings in the cache. When it is exceeded, the
+        least recently used embeddings are evicted. If None, the cache is
+        not bounded. This is a soft limit when several processes share the
+        cache: the embeddings are counted in memory by each process, which
+        only sees the embeddings added by the others when it opens the
+        cache or evicts embeddings. The cache can therefore temporarily
+        hold up to `max_entries` embeddings more per process.
+    touch_interval : float
+        Minimum number of seconds between two updates of the time an
+        embedding was last used. Reading embeddings used more recently than
+        that does not write to the database, which would otherwise block the
+        other readers.
+    """
+
+    def __init__(self, path, max_entries=None, touch_interval=60.0):
+        self.path = pathlib.Path(path)
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+
+        self.engine = sqlalchemy.create_engine(f"sqlite:///{self.path}")
+        metadata = sqlalchemy.MetaData()
+        self.table = sqlalchemy.Table(
+            "embeddings",
+            metadata,
+            sqlalchemy.Column("model_name", sqlalchemy.Text(), primary_key=True),
+            sqlalchemy.Column("fingerprint", sqlalchemy.Text(), primary_key=True),
+            sqlalchemy.Column("text_hash", sqlalchemy.String(64), primary_key=True),
+            sqlalchemy.Column("embedding", sqlalchemy.LargeBinary(), nullable=False),
+            sqlalchemy.Column("last_used", sqlalchemy.Float(), index=True),
+        )
+        metadata.create_all(self.engine)
+        self.n_entries = len(self)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hash_text(text):
+        """Compute the key of a preprocessed sentence.
+
+        Parameters
+        ----------
+        text : str
+            The preprocessed sentence.
+
+        Returns
+        -------
+        str
+            The hexadecimal SHA-256 hash of the sentence.
+        """
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _chunks(hashes):
+        """Split hashes in chunks, old versions of SQLite limit the parameters."""
+        for start in range(0, len(hashes), 500):
+            yield hashes[start : start + 500]
+
+    def _key_condition(self, model_name, fingerprint, hashes):
+        """Build the condition selecting the embeddings of some hashes."""
+        return sqlalchemy.and_(
+            self.table.c.model_name == model_name,
+            self.table.c.fingerprint == fingerprint,
+            self.table.c.text_hash.in_(hashes),
+        )
+
+    def _count(self, connection):
+        """Count the embeddings in the cache with a table scan."""
+        query = sqlalchemy.select(sqlalchemy.func.count()).select_from(self.table)
+        return connection.execute(query).scalar()
+
+    def __len__(self):
+        """Return the number of embeddings in the cache."""
+        with self.engine.connect() as connection:
+            return self._count(connection)
+
+    def get_many(self, model_name, fingerprint, texts):
+        """Get the cached embeddings of preprocessed sentences.
+
+        Parameters
+        ----------
+        model_name : str
+            The name of the model.
+        fingerprint : str
+            The fingerprint of the model checkpoint.
+        texts : list of str
+            The preprocessed sentences.
+
+        Returns
+        -------
+        dict
+            The keys are the sentences found in the cache and the values are
+            their embeddings as 1D float32 arrays.
+        """
+        hashes = {self.hash_text(text): text for text in texts}
+        if not hashes:
+            return {}
+
+        table = self.table
+        query = sqlalchemy.select(
+            table.c.text_hash, table.c.embedding, table.c.last_used
+        )
+        rows = []
+        with self.engine.connect() as connection:
+            for chunk in self._chunks(list(hashes)):
+                condition = self._key_condition(model_name, fingerprint, chunk)
+                rows.extend(connection.execute(query.where(condition)).fetchall())
+
+        now = time.time()
+        stale_hashes = [
+            text_hash
+            for text_hash, _, last_used in rows
+            if last_used is None or last_used < now - self.touch_interval
+        ]
+        if stale_hashes:
+            with self.engine.begin() as connection:
+                for chunk in self._chunks(stale_hashes):
+                    condition = self._key_condition(model_name, fingerprint, chunk)
+                    connection.execute(
+                        table.update().where(condition).values(last_used=now)
+                    )
+
+        return {
+            hashes[text_hash]: np.frombuffer(embedding, dtype=np.float32)
+            for text_hash, embedding, _ in rows
+        }
+
+    def put_many(self, model_name, fingerprint, texts, embeddings):
+        """Store the embeddings of preprocessed sentences.
+
+        Parameters
+        ----------
+        model_name : str
+            The name of the model.
+        fingerprint : str
+            The fingerprint of the model checkpoint.
+        texts : list of str
+            The preprocessed sentences.
+        embeddings : np.ndarray
+            2D array of shape `(len(texts), dim)` with their embeddings.
+        """
+        now = time.time()
+        entries = {
+            self.hash_text(text): np.asarray(embedding, dtype=np.float32).tobytes()
+            for text, embedding in zip(texts, embeddings)
+        }
+        if not entries:
+            return
+
+        table = self.table
+        # The request threads would otherwise count the same new keys twice
+        with self._lock:
+            with self.engine.begin() as connection:
+                n_existing = 0
+                for chunk in self._chunks(list(entries)):
+                    condition = self._key_condition(model_name, fingerprint, chunk)
+                    query = sqlalchemy.select(sqlalchemy.func.count()).where(condition)
+                    n_existing += connection.execute(query).scalar()
+                connection.execute(
+                    table.insert().prefix_with("OR REPLACE"),
+                    [
+                        {
+                            "model_name": model_name,
+                            "fingerprint": fingerprint,
+                            "text_hash": text_hash,
+                            "embedding": embedding,
+                            "last_used": now,
+                        }
+                        for text_hash, embedding in entries.items()
+                    ],
+                )
+            self.n_entries += len(entries) - n_existing
+            n_entries = self.n_entries
+
+        if self.max_entries is not None and n_entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used embeddings beyond `max_entries`.
+
+        The embeddings are counted again in the same transaction, so that
+        those added by other processes are evicted too.
+        """
+        if self.max_entries is None:
+            return
+
+        rowid = sqlalchemy.literal_column("rowid")
+        with self._lock:
+            with self.engine.begin() as connection:
+                n_entries = self._count(connection)
+                n_evicted = max(n_entries - self.max_entries, 0)
+                if n_evicted:
+                    oldest = (
+                        sqlalchemy.select(rowid)
+                        .select_from(self.table)
+                        .order_by(self.table.c.last_used)
+                        .limit(n_evicted)
+                    )
+                    result = connection.execute(
+                        self.table.delete().where(rowid.in_(oldest))
+                    )
+                    n_entries -= result.rowcount
+            self.n_entries = n_entries
+
+        if n_evicted:
+            logger.info(f"Evicted {n_evicted} embeddings from {self.path}")
+
+
+class CachedEmbeddingModel(EmbeddingModel):
+    """Embedding model looking up its embeddings in an `EmbeddingCache` first.
+
+    Only the sentences that are not in the cache are embedded by the
+    underlying model. Their embeddings are then added to the cache.
+
+    Parameters
+    ----------
+    model : EmbeddingModel
+        The embedding model. It needs to return dense embeddings.
+    cache : EmbeddingCache
+        The cache of embeddings.
+    model_name : str
+        The name of the model in the cache.
+    fingerprint : str or None
+        The fingerprint of the model checkpoint. If None, it is computed
+        with `get_model_fingerprint` on the first use of the cache.
+    """
+
+    def __init__(self, model, cache, model_name, fingerprint=None):
+        if getattr(model, "sparse", False):
+            raise ValueError("Sparse embeddings cannot be cached")
+
+        self.model = model
+        self.cache = cache
+        self.model_name = model_name
+        self._fingerprint = fingerprint
+
+    @property
+    def fingerprint(self):
+        """Return the fingerprint of the model checkpoint."""
+        if self._fingerprint is None:
+            self._fingerprint = get_model_fingerprint(self.model)
+        return self._fingerprint
+
+    @property
+    def dim(self):
+        """Return dimension of the embedding."""
+        return self.model.dim
+
+    def preprocess(self, raw_sentence):
+        """Preprocess the sentence with the underlying model.
+
+        Parameters
+        ----------
+        raw_sentence : str
+            Raw sentence to embed.
+
+        Returns
+        -------
+        preprocessed_sentence
+            Preprocessed sentence.
+        """
+        return self.model.preprocess(raw_sentence)
+
+    def preprocess_many(self, raw_sentences):
+        """Preprocess multiple sentences with the underlying model.
+
+        Parameters
+        ----------
+        raw_sentences : list of str
+            List of raw sentences to embed.
+
+        Returns
+        -------
+        preprocessed_sentences
+            List of preprocessed sentences.
+        """
+        return self.model.preprocess_many(raw_sentences)
+
+    def warmup(self, raw_sentences):
+        """Warm up the underlying model, bypassing the cache.
+
+        Otherwise, the cached sentences would not be embedded again.
+
+        Parameters
+        ----------
+        raw_sentences : sequence of str
+            The raw sentences.
+        """
+        self.model.warmup(raw_sentences)
+
+    def embed(self, preprocessed_sentence):
+        """Compute the embedding of one sentence, or get it from the cache.
+
+        Parameters
+        ----------
+        preprocessed_sentence : str
+            Preprocessed sentence to embed.
+
+        Returns
+        -------
+        embedding : numpy.array
+            One dimensional float32 vector representing the sentence.
+        """
+        return self.embed_many([preprocessed_sentence])[0]
+
+    def embed_many(self, preprocessed_sentences):
+        """Compute the embeddings of sentences, or get them from the cache.
+
+        Parameters
+        ----------
+        preprocessed_sentences : list of str
+            Preprocessed sentences to embed.
+
+        Returns
+        -------
+        embeddings : numpy.array
+            Float32 array of shape `(len(preprocessed_sentences), dim)`.
+        """
+        preprocessed_sentences = list(preprocessed_sentences)
+        cached: Dict[str, np.ndarray] = self.cache.get_many(
+            self.model_name, self.fingerprint, preprocessed_sentences
+        )
+        # Each missing sentence is embedded once
+        missing: List[str] = list(
+            dict.fromkeys(s for s in preprocessed_sentences if s not in cached)
+        )
+        logger.debug(
+            f"Embedding cache: {len(preprocessed_sentences) - len(missing)} hits, "
+            f"{len(missing)} misses"
+        )
+
+        if missing:
+            new_embeddings = np.asarray(
+                self.model.embed_many(missing), dtype=np.float32
+            )
+            self.cache.put_many(
+                self.model_name, self.fingerprint, missing, new_embeddings
+            )
+            cached.update(zip(missing, new_embeddings))
+
+        if not preprocessed_sentences:
+            return np.empty((0, self.dim), dtype=np.float32)
+
+        return np.stack([cached[s] for s in preprocessed_sentences])
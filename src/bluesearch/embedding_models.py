@@ -21,12 +21,19 @@ import logging
 import multiprocessing as mp
 import pathlib
 import pickle  # nosec
+import queue
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Optional, Union
+from contextlib import contextmanager
+from typing import Dict, Optional, Union
 
+import h5py
 import numpy as np
+import scipy.sparse
 import sentence_transformers
 import sqlalchemy
+import torch
 
 from bluesearch.sql import retrieve_sentences_from_sentence_ids
 from bluesearch.utils import H5
@@ -111,6 +118,23 @@ class EmbeddingModel(ABC):
         """
         return np.array([self.embed(sentence) for sentence in preprocessed_sentences])
 
+    def warmup(self, raw_sentences):
+        """Run the model on representative sentences.
+
+        The first calls of a model are slow because of the lazy
+        initialization of the kernels and of the caches of the tokenizers.
+        Running them once at startup makes the latency of the first requests
+        predictable. The sentences are embedded one by one and as a batch.
+
+        Parameters
+        ----------
+        raw_sentences : sequence of str
+            The raw sentences.
+        """
+        for raw_sentence in raw_sentences:
+            self.embed(self.preprocess(raw_sentence))
+        self.embed_many(self.preprocess_many(list(raw_sentences)))
+
 
 class SentTransformer(EmbeddingModel):
     """Sentence Transformer.
@@ -119,17 +143,33 @@ class SentTransformer(EmbeddingModel):
     ----------
     model_name_or_path : pathlib.Path or str
         The name or the path of the Transformer model to load.
+    device : str or torch.device or None
+        The device on which to run the model.
+    quantize : bool
+        If True, the linear layers of the model are dynamically quantized to
+        int8. This speeds up the inference on CPU at the cost of a slight
+        change of the embeddings. Only supported on CPU.
 
     References
     ----------
     https://github.com/UKPLab/sentence-transformers
+    https://pytorch.org/docs/stable/quantization.html
     """
 
-    def __init__(self, model_name_or_path, device=None):
+    def __init__(self, model_name_or_path, device=None, quantize=False):
+        if quantize and device is not None and torch.device(device).type != "cpu":
+            raise ValueError(f"Quantized models only run on CPU, got {device}")
 
+        self.model_name_or_path = model_name_or_path
         self.senttransf_model = sentence_transformers.SentenceTransformer(
             str(model_name_or_path), device=device
         )
+        self.quantize = quantize
+
+        if quantize:
+            self.senttransf_model = torch.quantization.quantize_dynamic(
+                self.senttransf_model, {torch.nn.Linear}, dtype=torch.qint8
+            )
 
     @property
     def dim(self):
@@ -176,10 +216,15 @@ class SklearnVectorizer(EmbeddingModel):
     ----------
     checkpoint_path : pathlib.Path or str
         The path of the scikit-learn model to use for the embeddings in Pickle format.
+    sparse : bool
+        If True, the embeddings are returned as `scipy.sparse.csr_matrix`
+        instead of dense arrays. This saves a lot of memory for vectorizers
+        with many features like TF-IDF or hashing vectorizers.
     """
 
-    def __init__(self, checkpoint_path):
+    def __init__(self, checkpoint_path, sparse=False):
         self.checkpoint_path = pathlib.Path(checkpoint_path)
+        self.sparse = sparse
         with self.checkpoint_path.open("rb") as f:
             self.model = pickle.load(f)  # nosec
 
@@ -213,10 +258,13 @@ class SklearnVectorizer(EmbeddingModel):
 
         Returns
         -------
-        embedding : numpy.ndarray
-            Array of shape `(dim,)` with the sentence embedding.
+        embedding : numpy.ndarray or scipy.sparse.csr_matrix
+            Array of shape `(dim,)` with the sentence embedding. If `sparse`,
+            sparse matrix of shape `(1, dim)`.
         """
         embedding = self.embed_many([preprocessed_sentence])
+        if self.sparse:
+            return embedding
         return embedding.squeeze()
 
     def embed_many(self, preprocessed_sentences):
@@ -230,19 +278,347 @@ class SklearnVectorizer(EmbeddingModel):
 
         Returns
         -------
-        embeddings : numpy.ndarray
+        embeddings : numpy.ndarray or scipy.sparse.csr_matrix
             Array of shape `(len(preprocessed_sentences), dim)` with the
-            sentence embeddings.
+            sentence embeddings. If `sparse`, it is a sparse matrix.
         """
-        embeddings = self.model.transform(preprocessed_sentences).toarray()
-        return embeddings
+        embeddings = self.model.transform(preprocessed_sentences)
+        if self.sparse:
+            return scipy.sparse.csr_matrix(embeddings, dtype=np.float32)
+        return embeddings.toarray()
+
+
+class LazyEmbeddingModel(EmbeddingModel):
+    """Embedding model loaded on its first use.
+
+    Concurrent first uses wait for a single load. The model can then be
+    unloaded to free its memory, it is loaded again on its next use.
+
+    Parameters
+    ----------
+    factory : callable
+        Function without arguments returning the `EmbeddingModel`, e.g.
+        `functools.partial(get_embedding_model, "SBioBERT")`.
+    on_load : callable or None
+        If not None, it is called with this instance after each load.
+    """
+
+    def __init__(self, factory, on_load=None):
+        self.factory = factory
+        self.on_load = on_load
+
+        self.model = None
+        # Monotonic time of the last use, only meaningful when loaded
+        self.last_used = 0.0
+        self.load_seconds = None
+        self.n_active = 0
+        self.lock = threading.RLock()
+
+    @property
+    def is_loaded(self):
+        """Whether the model is loaded."""
+        return self.model is not None
+
+    def load(self):
+        """Load the model if needed.
+
+        Returns
+        -------
+        model : EmbeddingModel
+            The loaded model.
+        """
+        with self.lock:
+            if self.model is None:
+                start = time.perf_counter()
+                self.model = self.factory()
+                self.load_seconds = time.perf_counter() - start
+                self.last_used = time.monotonic()
+                logger.info(f"Loaded a model in {self.load_seconds:.1f} seconds")
+                if self.on_load is not None:
+                    self.on_load(self)
+            return self.model
+
+    def unload(self):
+        """Unload the model unless it is being loaded or used.
+
+        It never waits for the lock of the model, so that models can unload
+        each other without deadlocks.
+
+        Returns
+        -------
+        bool
+            True if the model was unloaded.
+        """
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            if self.model is None or self.n_active > 0:
+                return False
+            self.model = None
+            return True
+        finally:
+            self.lock.release()
+
+    @contextmanager
+    def _use(self):
+        """Give the loaded model and mark it as being used."""
+        with self.lock:
+            model = self.load()
+            self.n_active += 1
+        try:
+            yield model
+        finally:
+            with self.lock:
+                self.n_active -= 1
+                self.last_used = time.monotonic()
+
+    @property
+    def dim(self):
+        """Return dimension of the embedding."""
+        with self._use() as model:
+            return model.dim
+
+    def preprocess(self, raw_sentence):
+        """Preprocess the sentence with the loaded model.
+
+        Parameters
+        ----------
+        raw_sentence : str
+            Raw sentence to embed.
+
+        Returns
+        -------
+        preprocessed_sentence
+            Preprocessed sentence.
+        """
+        with self._use() as model:
+            return model.preprocess(raw_sentence)
+
+    def preprocess_many(self, raw_sentences):
+        """Preprocess multiple sentences with the loaded model.
+
+        Parameters
+        ----------
+        raw_sentences : list of str
+            List of raw sentences to embed.
+
+        Returns
+        -------
+        preprocessed_sentences
+            List of preprocessed sentences.
+        """
+        with self._use() as model:
+            return model.preprocess_many(raw_sentences)
+
+    def embed(self, preprocessed_sentence):
+        """Embed one sentence with the loaded model.
+
+        Parameters
+        ----------
+        preprocessed_sentence : str
+            Preprocessed sentence to embed.
+
+        Returns
+        -------
+        embedding : numpy.array
+            One dimensional vector representing the sentence.
+        """
+        with self._use() as model:
+            return model.embed(preprocessed_sentence)
+
+    def embed_many(self, preprocessed_sentences):
+        """Embed multiple sentences with the loaded model.
+
+        Parameters
+        ----------
+        preprocessed_sentences : list of str
+            Preprocessed sentences to embed.
+
+        Returns
+        -------
+        embeddings : np.ndarray
+            2D array with shape `(len(preprocessed_sentences), self.dim)`.
+        """
+        with self._use() as model:
+            return model.embed_many(preprocessed_sentences)
+
+    def warmup(self, raw_sentences):
+        """Warm up the loaded model.
+
+        Parameters
+        ----------
+        raw_sentences : sequence of str
+            The raw sentences.
+        """
+        with self._use() as model:
+            model.warmup(raw_sentences)
+
+
+def _stack_embeddings(embeddings):
+    """Stack vertically dense or sparse embeddings.
+
+    Parameters
+    ----------
+    embeddings : list of np.ndarray or list of scipy.sparse.spmatrix
+        2D embeddings to stack.
+
+    Returns
+    -------
+    np.ndarray or scipy.sparse.csr_matrix
+        The stacked embeddings. They are sparse if the inputs are sparse.
+    """
+    if scipy.sparse.issparse(embeddings[0]):
+        return scipy.sparse.vstack(embeddings, format="csr")
+    return np.concatenate(embeddings, axis=0)
+
+
+def _embed_window(model, texts, batch_size, sort_by_length, deduplicate):
+    """Embed a window of sentences at once.
+
+    Parameters
+    ----------
+    model : EmbeddingModel
+        Instance of the EmbeddingModel of choice.
+    texts : list of str
+        Raw sentences to embed.
+    batch_size : int
+        Number of sentences to embed at the same time.
+    sort_by_length : bool
+        If True, the batches are made of sentences of similar lengths.
+    deduplicate : bool
+        If True, the sentences are preprocessed first and each distinct
+        preprocessed sentence is embedded only once.
+
+    Returns
+    -------
+    embeddings : np.ndarray or scipy.sparse.csr_matrix
+        2D array with the embeddings of `texts`, in the same order.
+    """
+    if deduplicate:
+        preprocessed_sentences = model.preprocess_many(texts)
+        position_by_sentence: Dict[str, int] = {}
+        inverse = np.array(
+            [
+                position_by_sentence.setdefault(sentence, len(position_by_sentence))
+                for sentence in preprocessed_sentences
+            ],
+            dtype=np.int64,
+        )
+        to_embed = list(position_by_sentence)
+        logger.info(
+            f"Deduplication: embedding {len(to_embed)} distinct sentences out "
+            f"of {len(texts)} ({1 - len(to_embed) / len(texts):.1%} saved)"
+        )
+    else:
+        to_embed = texts
+
+    if sort_by_length:
+        order = np.argsort([len(text) for text in to_embed], kind="stable")
+    else:
+        order = np.arange(len(to_embed))
+
+    batches = []
+    for start_ix in range(0, len(order), batch_size):
+        batch = [to_embed[i] for i in order[start_ix : start_ix + batch_size]]
+        if not deduplicate:
+            batch = model.preprocess_many(batch)
+        batches.append(model.embed_many(batch))
+
+    # Put the embeddings back in the order of the sentences
+    embeddings = _stack_embeddings(batches)[np.argsort(order)]
 
+    if deduplicate:
+        embeddings = embeddings[inverse]
 
-def compute_database_embeddings(connection, model, indices, batch_size=10):
+    return embeddings
+
+
+def iter_database_embeddings(
+    connection,
+    model,
+    indices,
+    batch_size=10,
+    chunk_size=1000,
+    sort_by_length=False,
+    deduplicate=False,
+):
+    """Compute sentences embeddings chunk by chunk.
+
+    The sentences are retrieved from the database `chunk_size` at a time and
+    the embeddings are yielded batch by batch. Therefore, the memory usage
+    does not depend on the number of sentences to embed.
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Engine
+        Connection to the database.
+    model : EmbeddingModel
+        Instance of the EmbeddingModel of choice.
+    indices : np.ndarray
+        1D array storing the sentence_ids for which we want to perform the
+        embedding.
+    batch_size : int
+        Number of sentences to preprocess and embed at the same time. Note
+        that batches do not span several chunks, so `chunk_size` should be
+        a multiple of `batch_size`.
+    chunk_size : int or None
+        Number of sentences to retrieve from the database at the same time.
+        If None, all the sentences are retrieved at once.
+    sort_by_length : bool
+        If True, the sentences of each chunk are sorted by length before
+        being split into batches, so that models padding the sentences to
+        the longest one of the batch waste less computations. The embeddings
+        are put back into the order of the database afterwards and the whole
+        chunk is yielded at once.
+    deduplicate : bool
+        If True, the sentences of each chunk having the same preprocessed
+        text are embedded only once and the whole chunk is yielded at once.
+        The embedding is then copied to all the corresponding rows.
+
+    Yields
+    ------
+    embeddings : np.ndarray
+        2D numpy array with the embeddings of one batch of sentences (of one
+        chunk if `sort_by_length` or `deduplicate`).
+    retrieved_indices : np.ndarray
+        1D array with the sentence_ids of the rows of `embeddings`.
+    """
+    if chunk_size is None:
+        chunk_size = max(len(indices), 1)
+
+    for chunk_start in range(0, len(indices), chunk_size):
+        sentences = retrieve_sentences_from_sentence_ids(
+            indices[chunk_start : chunk_start + chunk_size], connection
+        )
+
+        if (sort_by_length or deduplicate) and len(sentences) > 0:
+            embeddings = _embed_window(
+                model,
+                sentences["text"].to_list(),
+                batch_size,
+                sort_by_length=sort_by_length,
+                deduplicate=deduplicate,
+            )
+            yield embeddings, sentences["sentence_id"].to_numpy()
+            continue
+
+        for start_ix in range(0, len(sentences), batch_size):
+            batch = sentences.iloc[start_ix : start_ix + batch_size]
+
+            preprocessed_sentences = model.preprocess_many(batch["text"].to_list())
+            embeddings = model.embed_many(preprocessed_sentences)
+
+            yield embeddings, batch["sentence_id"].to_numpy()
+
+
+def compute_database_embeddings(
+    connection, model, indices, batch_size=10, sort_by_length=False, deduplicate=False
+):
     """Compute sentences embeddings.
 
     The embeddings are computed for a given model and a given database
-    (articles with covid19_tag True).
+    (articles with covid19_tag True). All the sentences are retrieved at
+    once, see `iter_database_embeddings` for a streaming variant.
 
     Parameters
     ----------
@@ -259,39 +635,39 @@ def compute_database_embeddings(connection, model, indices, batch_size=10):
         `n_sentences % batch_size` (unless it is 0). Note that some models
         (SBioBERT) might perform padding to the longest sentence and bigger
         batch size might not lead to a speedup.
+    sort_by_length : bool
+        If True, the batches are made of sentences of similar lengths. This
+        reduces the padding and does not change the order of the results.
+    deduplicate : bool
+        If True, the sentences having the same preprocessed text are embedded
+        only once.
 
     Returns
     -------
-    final_embeddings : np.array
-        2D numpy array with all sentences embeddings for the given models. Its
-        shape is `(len(retrieved_indices), dim)`.
+    final_embeddings : np.array or scipy.sparse.csr_matrix
+        2D array with all sentences embeddings for the given models. Its
+        shape is `(len(retrieved_indices), dim)`. It is sparse if the model
+        returns sparse embeddings.
     retrieved_indices : np.ndarray
         1D array of sentence_ids that we managed to embed. Note that the order
         corresponds exactly to the rows in `final_embeddings`.
     """
-    sentences = retrieve_sentences_from_sentence_ids(indices, connection)
-    n_sentences = len(sentences)
-
     all_embeddings = []
     all_ids = []
 
-    for batch_ix in range((n_sentences // batch_size) + 1):
-        start_ix = batch_ix * batch_size
-        end_ix = min((batch_ix + 1) * batch_size, n_sentences)
-
-        if start_ix == end_ix:
-            continue
-
-        sentences_text = sentences.iloc[start_ix:end_ix]["text"].to_list()
-        sentences_id = sentences.iloc[start_ix:end_ix]["sentence_id"].to_list()
-
-        preprocessed_sentences = model.preprocess_many(sentences_text)
-        embeddings = model.embed_many(preprocessed_sentences)
-
+    for embeddings, sentences_id in iter_database_embeddings(
+        connection,
+        model,
+        indices,
+        batch_size=batch_size,
+        chunk_size=None,
+        sort_by_length=sort_by_length,
+        deduplicate=deduplicate,
+    ):
         all_ids.extend(sentences_id)
         all_embeddings.append(embeddings)
 
-    final_embeddings = np.concatenate(all_embeddings, axis=0)
+    final_embeddings = _stack_embeddings(all_embeddings)
     retrieved_indices = np.array(all_ids)
 
     return final_embeddings, retrieved_indices
@@ -301,6 +677,8 @@ def get_embedding_model(
     model_name_or_class: str,
     checkpoint_path: Optional[Union[pathlib.Path, str]] = None,
     device: str = "cpu",
+    quantize: bool = False,
+    sparse: bool = False,
 ) -> EmbeddingModel:
     """Load a sentence embedding model from its name or its class and checkpoint.
 
@@ -329,6 +707,12 @@ def get_embedding_model(
         it is the path of the embedding model to load.
     device
         The target device to which load the model ('cpu' or 'cuda').
+    quantize
+        If True, the Transformer model is dynamically quantized to int8 to
+        speed up the inference on CPU. Not supported by scikit-learn models.
+    sparse
+        If True, the scikit-learn model returns sparse embeddings. Not
+        supported by Transformer models.
 
     Returns
     -------
@@ -337,17 +721,21 @@ def get_embedding_model(
     """
     configs = {
         # Transformer models.
-        "SentTransformer": lambda: SentTransformer(checkpoint_path, device),
+        "SentTransformer": lambda: SentTransformer(checkpoint_path, device, quantize),
         "BioBERT NLI+STS": lambda: SentTransformer(
-            "clagator/biobert_v1.1_pubmed_nli_sts", device
+            "clagator/biobert_v1.1_pubmed_nli_sts", device, quantize
         ),
-        "SBioBERT": lambda: SentTransformer("gsarti/biobert-nli", device),
-        "SBERT": lambda: SentTransformer("bert-base-nli-mean-tokens", device),
+        "SBioBERT": lambda: SentTransformer("gsarti/biobert-nli", device, quantize),
+        "SBERT": lambda: SentTransformer("bert-base-nli-mean-tokens", device, quantize),
         # Scikit-learn models.
-        "SklearnVectorizer": lambda: SklearnVectorizer(checkpoint_path),
+        "SklearnVectorizer": lambda: SklearnVectorizer(checkpoint_path, sparse),
     }
     if model_name_or_class not in configs:
         raise ValueError(f"Unknown model name or class: {model_name_or_class}")
+    if quantize and model_name_or_class == "SklearnVectorizer":
+        raise ValueError("Quantization is only supported by Transformer models")
+    if sparse and model_name_or_class != "SklearnVectorizer":
+        raise ValueError("Sparse embeddings are only supported by scikit-learn models")
     return configs[model_name_or_class]()
 
 
@@ -375,8 +763,8 @@ class MPEmbedder:
         Batch size to be used for transfering data from the temporary h5 files to the
         final h5 file.
     n_processes : int
-        Number of processes to use. Note that each process gets
-        `len(indices) / n_processes` sentences to embed.
+        Number of processes to use. The processes pull chunks of sentences
+        to embed from a shared queue until all of them are done.
     checkpoint_path : pathlib.Path or None
         If 'model_name_or_class' is the class, the path of the model to load.
         Otherwise, this argument is ignored.
@@ -401,6 +789,37 @@ class MPEmbedder:
         If True we instantiate the model before running multiprocessing
         in order to download any checkpoints. Once instantiated, the model
         will be deleted.
+    chunk_size : int
+        Number of sentences in each chunk of work. Each chunk is embedded
+        into its own temporary h5 file. Smaller chunks balance the work
+        better between the processes but lead to more temporary files.
+    sort_by_length : bool
+        If True, each chunk is embedded at once with batches of sentences of
+        similar lengths, see `compute_database_embeddings`. Otherwise, the
+        batches follow the order of the database.
+    deduplicate : bool
+        If True, the sentences of a chunk having the same preprocessed text
+        are embedded only once, see `compute_database_embeddings`.
+    quantize : bool
+        If True, the Transformer model is dynamically quantized to int8, see
+        `get_embedding_model`. Only supported on CPU.
+    sparse : bool
+        If True, the scikit-learn model returns sparse embeddings and the
+        output dataset is stored in the CSR format, see `H5.write_sparse`.
+    dtype : str
+        The floating point dtype in which the embeddings are stored, for
+        example "f2" to halve the size of the h5 files. The embeddings are
+        computed in float32 and converted when written.
+    virtual : bool
+        If True, the output dataset is an HDF5 virtual dataset referencing
+        the temporary h5 files instead of a copy of them, see
+        `H5.concatenate_virtual`. The temporary h5 files are then kept
+        whatever `delete_temp` and must stay next to the output h5 file.
+    resume : bool
+        If True, resume an interrupted run with the same parameters. The
+        chunks whose temporary h5 file is complete are not embedded again.
+        If the output dataset already exists, only its unpopulated rows
+        are embedded and then written into it.
     """
 
     def __init__(
@@ -419,6 +838,14 @@ class MPEmbedder:
         h5_dataset_name=None,
         start_method="forkserver",
         preinitialize=True,
+        chunk_size=5000,
+        sort_by_length=False,
+        deduplicate=False,
+        quantize=False,
+        sparse=False,
+        dtype="f4",
+        virtual=False,
+        resume=False,
     ):
         self.database_url = database_url
         self.model_name_or_class = model_name_or_class
@@ -432,6 +859,14 @@ class MPEmbedder:
         self.temp_folder = temp_folder
         self.start_method = start_method
         self.preinitialize = preinitialize
+        self.chunk_size = chunk_size
+        self.sort_by_length = sort_by_length
+        self.deduplicate = deduplicate
+        self.quantize = quantize
+        self.sparse = sparse
+        self.dtype = dtype
+        self.virtual = virtual
+        self.resume = resume
         if h5_dataset_name is None:
             self.h5_dataset_name = model_name_or_class
         else:
@@ -444,6 +879,18 @@ class MPEmbedder:
         if gpus is not None and len(gpus) != n_processes:
             raise ValueError("One needs to specify the GPU for each process separately")
 
+        if gpus is not None and quantize:
+            raise ValueError("Quantized models only run on CPU")
+
+        if sparse and virtual:
+            raise ValueError("Sparse datasets cannot be virtual")
+
+        if np.dtype(dtype).kind != "f":
+            raise ValueError(f"The dtype {dtype} is not a floating point dtype")
+
+        if sparse and np.dtype(dtype) != np.float32:
+            raise ValueError("Sparse datasets are only stored as float32")
+
         self.gpus = gpus
 
     def do_embedding(self):
@@ -451,7 +898,9 @@ class MPEmbedder:
         if self.preinitialize:
             self.logger.info("Preinitializing model (download of checkpoints)")
             model_temp = get_embedding_model(  # noqa
-                self.model_name_or_class, checkpoint_path=self.checkpoint_path
+                self.model_name_or_class,
+                checkpoint_path=self.checkpoint_path,
+                sparse=self.sparse,
             )
             del model_temp
 
@@ -463,73 +912,217 @@ class MPEmbedder:
         self.h5_path_output.parent.mkdir(parents=True, exist_ok=True)
         output_folder.mkdir(parents=True, exist_ok=True)
 
-        worker_processes = []
-        splits = [
-            x for x in np.array_split(self.indices, self.n_processes) if len(x) > 0
-        ]
-        h5_paths_temp = []
+        output_exists = False
+        if self.h5_path_output.exists():
+            with h5py.File(self.h5_path_output, "r") as f:
+                output_exists = self.h5_dataset_name in f
+
+        indices = self.indices
+        if output_exists:
+            if self.sparse or self.virtual:
+                raise ValueError(
+                    f"The dataset {self.h5_dataset_name} already exists in "
+                    f"{self.h5_path_output}, sparse and virtual datasets cannot "
+                    "be resumed"
+                )
+            if not self.resume:
+                raise ValueError(
+                    f"The dataset {self.h5_dataset_name} already exists in "
+                    f"{self.h5_path_output}, use resume to fill its missing rows"
+                )
+            unpop_rows = H5.find_unpopulated_rows(
+                self.h5_path_output, self.h5_dataset_name
+            )
+            n_rows, _ = H5.get_shape(self.h5_path_output, self.h5_dataset_name)
+            if len(indices) > 0 and indices.max() >= n_rows:
+                raise ValueError(
+                    f"The dataset {self.h5_dataset_name} has only {n_rows} rows, "
+                    f"it cannot hold the sentence {indices.max()}"
+                )
+            indices = indices[np.isin(indices, unpop_rows)]
+            self.logger.info(
+                f"Resuming, {len(indices)} of {len(self.indices)} sentences "
+                "are not embedded yet"
+            )
+            if len(indices) == 0:
+                self.logger.info("Nothing left to embed")
+                return
 
-        for process_ix, split in enumerate(splits):
+        task_queue: mp.Queue = mp.Queue()
+        done_queue: mp.Queue = mp.Queue()
+        h5_paths_temp = []
+        done_chunks = set()
+        for chunk_ix, start_ix in enumerate(range(0, len(indices), self.chunk_size)):
             temp_h5_path = (
-                output_folder / f"{self.h5_path_output.stem}_temp{process_ix}.h5"
+                output_folder / f"{self.h5_path_output.stem}_temp{chunk_ix}.h5"
             )
+            chunk = indices[start_ix : start_ix + self.chunk_size]
+            h5_paths_temp.append(temp_h5_path)
+
+            if temp_h5_path.exists():
+                if not self.resume:
+                    raise FileExistsError(f"{temp_h5_path} already exists")
+                if self.is_chunk_done(temp_h5_path, self.h5_dataset_name, chunk):
+                    self.logger.info(f"Chunk {chunk_ix} already done, skipping it")
+                    done_chunks.add(chunk_ix)
+                    continue
+                self.logger.warning(f"Embedding {temp_h5_path} again, stale file")
+                temp_h5_path.unlink()
+
+            task_queue.put((chunk_ix, chunk, temp_h5_path))
+
+        n_chunks = len(h5_paths_temp)
+        n_workers = min(self.n_processes, n_chunks - len(done_chunks))
+        self.logger.info(
+            f"Split the work into {n_chunks} chunks, {len(done_chunks)} already done"
+        )
+        for _ in range(n_workers):
+            task_queue.put(None)  # tell the workers that there is no work left
 
+        worker_processes = []
+        for process_ix in range(n_workers):
             worker_process = mp.Process(
                 name=f"worker_{process_ix}",
                 target=self.run_embedding_worker,
                 kwargs={
                     "database_url": self.database_url,
                     "model_name_or_class": self.model_name_or_class,
-                    "indices": split,
-                    "temp_h5_path": temp_h5_path,
+                    "task_queue": task_queue,
+                    "done_queue": done_queue,
                     "batch_size": self.batch_size_inference,
                     "checkpoint_path": self.checkpoint_path,
                     "gpu": None if self.gpus is None else self.gpus[process_ix],
                     "h5_dataset_name": self.h5_dataset_name,
+                    "sort_by_length": self.sort_by_length,
+                    "deduplicate": self.deduplicate,
+                    "quantize": self.quantize,
+                    "sparse": self.sparse,
+                    "dtype": self.dtype,
                 },
             )
             worker_process.start()
             worker_processes.append(worker_process)
-            h5_paths_temp.append(temp_h5_path)
 
         self.logger.info("Waiting for children to be done")
+        while len(done_chunks) < n_chunks:
+            try:
+                chunk_ix = done_queue.get(timeout=1)
+            except queue.Empty:
+                if not any(process.is_alive() for process in worker_processes):
+                    break
+                continue
+            done_chunks.add(chunk_ix)
+            self.logger.info(
+                f"Chunk {chunk_ix} done, finished {len(done_chunks) / n_chunks:.2%}"
+            )
+
         for process in worker_processes:
             process.join()
 
+        # Chunks reported after the last check
+        while True:
+            try:
+                done_chunks.add(done_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        missing_chunks = sorted(set(range(n_chunks)) - done_chunks)
+        if missing_chunks:
+            raise RuntimeError(
+                f"The chunks {missing_chunks} were not embedded, see the logs "
+                "of the workers"
+            )
+
         self.logger.info("Concatenating children temp h5")
+        if self.sparse:
+            H5.concatenate_sparse(
+                self.h5_path_output,
+                self.h5_dataset_name,
+                h5_paths_temp,
+                delete_inputs=self.delete_temp,
+            )
+            self.logger.info("Concatenation done!")
+            return
+
+        if self.virtual:
+            H5.concatenate_virtual(
+                self.h5_path_output, self.h5_dataset_name, h5_paths_temp
+            )
+            self.logger.info("Concatenation done!")
+            return
+
         H5.concatenate(
             self.h5_path_output,
             self.h5_dataset_name,
             h5_paths_temp,
             delete_inputs=self.delete_temp,
             batch_size=self.batch_size_transfer,
+            append=output_exists,
+            dtype=self.dtype,
         )
         self.logger.info("Concatenation done!")
 
+    @staticmethod
+    def is_chunk_done(temp_h5_path, h5_dataset_name, indices):
+        """Check whether a temporary h5 file holds a given chunk.
+
+        Parameters
+        ----------
+        temp_h5_path : pathlib.Path
+            Path to the temporary h5 file. Note that `embed_chunk` only
+            creates it once all the embeddings of the chunk are written.
+        h5_dataset_name : str
+            The name of the dataset in the H5 file.
+        indices : np.ndarray
+            1D array of sentences ids of the chunk.
+
+        Returns
+        -------
+        bool
+            True if the file contains the embeddings of exactly `indices`.
+        """
+        try:
+            with h5py.File(temp_h5_path, "r") as f:
+                chunk_indices = f[f"{h5_dataset_name}_indices"][:, 0]
+        except (OSError, KeyError):
+            return False
+
+        return np.array_equal(chunk_indices, indices)
+
     @staticmethod
     def run_embedding_worker(
         database_url,
         model_name_or_class,
-        indices,
-        temp_h5_path,
+        task_queue,
+        done_queue,
         batch_size,
         checkpoint_path,
         gpu,
         h5_dataset_name,
+        sort_by_length=False,
+        deduplicate=False,
+        quantize=False,
+        sparse=False,
+        dtype="f4",
     ):
         """Run per worker function.
 
+        The worker pulls chunks of sentence IDs from `task_queue` until it
+        gets None. Each chunk is embedded into its own temporary h5 file
+        and its index is then put to `done_queue`.
+
         Parameters
         ----------
         database_url : str
             URL of the database.
         model_name_or_class : str
             The name or class of the model for which to compute the embeddings.
-        indices : np.ndarray
-            1D array of sentences ids indices representing what
-            the worker needs to embed.
-        temp_h5_path : pathlib.Path
-            Path to where we store the temporary h5 file.
+        task_queue : multiprocessing.Queue
+            Queue of tasks `(chunk_ix, indices, temp_h5_path)`, where `indices`
+            is a 1D array of sentences ids to embed and `temp_h5_path` is the
+            path of the temporary h5 file to create.
+        done_queue : multiprocessing.Queue
+            Queue to which the `chunk_ix` of each finished task is put.
         batch_size : int
             Number of sentences in the batch.
         checkpoint_path : pathlib.Path or None
@@ -540,13 +1133,22 @@ class MPEmbedder:
             with the specified id.
         h5_dataset_name : str or None
             The name of the dataset in the H5 file.
+        sort_by_length : bool
+            If True, the sentences of each chunk are batched by length.
+        deduplicate : bool
+            If True, duplicated sentences of each chunk are embedded once.
+        quantize : bool
+            If True, the model is dynamically quantized to int8.
+        sparse : bool
+            If True, the model returns sparse embeddings.
+        dtype : str
+            The floating point dtype in which the embeddings are stored.
         """
         current_process = mp.current_process()
         cname = current_process.name
         cpid = current_process.pid
 
         logger = logging.getLogger(f"{cname}({cpid})")
-        logger.info(f"First index={indices[0]}")
 
         device = "cpu" if gpu is None else f"cuda:{gpu}"
 
@@ -555,28 +1157,118 @@ class MPEmbedder:
             model_name_or_class,
             checkpoint_path=checkpoint_path,
             device=device,
+            quantize=quantize,
+            sparse=sparse,
         )
         logger.info("Get sentences from the database")
         engine = sqlalchemy.create_engine(database_url)
         engine.dispose()
 
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+
+            chunk_ix, indices, temp_h5_path = task
+            logger.info(f"Chunk {chunk_ix}: first index={indices[0]}")
+            MPEmbedder.embed_chunk(
+                engine,
+                model,
+                indices,
+                temp_h5_path,
+                batch_size,
+                h5_dataset_name,
+                sort_by_length=sort_by_length,
+                deduplicate=deduplicate,
+                dtype=dtype,
+            )
+            done_queue.put(chunk_ix)
+
+        logger.info("CHILD IS DONE")
+
+    @staticmethod
+    def embed_chunk(
+        engine,
+        model,
+        indices,
+        temp_h5_path,
+        batch_size,
+        h5_dataset_name,
+        sort_by_length=False,
+        deduplicate=False,
+        dtype="f4",
+    ):
+        """Embed one chunk of sentences into a temporary h5 file.
+
+        The embeddings are first written into a ".part" file that is
+        renamed to `temp_h5_path` once it is complete. Therefore, an
+        existing `temp_h5_path` always holds the full chunk.
+
+        Parameters
+        ----------
+        engine : sqlalchemy.engine.Engine
+            Connection to the database.
+        model : EmbeddingModel
+            The embedding model.
+        indices : np.ndarray
+            1D array of sentences ids to embed.
+        temp_h5_path : pathlib.Path
+            Path to where we store the temporary h5 file.
+        batch_size : int
+            Number of sentences in the batch.
+        h5_dataset_name : str or None
+            The name of the dataset in the H5 file.
+        sort_by_length : bool
+            If True, the whole chunk is embedded at once with batches of
+            sentences of similar lengths. Otherwise, the batches are embedded
+            and written one by one.
+        deduplicate : bool
+            If True, the whole chunk is embedded at once and the sentences
+            having the same preprocessed text are embedded only once.
+        dtype : str
+            The floating point dtype in which the embeddings are stored. It
+            is ignored for sparse embeddings.
+
+        Notes
+        -----
+        If the model returns sparse embeddings, the whole chunk is embedded at
+        once and stored with `H5.write_sparse`.
+        """
+        current_process = mp.current_process()
+        logger = logging.getLogger(f"{current_process.name}({current_process.pid})")
+
         if temp_h5_path.exists():
             raise FileExistsError(f"{temp_h5_path} already exists")
 
+        part_h5_path = temp_h5_path.with_name(f"{temp_h5_path.name}.part")
+        if part_h5_path.exists():
+            logger.info(f"Removing {part_h5_path} of an interrupted run")
+            part_h5_path.unlink()
+
+        # Sparse embeddings are written at once, see `H5.write_sparse`
+        sparse = getattr(model, "sparse", False)
+
         n_indices = len(indices)
         logger.info("Create temporary h5 files.")
-        H5.create(temp_h5_path, h5_dataset_name, shape=(n_indices, model.dim))
+        if not sparse:
+            H5.create(
+                part_h5_path, h5_dataset_name, shape=(n_indices, model.dim), dtype=dtype
+            )
         H5.create(
-            temp_h5_path,
+            part_h5_path,
             f"{h5_dataset_name}_indices",
             shape=(n_indices, 1),
             dtype="int32",
         )
 
         batch_size = min(n_indices, batch_size)
+        if sort_by_length or deduplicate or sparse:
+            window_size = n_indices
+        else:
+            window_size = batch_size
 
         logger.info("Populating h5 files")
-        splits = np.array_split(np.arange(n_indices), n_indices / batch_size)
+        splits = np.array_split(np.arange(n_indices), n_indices / window_size)
         splits = [split for split in splits if len(split) > 0]
 
         for split_ix, pos_indices in enumerate(splits):
@@ -584,7 +1276,12 @@ class MPEmbedder:
 
             try:
                 embeddings, retrieved_indices = compute_database_embeddings(
-                    engine, model, batch_indices, batch_size=len(batch_indices)
+                    engine,
+                    model,
+                    batch_indices,
+                    batch_size=batch_size,
+                    sort_by_length=sort_by_length,
+                    deduplicate=deduplicate,
                 )
 
                 if not np.array_equal(retrieved_indices, batch_indices):
@@ -592,7 +1289,10 @@ class MPEmbedder:
                         "The retrieved and requested indices do not agree."
                     )
 
-                H5.write(temp_h5_path, h5_dataset_name, embeddings, pos_indices)
+                if sparse:
+                    H5.write_sparse(part_h5_path, h5_dataset_name, embeddings)
+                else:
+                    H5.write(part_h5_path, h5_dataset_name, embeddings, pos_indices)
 
             except Exception as e:
                 logger.error(f"Issues raised for sentence_ids[{batch_indices}]")
@@ -600,12 +1300,12 @@ class MPEmbedder:
                 raise  # any error will lead to the child being stopped
 
             H5.write(
-                temp_h5_path,
+                part_h5_path,
                 f"{h5_dataset_name}_indices",
                 batch_indices.reshape(-1, 1),
                 pos_indices,
             )
 
-            logger.info(f"Finished {(split_ix + 1) / len(splits):.2%}")
+            logger.debug(f"Finished {(split_ix + 1) / len(splits):.2%}")
 
-        logger.info("CHILD IS DONE")
+        part_h5_path.rename(temp_h5_path)
@@ -19,6 +19,7 @@
 
 import argparse
 import collections
+import gc
 import logging
 import os
 import sys
@@ -112,11 +113,124 @@ def get_var(var_name, default=None, *, check_not_set=True, var_type=str):
     return var_type(var)
 
 
+def configure_threads(n_threads):
+    """Limit the number of threads used by the computations of a worker.
+
+    When several workers run on the same machine, each one uses by default
+    as many threads as there are cores, which oversubscribes them. This
+    limits the intra-op and inter-op thread pools of torch, and the thread
+    pools of the BLAS and OpenMP libraries, which are also the ones used by
+    numpy, scikit-learn and spaCy.
+
+    Parameters
+    ----------
+    n_threads : int
+        The number of threads. If 0, the defaults of the libraries are kept.
+    """
+    if n_threads <= 0:
+        return
+
+    import torch
+    from threadpoolctl import threadpool_limits
+
+    logger = logging.getLogger(__name__)
+    torch.set_num_threads(n_threads)
+    try:
+        torch.set_num_interop_threads(n_threads)
+    except RuntimeError:
+        # Torch only allows it before the first parallel work is started
+        logger.warning("The number of inter-op threads of torch cannot be changed")
+    threadpool_limits(limits=n_threads)
+    logger.info(f"Limited the computations to {n_threads} thread(s)")
+
+
+def run_prefork_server(app_factory, host, port, workers, threads=1, timeout=180):
+    """Run a server app in production with pre-forked worker processes.
+
+    The app is created once in a master process of gunicorn, and the worker
+    processes are forked from it. The memory of the models and of the
+    embeddings is therefore shared copy-on-write between the workers. The
+    objects of the app are moved to the permanent generation of the garbage
+    collector with `gc.freeze` before forking, so that collections in the
+    workers do not write to their memory pages and copy them.
+
+    Torch only uses one thread in processes forked after it started its
+    thread pool, and OpenMP cannot start a new one in them. Each worker
+    therefore runs its computations on one thread, the BLAS libraries are
+    limited accordingly, and the parallelism comes from the workers.
+
+    Threads and database connections do not survive a fork either. If the
+    app has an `after_fork` method, it is called in each worker after it is
+    forked, to start its background threads and to discard the connections
+    opened by the master process.
+
+    Sending SIGHUP to the master process reloads the app, e.g. new models
+    or embeddings, and then gracefully replaces the workers. They finish
+    their current requests before exiting.
+
+    Parameters
+    ----------
+    app_factory : callable
+        A factory function that returns an instance of a flask app.
+    host : str
+        The server host.
+    port : int
+        The server port.
+    workers : int
+        The number of worker processes.
+    threads : int
+        The number of threads of each worker handling requests.
+    timeout : int
+        Number of seconds after which a worker not responding is restarted.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError as err:
+        raise ModuleNotFoundError(
+            "The production server requires gunicorn, please install it using "
+            "   $ pip install gunicorn"
+        ) from err
+
+    def post_fork(server, worker):
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(limits=1)
+        app = worker.app.wsgi()
+        if hasattr(app, "after_fork"):
+            app.after_fork()
+
+    class PreforkApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("timeout", timeout)
+            self.cfg.set("preload_app", True)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            app = app_factory()
+            gc.collect()
+            gc.freeze()
+            return app
+
+        def reload(self):
+            super().reload()
+            # Otherwise, the master process keeps the preloaded app
+            self.callable = None
+            gc.unfreeze()
+            # The app factory configures the logging again
+            logging.getLogger().handlers.clear()
+
+    PreforkApplication().run()
+
+
 def run_server(app_factory, name, argv=None):
     """Run a server app from the command line.
 
-    This starts Flask's development web server. For development
-    purposes only. For production use the corresponding docker file.
+    By default, this starts Flask's development web server. For development
+    purposes only. With `--workers`, the production server of
+    `run_prefork_server` is started instead.
 
     Parameters
     ----------
@@ -140,14 +254,47 @@ def run_server(app_factory, name, argv=None):
         type=str,
         help="The name of the .env file with the server configuration",
     )
+    parser.add_argument(
+        "--workers",
+        default=0,
+        type=int,
+        help="""
+        The number of worker processes of the production server. They share
+        the memory of the app loaded once before forking them. If 0, Flask's
+        development server is started instead.
+        """,
+    )
+    parser.add_argument(
+        "--threads",
+        default=1,
+        type=int,
+        help="The number of threads of each worker of the production server",
+    )
+    parser.add_argument(
+        "--timeout",
+        default=180,
+        type=int,
+        help="Seconds after which a worker of the production server not "
+        "responding is restarted",
+    )
     args = parser.parse_args(argv)
 
     # Load configuration from a .env file, if one is found
     load_dotenv(dotenv_path=args.env_file)
 
     # Construct and launch the app
-    app = app_factory()
-    app.run(host=args.host, port=args.port, threaded=True, debug=True)
+    if args.workers > 0:
+        run_prefork_server(
+            app_factory,
+            args.host,
+            args.port,
+            args.workers,
+            threads=args.threads,
+            timeout=args.timeout,
+        )
+    else:
+        app = app_factory()
+        app.run(host=args.host, port=args.port, threaded=True, debug=True)
 
 
 class CombinedHelpFormatter(argparse.HelpFormatter):
@@ -17,20 +17,41 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
+import functools
 import logging
 import sys
 
 from bluesearch.embedding_models import get_embedding_model
-from bluesearch.entrypoint._helper import configure_logging, get_var, run_server
+from bluesearch.entrypoint._helper import (
+    configure_logging,
+    configure_threads,
+    get_var,
+    run_server,
+)
 
 
 def get_embedding_app():
     """Construct the embedding flask app."""
-    from bluesearch.server.embedding_server import EmbeddingServer
+    from bluesearch.embedding_cache import CachedEmbeddingModel, EmbeddingCache
+    from bluesearch.server.embedding_server import (
+        WARMUP_TEXTS,
+        EmbeddingServer,
+        ModelRegistry,
+    )
 
     # Read configuration
     log_file = get_var("BBS_EMBEDDING_LOG_FILE", check_not_set=False)
     log_level = get_var("BBS_EMBEDDING_LOG_LEVEL", logging.INFO, var_type=int)
+    quantize = get_var("BBS_EMBEDDING_QUANTIZE", 0, var_type=int)
+    max_batch_size = get_var("BBS_EMBEDDING_MAX_BATCH_SIZE", 1, var_type=int)
+    max_wait_ms = get_var("BBS_EMBEDDING_MAX_WAIT_MS", 5.0, var_type=float)
+    cache_path = get_var("BBS_EMBEDDING_CACHE_PATH", "")
+    cache_max_entries = get_var("BBS_EMBEDDING_CACHE_MAX_ENTRIES", 0, var_type=int)
+    lazy_loading = get_var("BBS_EMBEDDING_LAZY_LOADING", 0, var_type=int)
+    idle_timeout = get_var("BBS_EMBEDDING_IDLE_TIMEOUT", 0, var_type=float)
+    max_loaded_models = get_var("BBS_EMBEDDING_MAX_LOADED_MODELS", 0, var_type=int)
+    n_threads = get_var("BBS_EMBEDDING_N_THREADS", 0, var_type=int)
+    warmup = get_var("BBS_EMBEDDING_WARMUP", 1, var_type=int)
 
     # Configure logging
     configure_logging(log_file, log_level)
@@ -39,18 +60,63 @@ def get_embedding_app():
     logger.info(" Configuration ".center(80, "-"))
     logger.info(f"log-file            : {log_file}")
     logger.info(f"log-level           : {log_level}")
+    logger.info(f"quantize            : {bool(quantize)}")
+    logger.info(f"max-batch-size      : {max_batch_size}")
+    logger.info(f"max-wait-ms         : {max_wait_ms}")
+    logger.info(f"cache-path          : {cache_path}")
+    logger.info(f"cache-max-entries   : {cache_max_entries}")
+    logger.info(f"lazy-loading        : {bool(lazy_loading)}")
+    logger.info(f"idle-timeout        : {idle_timeout}")
+    logger.info(f"max-loaded-models   : {max_loaded_models}")
+    logger.info(f"n-threads           : {n_threads}")
+    logger.info(f"warmup              : {bool(warmup)}")
     logger.info("-" * 80)
 
+    configure_threads(n_threads)
+
     # Load embedding models
-    logger.info("Loading embedding models")
     supported_models = ["SBERT", "SBioBERT", "BioBERT NLI+STS"]
-    embedding_models = {
-        model_name: get_embedding_model(model_name) for model_name in supported_models
-    }
+    model_registry = None
+    if lazy_loading:
+        logger.info("Embedding models will be loaded on demand")
+        model_registry = ModelRegistry(
+            {
+                model_name: functools.partial(
+                    get_embedding_model, model_name, quantize=bool(quantize)
+                )
+                for model_name in supported_models
+            },
+            idle_timeout=idle_timeout or None,
+            max_loaded_models=max_loaded_models or None,
+            warmup_texts=WARMUP_TEXTS if warmup else None,
+        )
+        embedding_models = dict(model_registry.models)
+    else:
+        logger.info("Loading embedding models")
+        embedding_models = {
+            model_name: get_embedding_model(model_name, quantize=bool(quantize))
+            for model_name in supported_models
+        }
+
+    if cache_path:
+        logger.info(f"Caching the embeddings in {cache_path}")
+        cache = EmbeddingCache(cache_path, max_entries=cache_max_entries or None)
+        embedding_models = {
+            model_name: CachedEmbeddingModel(model, cache, model_name)
+            for model_name, model in embedding_models.items()
+        }
 
     # Create Server app
     logger.info("Creating the server app")
-    embedding_app = EmbeddingServer(embedding_models)
+    embedding_app = EmbeddingServer(
+        embedding_models,
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms,
+        model_registry=model_registry,
+    )
+    if warmup:
+        logger.info("Warming up the embedding models")
+        embedding_app.warmup()
 
     return embedding_app
 
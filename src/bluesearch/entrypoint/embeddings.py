@@ -76,6 +76,15 @@ def run_compute_embeddings(argv=None):
         Otherwise, this argument is ignored.
         """,
     )
+    parser.add_argument(
+        "--chunk-size",
+        default=5000,
+        type=int,
+        help="""
+        Number of sentences in each chunk of work. The processes pull the
+        chunks from a shared queue, so smaller chunks balance the work better.
+        """,
+    )
     parser.add_argument(
         "--db-url",
         type=str,
@@ -144,6 +153,66 @@ def run_compute_embeddings(argv=None):
         type=int,
         help="Number of processes to use",
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="""
+        Resume an interrupted run that used the same arguments. The finished
+        chunks are not embedded again. If the dataset already exists in the
+        output file, only its unpopulated rows are embedded.
+        """,
+    )
+    parser.add_argument(
+        "--sort-by-length",
+        action="store_true",
+        help="""
+        Embed each chunk with batches of sentences of similar lengths. This
+        reduces the padding done by transformer models.
+        """,
+    )
+    parser.add_argument(
+        "--deduplicate",
+        action="store_true",
+        help="""
+        Embed only once the sentences of a chunk having the same preprocessed
+        text. The embedding is copied to all the corresponding rows.
+        """,
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="""
+        Dynamically quantize the linear layers of Transformer models to int8.
+        This speeds up the embedding on CPU. Cannot be used with GPUs.
+        """,
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="""
+        Store the embeddings of scikit-learn models as a sparse CSR matrix
+        instead of a dense dataset. Only for SklearnVectorizer.
+        """,
+    )
+    parser.add_argument(
+        "--dtype",
+        default="float32",
+        choices=["float16", "float32"],
+        type=str,
+        help="""
+        The dtype in which the embeddings are stored. Using float16 halves the
+        size of the output file. Sparse embeddings are always float32.
+        """,
+    )
+    parser.add_argument(
+        "--virtual",
+        action="store_true",
+        help="""
+        Create the output dataset as an HDF5 virtual dataset referencing the
+        temporary h5 files instead of copying them. The temporary files are
+        kept and must stay next to the output file.
+        """,
+    )
     parser.add_argument(
         "-s",
         "--start-method",
@@ -228,6 +297,14 @@ def run_compute_embeddings(argv=None):
         temp_folder=temp_dir,
         h5_dataset_name=args.h5_dataset_name,
         start_method=args.start_method,
+        chunk_size=args.chunk_size,
+        sort_by_length=args.sort_by_length,
+        deduplicate=args.deduplicate,
+        quantize=args.quantize,
+        sparse=args.sparse,
+        dtype=args.dtype,
+        virtual=args.virtual,
+        resume=args.resume,
     )
 
     logger.info("Starting embedding")
@@ -23,19 +23,28 @@ import sys
 
 import sqlalchemy
 
-from bluesearch.entrypoint._helper import configure_logging, get_var, run_server
+from bluesearch.entrypoint._helper import (
+    configure_logging,
+    configure_threads,
+    get_var,
+    run_server,
+)
 from bluesearch.utils import get_available_spacy_models
 
 
 def get_mining_app():
     """Construct the mining flask app."""
     from bluesearch.server.mining_server import MiningServer
+    from bluesearch.sql import InstrumentedQueuePool, ReplicatedEngine
 
     # Read configuration
     log_file = get_var("BBS_MINING_LOG_FILE", check_not_set=False)
     log_level = get_var("BBS_MINING_LOG_LEVEL", logging.INFO, var_type=int)
     db_type = get_var("BBS_MINING_DB_TYPE")
+    replica_urls = get_var("BBS_MINING_DB_REPLICA_URLS", "")
     data_and_models_dir = get_var("BBS_DATA_AND_MODELS_DIR")
+    n_threads = get_var("BBS_MINING_N_THREADS", 0, var_type=int)
+    warmup = get_var("BBS_MINING_WARMUP", 1, var_type=int)
 
     # Configure logging
     configure_logging(log_file, log_level)
@@ -45,9 +54,14 @@ def get_mining_app():
     logger.info(f"log-file                : {log_file}")
     logger.info(f"log-level               : {log_level}")
     logger.info(f"db-type                 : {db_type}")
+    logger.info(f"replica-urls            : {replica_urls}")
     logger.info(f"data_and_models_dir     : {data_and_models_dir}")
+    logger.info(f"n-threads               : {n_threads}")
+    logger.info(f"warmup                  : {bool(warmup)}")
     logger.info("-" * 80)
 
+    configure_threads(n_threads)
+
     # Create the database engine
     logger.info("Creating the database engine")
     if db_type == "sqlite":
@@ -58,24 +72,49 @@ def get_mining_app():
             sqlite_db_path.touch()
         engine_url = f"sqlite:///{sqlite_db_path}"
         logger.info(f"engine-url              : {engine_url}")
-        engine = sqlalchemy.create_engine(engine_url)
+
+        def create_engine(url):
+            return sqlalchemy.create_engine(f"sqlite:///{url}")
+
+        engine = create_engine(sqlite_db_path)
     elif db_type == "mysql":
         mysql_url = get_var("BBS_MINING_DB_URL")
         mysql_user = get_var("BBS_MINING_MYSQL_USER")
         mysql_password = get_var("BBS_MINING_MYSQL_PASSWORD")
+        pool_size = get_var("BBS_MINING_DB_POOL_SIZE", 5, var_type=int)
+        max_overflow = get_var("BBS_MINING_DB_MAX_OVERFLOW", 10, var_type=int)
+        pool_pre_ping = get_var("BBS_MINING_DB_POOL_PRE_PING", 0, var_type=int)
         logger.info(f"mysql-url               : {mysql_url}")
         logger.info(f"mysql-user              : {mysql_user}")
-        engine_url = (
-            f"mysql+mysqldb://{mysql_user}:{mysql_password}@{mysql_url}?charset=utf8mb4"
-        )
-        engine = sqlalchemy.create_engine(engine_url)
+        logger.info(f"pool-size               : {pool_size}")
+        logger.info(f"max-overflow            : {max_overflow}")
+        logger.info(f"pool-pre-ping           : {pool_pre_ping}")
+
+        def create_engine(url):
+            return sqlalchemy.create_engine(
+                f"mysql+mysqldb://{mysql_user}:{mysql_password}@{url}?charset=utf8mb4",
+                poolclass=InstrumentedQueuePool,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_pre_ping=bool(pool_pre_ping),
+            )
+
+        engine = create_engine(mysql_url)
     else:
         raise ValueError(f"This is not a valid database type: {db_type}.")
 
+    replica_urls = [url.strip() for url in replica_urls.split(",") if url.strip()]
+    if replica_urls:
+        logger.info(f"Routing the reads to {len(replica_urls)} replica(s)")
+        engine = ReplicatedEngine(engine, [create_engine(url) for url in replica_urls])
+
     # Create the server app
     logger.info("Creating the server app")
     ee_models_paths = get_available_spacy_models(data_and_models_dir)
     mining_app = MiningServer(models_libs={"ee": ee_models_paths}, connection=engine)
+    if warmup:
+        logger.info("Warming up the NER models")
+        mining_app.warmup()
 
     return mining_app
 
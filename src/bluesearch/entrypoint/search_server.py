@@ -23,12 +23,19 @@ import sys
 
 import sqlalchemy
 
-from bluesearch.entrypoint._helper import configure_logging, get_var, run_server
+from bluesearch.entrypoint._helper import (
+    configure_logging,
+    configure_threads,
+    get_var,
+    run_server,
+)
 
 
 def get_search_app():
     """Construct the search flask app."""
+    from bluesearch.embedding_cache import EmbeddingCache
     from bluesearch.server.search_server import SearchServer
+    from bluesearch.sql import InstrumentedQueuePool, ReplicatedEngine
     from bluesearch.utils import H5
 
     # Read configuration
@@ -40,8 +47,18 @@ def get_search_app():
     which_models = get_var("BBS_SEARCH_MODELS")
 
     mysql_url = get_var("BBS_SEARCH_DB_URL")
+    replica_urls = get_var("BBS_SEARCH_DB_REPLICA_URLS", "")
     mysql_user = get_var("BBS_SEARCH_MYSQL_USER")
     mysql_password = get_var("BBS_SEARCH_MYSQL_PASSWORD")
+    pool_size = get_var("BBS_SEARCH_DB_POOL_SIZE", 5, var_type=int)
+    max_overflow = get_var("BBS_SEARCH_DB_MAX_OVERFLOW", 10, var_type=int)
+    pool_pre_ping = get_var("BBS_SEARCH_DB_POOL_PRE_PING", 0, var_type=int)
+    cache_path = get_var("BBS_SEARCH_EMBEDDING_CACHE_PATH", "")
+    cache_max_entries = get_var(
+        "BBS_SEARCH_EMBEDDING_CACHE_MAX_ENTRIES", 0, var_type=int
+    )
+    n_threads = get_var("BBS_SEARCH_N_THREADS", 0, var_type=int)
+    warmup = get_var("BBS_SEARCH_WARMUP", 1, var_type=int)
 
     # Configure logging
     configure_logging(log_file, log_level)
@@ -54,22 +71,60 @@ def get_search_app():
     logger.info(f"embeddings-path   : {embeddings_path}")
     logger.info(f"which-models      : {which_models}")
     logger.info(f"mysql_url         : {mysql_url}")
+    logger.info(f"replica_urls      : {replica_urls}")
     logger.info(f"mysql_user        : {mysql_user}")
     logger.info(f"mysql_password    : {mysql_password}")
+    logger.info(f"pool_size         : {pool_size}")
+    logger.info(f"max_overflow      : {max_overflow}")
+    logger.info(f"pool_pre_ping     : {pool_pre_ping}")
+    logger.info(f"cache_path        : {cache_path}")
+    logger.info(f"cache_max_entries : {cache_max_entries}")
+    logger.info(f"n_threads         : {n_threads}")
+    logger.info(f"warmup            : {bool(warmup)}")
     logger.info("-" * 80)
 
+    configure_threads(n_threads)
+
     # Initialize flask app
     logger.info("Creating the Flask app")
     models_path = pathlib.Path(models_path)
     embeddings_path = pathlib.Path(embeddings_path)
-    engine_url = f"mysql://{mysql_user}:{mysql_password}@{mysql_url}"
-    engine = sqlalchemy.create_engine(engine_url, pool_recycle=14400)
+
+    def create_engine(url):
+        return sqlalchemy.create_engine(
+            f"mysql://{mysql_user}:{mysql_password}@{url}",
+            poolclass=InstrumentedQueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=bool(pool_pre_ping),
+            pool_recycle=14400,
+        )
+
+    engine = create_engine(mysql_url)
+    replica_urls = [url.strip() for url in replica_urls.split(",") if url.strip()]
+    if replica_urls:
+        logger.info(f"Routing the reads to {len(replica_urls)} replica(s)")
+        engine = ReplicatedEngine(engine, [create_engine(url) for url in replica_urls])
     models_list = [model.strip() for model in which_models.split(",")]
     indices = H5.find_populated_rows(embeddings_path, models_list[0])
+    embedding_cache = None
+    if cache_path:
+        embedding_cache = EmbeddingCache(
+            cache_path, max_entries=cache_max_entries or None
+        )
 
     server_app = SearchServer(
-        models_path, embeddings_path, indices, engine, models_list
+        models_path,
+        embeddings_path,
+        indices,
+        engine,
+        models_list,
+        embedding_cache=embedding_cache,
     )
+    if warmup:
+        logger.info("Warming up the search")
+        server_app.warmup()
+
     return server_app
 
 
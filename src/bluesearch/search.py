@@ -20,15 +20,43 @@
 import logging
 
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 import torch
 import torch.nn.functional as nnf
 
-from bluesearch.sql import SentenceFilter, retrieve_article_ids
+from bluesearch.sql import PublishYearIndex, SentenceFilter, retrieve_article_ids
 from bluesearch.utils import Timer
 
 logger = logging.getLogger(__name__)
 
 
+def _to_query_vector(embedding, sparse):
+    """Convert the embedding of a query for the scoring.
+
+    Parameters
+    ----------
+    embedding : np.ndarray or scipy.sparse.spmatrix
+        Embedding of the query as returned by the embedding model.
+    sparse : bool
+        If True, the precomputed embeddings are sparse.
+
+    Returns
+    -------
+    torch.Tensor or scipy.sparse.csr_matrix
+        1D tensor if not `sparse`. Otherwise, sparse matrix of shape
+        `(1, dim)`.
+    """
+    if sparse:
+        if not scipy.sparse.issparse(embedding):
+            embedding = embedding.reshape(1, -1)
+        return scipy.sparse.csr_matrix(embedding, dtype=np.float32)
+
+    if scipy.sparse.issparse(embedding):
+        embedding = embedding.toarray().squeeze(axis=0)
+    return torch.from_numpy(embedding).to(dtype=torch.float32)
+
+
 class SearchEngine:
     """Search locally using assets on disk.
 
@@ -44,7 +72,8 @@ class SearchEngine:
     embedding_models : dict
         The pre-trained models.
     precomputed_embeddings : dict
-        The pre-computed embeddings.
+        The pre-computed embeddings. Their rows are expected to be normalized.
+        They are either 2D tensors or sparse matrices in the CSR format.
     indices : np.ndarray
         1D array containing sentence_ids corresponding to the rows of each of the
         values of precomputed_embeddings.
@@ -60,6 +89,11 @@ class SearchEngine:
         logger.info("Retrieving articles ids for all sentence ids...")
         self.all_article_ids = retrieve_article_ids(self.connection)
         logger.info("Retrieve articles ids: DONE")
+        logger.info("Building the publication year index...")
+        self.year_index = PublishYearIndex.from_engine(
+            self.connection, article_ids=self.all_article_ids
+        )
+        logger.info("Building the publication year index: DONE")
 
     def query(
         self,
@@ -133,6 +167,7 @@ class SearchEngine:
         """
         embedding_model = self.embedding_models[which_model]
         precomputed_embeddings = self.precomputed_embeddings[which_model]
+        sparse = scipy.sparse.issparse(precomputed_embeddings)
 
         logger.info("Starting run_search")
 
@@ -146,7 +181,7 @@ class SearchEngine:
             logger.info("Embedding the query text")
             preprocessed_query_text = embedding_model.preprocess(query_text)
             embedding_query = embedding_model.embed(preprocessed_query_text)
-            embedding_query = torch.from_numpy(embedding_query).to(dtype=torch.float32)
+            embedding_query = _to_query_vector(embedding_query, sparse)
 
         if deprioritize_text is None:
             combined_embeddings = embedding_query
@@ -159,8 +194,8 @@ class SearchEngine:
                 embedding_deprioritize = embedding_model.embed(
                     preprocessed_deprioritize_text
                 )
-                embedding_deprioritize = torch.from_numpy(embedding_deprioritize).to(
-                    dtype=torch.float32
+                embedding_deprioritize = _to_query_vector(
+                    embedding_deprioritize, sparse
                 )
 
             deprioritizations = {
@@ -177,16 +212,20 @@ class SearchEngine:
                 alpha_1 * embedding_query - alpha_2 * embedding_deprioritize
             )
 
-        norm = torch.norm(input=combined_embeddings).item()
+        if sparse:
+            norm = scipy.sparse.linalg.norm(combined_embeddings)
+        else:
+            norm = torch.norm(input=combined_embeddings).item()
         if norm == 0:
             norm = 1
-        combined_embeddings /= norm
+        combined_embeddings = combined_embeddings / norm
 
         with timer("sentences_filtering"):
             logger.info("Applying sentence filtering")
             restricted_sentence_ids = torch.from_numpy(
                 (
                     SentenceFilter(self.connection)
+                    .use_year_index(self.year_index)
                     .only_english(is_english)
                     .only_with_journal(has_journal)
                     .discard_bad_sentences(discard_bad_sentences)
@@ -204,9 +243,13 @@ class SearchEngine:
         # Compute similarities
         with timer("query_similarity"):
             logger.info("Computing cosine similarities for the combined query")
-            similarities = nnf.linear(
-                input=combined_embeddings, weight=precomputed_embeddings
-            )
+            if sparse:
+                similarities = precomputed_embeddings @ combined_embeddings.T
+                similarities = torch.from_numpy(similarities.toarray().ravel())
+            else:
+                similarities = nnf.linear(
+                    input=combined_embeddings, weight=precomputed_embeddings
+                )
 
         logger.info(f"Sorting the similarities and getting the top {k} results")
         top_sentence_ids, top_similarities = self.get_top_k_results(
@@ -18,13 +18,275 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import csv
+import gc
 import io
+import logging
+import os
+import queue
 import textwrap
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional
 
+import numpy as np
 from flask import Flask, jsonify, make_response, request
 
 import bluesearch
+from bluesearch.embedding_cache import CachedEmbeddingModel
+from bluesearch.embedding_models import LazyEmbeddingModel
 from bluesearch.server.invalid_usage_exception import InvalidUsage
+from bluesearch.sql import discard_connections
+
+logger = logging.getLogger(__name__)
+
+WARMUP_TEXTS = (
+    "Glucose is a risk factor for COVID-19.",
+    "The virus binds to the ACE2 receptor of the host cells.",
+    "Hydroxychloroquine did not reduce the mortality of the hospitalized "
+    "patients in this randomized controlled trial.",
+    "Neurons",
+)
+
+
+class MicroBatcher:
+    """Combine the concurrent embedding requests of a model into batches.
+
+    A background thread takes the pending requests from a queue. It waits
+    at most `max_wait_ms` for more of them after the first one, embeds them
+    with one `embed_many` call and sends back the individual results.
+
+    The thread is started by the first request of each process, or by
+    `start`. Threads do not survive a fork, so a batcher created before the
+    workers of `run_prefork_server` are forked starts its own thread in each
+    of them.
+
+    Parameters
+    ----------
+    model : EmbeddingModel
+        The embedding model.
+    max_batch_size : int
+        Maximum number of sentences embedded at once.
+    max_wait_ms : float
+        Maximum number of milliseconds a request waits for others to be
+        batched with.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5.0):
+        if max_batch_size < 1:
+            raise ValueError("The maximum batch size needs to be at least 1")
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+        self.queue: queue.Queue = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the thread of the current process, if not started yet."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # The requests pending in the parent process are not ours
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(
+                target=self._run, args=(self.queue,), daemon=True
+            )
+            self.thread.start()
+            self._pid = os.getpid()
+
+    def embed(self, preprocessed_sentence):
+        """Embed one sentence as part of a batch.
+
+        Parameters
+        ----------
+        preprocessed_sentence : str
+            Preprocessed sentence to embed.
+
+        Returns
+        -------
+        np.ndarray
+            1D array representing the sentence embedding.
+        """
+        if self._pid != os.getpid():
+            self.start()
+
+        future: Future = Future()
+        self.queue.put((preprocessed_sentence, future))
+
+        return future.result()
+
+    def _run(self, pending_queue):
+        """Embed the batches of pending requests, forever."""
+        while True:
+            pending = [pending_queue.get()]
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        pending.append(pending_queue.get(timeout=timeout))
+                    else:
+                        pending.append(pending_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._embed_batch(pending)
+
+    def _embed_batch(self, pending):
+        """Embed a batch of requests and set their results."""
+        sentences = [sentence for sentence, _ in pending]
+        try:
+            embeddings = self.model.embed_many(sentences)
+        except Exception as exc:
+            for _, future in pending:
+                future.set_exception(exc)
+        else:
+            for (_, future), embedding in zip(pending, embeddings):
+                future.set_result(embedding)
+
+
+class ModelRegistry:
+    """Embedding models loaded on demand and unloaded when not used.
+
+    Each model is a `LazyEmbeddingModel`, loaded by its first request. A
+    background thread unloads the models that were not used for
+    `idle_timeout` seconds. When a model is loaded and more than
+    `max_loaded_models` are, the least recently used ones are unloaded.
+
+    The thread is started by the first load of a model in each process, or
+    by `start`. Threads do not survive a fork, so a registry created before
+    the workers of `run_prefork_server` are forked starts its own thread in
+    each of them.
+
+    Parameters
+    ----------
+    factories : dict
+        The keys are the model names and the values are functions without
+        arguments returning the models.
+    idle_timeout : float or None
+        Number of seconds after which a model that is not used is unloaded.
+        If None, the models are not unloaded because of idleness.
+    max_loaded_models : int or None
+        Maximum number of models loaded at the same time. If None, there is
+        no limit.
+    warmup_texts : sequence of str or None
+        If not None, each model is warmed up with these sentences when it
+        is loaded, see `EmbeddingModel.warmup`.
+    """
+
+    def __init__(
+        self,
+        factories,
+        idle_timeout=None,
+        max_loaded_models=None,
+        warmup_texts=None,
+    ):
+        if max_loaded_models is not None and max_loaded_models < 1:
+            raise ValueError("At least one model needs to be loaded at a time")
+
+        self.idle_timeout = idle_timeout
+        self.max_loaded_models = max_loaded_models
+        self.warmup_texts = warmup_texts
+        self.models = {
+            model_name: LazyEmbeddingModel(factory, on_load=self._on_load)
+            for model_name, factory in factories.items()
+        }
+
+        self.thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the thread unloading the idle models, if not started yet.
+
+        Nothing is started if `idle_timeout` is None.
+        """
+        if self.idle_timeout is None:
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        """Unload the idle models, forever."""
+        while True:
+            time.sleep(min(self.idle_timeout / 2, 60))
+            self.evict_idle()
+
+    def _unload(self, model_name, reason):
+        """Unload a model and release its memory."""
+        if self.models[model_name].unload():
+            gc.collect()
+            logger.info(f"Unloaded the model {model_name} ({reason})")
+            return True
+        return False
+
+    def evict_idle(self):
+        """Unload the models that were not used for `idle_timeout` seconds."""
+        if self.idle_timeout is None:
+            return
+
+        now = time.monotonic()
+        for model_name, model in self.models.items():
+            if model.is_loaded and now - model.last_used > self.idle_timeout:
+                self._unload(model_name, "idle")
+
+    def _on_load(self, loaded_model):
+        """Enforce the budget of models and warm up the loaded one."""
+        if self._pid != os.getpid():
+            self.start()
+        if self.max_loaded_models is not None:
+            self._enforce_budget(loaded_model)
+        if self.warmup_texts is not None:
+            loaded_model.model.warmup(self.warmup_texts)
+
+    def _enforce_budget(self, loaded_model):
+        """Unload the least recently used models beyond the budget."""
+        others = sorted(
+            (
+                (model.last_used, model_name)
+                for model_name, model in self.models.items()
+                if model.is_loaded and model is not loaded_model
+            )
+        )
+        n_excess = len(others) + 1 - self.max_loaded_models
+        for _, model_name in others:
+            if n_excess <= 0:
+                break
+            if self._unload(model_name, "budget"):
+                n_excess -= 1
+
+    def state(self):
+        """Describe the state of the models.
+
+        Returns
+        -------
+        dict
+            The keys are the model names and the values are dictionaries
+            with whether the model is loaded, for how many seconds it was
+            not used and how many seconds its last load took.
+        """
+        now = time.monotonic()
+        return {
+            model_name: {
+                "loaded": model.is_loaded,
+                "idle_seconds": (
+                    round(now - model.last_used, 1) if model.is_loaded else None
+                ),
+                "load_seconds": (
+                    None if model.load_seconds is None else round(model.load_seconds, 1)
+                ),
+            }
+            for model_name, model in self.models.items()
+        }
 
 
 class EmbeddingServer(Flask):
@@ -35,9 +297,25 @@ class EmbeddingServer(Flask):
     embedding_models : dict
         Dictionary whom keys are name of embedding_models
         and values are instance of the embedding models.
+    max_batch_size : int
+        If greater than 1, the concurrent requests to `/v1/embed` are
+        combined into batches of at most this number of sentences, see
+        `MicroBatcher`. Otherwise, each sentence is embedded on its own.
+    max_wait_ms : float
+        Maximum number of milliseconds a request waits for others to be
+        batched with. Only used if `max_batch_size` is greater than 1.
+    model_registry : ModelRegistry or None
+        If the models are loaded on demand, their registry. The state of
+        the models is then reported by `/help`.
     """
 
-    def __init__(self, embedding_models):
+    def __init__(
+        self,
+        embedding_models,
+        max_batch_size=1,
+        max_wait_ms=5.0,
+        model_registry=None,
+    ):
         package_name, *_ = __name__.partition(".")
         super().__init__(import_name=package_name)
 
@@ -55,9 +333,25 @@ class EmbeddingServer(Flask):
             view_func=self.request_embedding,
             methods=["POST"],
         )
+        self.add_url_rule(
+            rule="/v1/embed_batch/<output_type>",
+            view_func=self.request_embedding_batch,
+            methods=["POST"],
+        )
         self.register_error_handler(InvalidUsage, self.handle_invalid_usage)
 
         self.embedding_models = embedding_models
+        self.model_registry = model_registry
+        self.batchers = {}
+        if max_batch_size > 1:
+            self.logger.info(
+                f"Batching requests by up to {max_batch_size} sentences, "
+                f"waiting at most {max_wait_ms} ms"
+            )
+            self.batchers = {
+                model_name: MicroBatcher(model, max_batch_size, max_wait_ms)
+                for model_name, model in embedding_models.items()
+            }
 
         html_header = """
         <!DOCTYPE html>
@@ -71,9 +365,63 @@ class EmbeddingServer(Flask):
             "csv": self.make_csv_response,
             "json": self.make_json_response,
         }
+        self.batch_output_fn = {
+            "json": self.make_json_batch_response,
+            "npy": self.make_npy_batch_response,
+        }
 
         self.logger.info("Initialization done.")
 
+    def after_fork(self):
+        """Prepare the server for a worker process forked after its creation.
+
+        The background threads of the batchers and of the model registry are
+        started in the worker, and the connections to the embedding caches
+        inherited from the parent process are discarded.
+        """
+        for batcher in self.batchers.values():
+            batcher.start()
+        if self.model_registry is not None:
+            self.model_registry.start()
+        for model in self.embedding_models.values():
+            if isinstance(model, CachedEmbeddingModel):
+                discard_connections(model.cache.engine)
+
+    def warmup(self, texts=WARMUP_TEXTS):
+        """Warm up the embedding models with representative sentences.
+
+        The models loaded on demand which are not loaded yet are skipped.
+        They are warmed up when they are loaded if the `ModelRegistry` was
+        created with `warmup_texts`.
+
+        Parameters
+        ----------
+        texts : sequence of str
+            The raw sentences, see `EmbeddingModel.warmup`.
+
+        Returns
+        -------
+        dict
+            The keys are the names of the warmed up models and the values
+            are the durations of their warmup in seconds.
+        """
+        timings = {}
+        for model_name, model in self.embedding_models.items():
+            if isinstance(model, CachedEmbeddingModel):
+                lazy_model = model.model
+            else:
+                lazy_model = model
+            if isinstance(lazy_model, LazyEmbeddingModel) and not lazy_model.is_loaded:
+                continue
+            start = time.perf_counter()
+            model.warmup(texts)
+            timings[model_name] = time.perf_counter() - start
+            self.logger.info(
+                f"Warmed up the model {model_name} in {timings[model_name]:.1f} seconds"
+            )
+
+        return timings
+
     @staticmethod
     def handle_invalid_usage(error):
         """Handle invalid usage."""
@@ -109,9 +457,29 @@ class EmbeddingServer(Flask):
                         "text": [],
                     },
                 },
+                "/v1/embed_batch/json": {
+                    "description": "Compute the embeddings of multiple texts.",
+                    "response_content_type": "application/json",
+                    "required_fields": {
+                        "model": ["SBioBERT", "SBERT", "BioBERT NLI+STS"],
+                        "texts": [],
+                    },
+                },
+                "/v1/embed_batch/npy": {
+                    "description": "Compute the embeddings of multiple texts. "
+                    "The response is a 2D array in the NumPy .npy format.",
+                    "response_content_type": "application/octet-stream",
+                    "required_fields": {
+                        "model": ["SBioBERT", "SBERT", "BioBERT NLI+STS"],
+                        "texts": [],
+                    },
+                },
             },
         }
 
+        if self.model_registry is not None:
+            response["models"] = self.model_registry.state()
+
         return jsonify(response)
 
     def request_welcome(self):
@@ -160,7 +528,10 @@ class EmbeddingServer(Flask):
         try:
             model_instance = self.embedding_models[model]
             preprocessed_sentence = model_instance.preprocess(text)
-            embedding = model_instance.embed(preprocessed_sentence)
+            if model in self.batchers:
+                embedding = self.batchers[model].embed(preprocessed_sentence)
+            else:
+                embedding = model_instance.embed(preprocessed_sentence)
             return embedding
         except KeyError:
             raise InvalidUsage(f"Model {model} is not available.")
@@ -175,6 +546,47 @@ class EmbeddingServer(Flask):
             """
             raise InvalidUsage(textwrap.dedent(msg).strip())
 
+    def embed_texts(self, model, texts):
+        """Embed multiple texts at once.
+
+        Parameters
+        ----------
+        model : str
+            String representing the model name.
+        texts : list of str
+            Texts to be embedded.
+
+        Returns
+        -------
+        np.ndarray
+            2D array of shape `(len(texts), dim)` with the text embeddings.
+
+        Raises
+        ------
+        InvalidUsage
+            If the model name is invalid.
+        """
+        try:
+            model_instance = self.embedding_models[model]
+        except KeyError:
+            raise InvalidUsage(f"Model {model} is not available.")
+
+        try:
+            preprocessed_sentences = model_instance.preprocess_many(texts)
+            embeddings = model_instance.embed_many(preprocessed_sentences)
+        except RuntimeError:
+            msg = f"""
+            An unhandled error occurred. You may want to contact the
+            developers and provide them the model name and the texts
+            of the query that caused this error.
+
+            "model": "{model}"
+            "number of texts": {len(texts)}
+            """
+            raise InvalidUsage(textwrap.dedent(msg).strip())
+
+        return np.asarray(embeddings)
+
     @staticmethod
     def make_csv_response(embedding):
         """Generate a csv response."""
@@ -196,6 +608,26 @@ class EmbeddingServer(Flask):
 
         return response
 
+    @staticmethod
+    def make_json_batch_response(embeddings):
+        """Generate a json response with multiple embeddings."""
+        json_response = {"embeddings": embeddings.tolist()}
+        response = jsonify(json_response)
+
+        return response
+
+    @staticmethod
+    def make_npy_batch_response(embeddings):
+        """Generate a binary response with the embeddings in the .npy format."""
+        npy_file = io.BytesIO()
+        np.save(npy_file, embeddings, allow_pickle=False)
+
+        response = make_response(npy_file.getvalue())
+        response.headers["Content-Disposition"] = "attachment; filename=export.npy"
+        response.headers["Content-type"] = "application/octet-stream"
+
+        return response
+
     def request_embedding(self, output_type):
         """Request embedding."""
         self.logger.info(f"Got query for embedding on /v1/embed/{output_type}")
@@ -226,3 +658,35 @@ class EmbeddingServer(Flask):
         for key in required_keys:
             if key not in json_request:
                 raise InvalidUsage(f"Request must contain the key '{key}'")
+
+    def request_embedding_batch(self, output_type):
+        """Request the embeddings of multiple texts."""
+        self.logger.info(f"Got query for embeddings on /v1/embed_batch/{output_type}")
+
+        if output_type.lower() not in self.batch_output_fn:
+            raise InvalidUsage(f"Output type not recognized: {output_type}")
+        else:
+            output_fn = self.batch_output_fn[output_type.lower()]
+
+        if request.is_json:
+            json_request = request.get_json()
+            for key in ("model", "texts"):
+                if key not in json_request:
+                    raise InvalidUsage(f"Request must contain the key '{key}'")
+            model = json_request["model"]
+            texts = json_request["texts"]
+            if (
+                not isinstance(texts, list)
+                or not texts
+                or not all(isinstance(text, str) for text in texts)
+            ):
+                raise InvalidUsage("The texts must be a non-empty list of strings")
+            self.logger.info("Embedding query parameters:")
+            self.logger.info(f"model: {model}")
+            self.logger.info(f"number of texts: {len(texts)}")
+            self.logger.info("Calling embed_texts...")
+            embeddings = self.embed_texts(model, texts)
+            self.logger.info("Embeddings computed successfully.")
+            return output_fn(embeddings)
+        else:
+            raise InvalidUsage("Expected a JSON file")
@@ -18,17 +18,34 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import io
+import itertools
+import json
+import time
 from typing import Any, Dict, Iterable, Tuple
 
 import pandas as pd
 import spacy
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 
 import bluesearch
 from bluesearch.mining.pipeline import SPECS, run_pipeline
-from bluesearch.sql import retrieve_articles, retrieve_mining_cache, retrieve_paragraph
+from bluesearch.sql import (
+    discard_connections,
+    get_mining_cache_columns,
+    get_pool_stats,
+    iter_articles,
+    iter_mining_cache,
+    retrieve_mining_cache,
+    retrieve_paragraph,
+)
 from bluesearch.utils import load_spacy_model
 
+WARMUP_TEXT = (
+    "Glucose is a risk factor for COVID-19. The virus binds to the ACE2 "
+    "receptor of the host cells and hydroxychloroquine did not reduce the "
+    "mortality of the hospitalized patients."
+)
+
 
 class MiningServer(Flask):
     """The BBS mining server.
@@ -66,15 +83,60 @@ class MiningServer(Flask):
             self.ee_models[entity_type] = load_spacy_model(model_path)
 
         self.connection = connection
+        self.streaming_output_fn = {
+            "csv": self.stream_csv,
+            "ndjson": self.stream_ndjson,
+        }
 
         self.add_url_rule("/text", view_func=self.pipeline_text, methods=["POST"])
         self.add_url_rule(
             "/database", view_func=self.pipeline_database, methods=["POST"]
         )
         self.add_url_rule("/help", view_func=self.help, methods=["POST"])
+        self.add_url_rule("/stats", view_func=self.stats, methods=["POST"])
 
         self.logger.info("Initialization done.")
 
+    def after_fork(self):
+        """Prepare the server for a worker process forked after its creation.
+
+        The connections to the database inherited from the parent process are
+        discarded, the worker opens its own.
+        """
+        discard_connections(self.connection)
+
+    def warmup(self, text=WARMUP_TEXT):
+        """Warm up the NER models with a representative text.
+
+        The first calls of a spaCy model are slow because of the lazy
+        initialization of its components. Running them once at startup
+        makes the latency of the first requests predictable.
+
+        Parameters
+        ----------
+        text : str
+            The raw text.
+
+        Returns
+        -------
+        dict
+            The keys are the entity types and the values are the durations
+            of the warmup of their model in seconds.
+        """
+        timings = {}
+        for entity_type, ee_model in self.ee_models.items():
+            start = time.perf_counter()
+            run_pipeline(
+                texts=[(text, {})], model_entities=ee_model, models_relations={}
+            )
+            timings[entity_type] = time.perf_counter() - start
+            self.logger.info(
+                f"Warmed up the model of {entity_type} in "
+                f"{timings[entity_type]:.1f} seconds"
+            )
+
+        return timings
+
     def help(self):
         """Respond to the help."""
         self.logger.info("Help called")
@@ -89,11 +151,18 @@ class MiningServer(Flask):
                     "description": "Get this help.",
                     "response_content_type": "application/json",
                 },
+                "/stats": {
+                    "description": "Get the database connection pool statistics.",
+                    "response_content_type": "application/json",
+                },
                 "/text": {
                     "description": "Mine a given text according to a given schema.",
                     "response_content_type": "application/json",
                     "required_fields": {"text": [], "schema": []},
-                    "accepted_fields": {"debug": [True, False]},
+                    "accepted_fields": {
+                        "debug": [True, False],
+                        "format": ["json", "csv", "ndjson"],
+                    },
                 },
                 "/database": {
                     "description": "The BBS text mining server." "schema.",
@@ -107,6 +176,7 @@ class MiningServer(Flask):
                     "accepted_fields": {
                         "debug": [True, False],
                         "use_cache": [True, False],
+                        "format": ["json", "csv", "ndjson"],
                     },
                 },
             },
@@ -115,6 +185,18 @@ class MiningServer(Flask):
 
         return jsonify(response)
 
+    def stats(self):
+        """Send the statistics of the database connection pool."""
+        self.logger.info("Stats called")
+
+        response = {
+            "name": self.server_name,
+            "version": self.version,
+            "database_pool": get_pool_stats(self.connection),
+        }
+
+        return jsonify(response)
+
     def get_available_etypes(self, schema_df):
         """Find entity extraction model for entity types.
 
@@ -148,16 +230,20 @@ class MiningServer(Flask):
             schema_str = json_request.get("schema")
             debug = json_request.get("debug", False)
             use_cache = json_request.get("use_cache", True)
+            output_format = json_request.get("format", "json")
 
             self.logger.info("Mining parameters:")
             self.logger.info(f"identifiers : {identifiers}")
             self.logger.info(f"schema      : {schema_str}")
             self.logger.info(f"debug       : {debug}")
             self.logger.info(f"use_cache   : {use_cache}")
+            self.logger.info(f"format      : {output_format}")
             self.logger.info("Mining starting...")
 
-            args_err_response = self.check_args_not_null(
-                identifiers=identifiers, schema=schema_str
+            args_err_response = (
+                self.check_args_not_null(identifiers=identifiers, schema=schema_str)
+                or self.check_identifiers(identifiers)
+                or self.check_format(output_format)
             )
             if args_err_response:
                 return args_err_response
@@ -166,6 +252,23 @@ class MiningServer(Flask):
             self.logger.debug("schema_df:")
             self.logger.debug(str(schema_df))
 
+            if output_format != "json":
+                _, etypes_na = self.get_available_etypes(schema_df)
+                if debug and use_cache:
+                    columns = get_mining_cache_columns(self.connection)
+                    # The ontology source is added from the schema
+                    if "ontology_source" not in columns:
+                        columns.append("ontology_source")
+                else:
+                    # Without relation models, the debug columns are in SPECS
+                    columns = SPECS
+                df_chunks = self.iter_extractions(
+                    identifiers, schema_df, debug, use_cache
+                )
+                return self.create_streaming_response(
+                    df_chunks, etypes_na, output_format, columns
+                )
+
             if use_cache:
                 self.logger.info("Using cache")
                 # determine which models are necessary
@@ -189,32 +292,10 @@ class MiningServer(Flask):
                     self.logger.debug(f"applied column specs, df_all =\n{str(df_all)}")
             else:
                 self.logger.info("Not using the cache")
-                all_article_ids = []
-                all_paragraphs = pd.DataFrame()
-                for (article_id, paragraph_pos) in identifiers:
-                    if paragraph_pos == -1:
-                        all_article_ids += [article_id]
-                    else:
-                        paragraph = retrieve_paragraph(
-                            article_id, paragraph_pos, engine=self.connection
-                        )
-                        all_paragraphs = all_paragraphs.append(paragraph)
-
-                if all_article_ids:
-                    articles = retrieve_articles(
-                        article_ids=all_article_ids, engine=self.connection
-                    )
-                    all_paragraphs = all_paragraphs.append(articles)
-
                 texts = [
-                    (
-                        row["text"],
-                        {
-                            "paper_id": f'{row["article_id"]}:{row["section_name"]}'
-                            f':{row["paragraph_pos_in_article"]}'
-                        },
-                    )
-                    for _, row in all_paragraphs.iterrows()
+                    text
+                    for paragraphs in self.iter_paragraphs(identifiers)
+                    for text in self.get_texts(paragraphs)
                 ]
 
                 df_all, etypes_na = self.mine_texts(
@@ -240,13 +321,17 @@ class MiningServer(Flask):
             text = json_request.get("text")
             schema_str = json_request.get("schema")
             debug = json_request.get("debug", False)
+            output_format = json_request.get("format", "json")
 
             self.logger.info("Mining parameters:")
             self.logger.info(f"text        : {text}")
             self.logger.info(f"schema      : {schema_str}")
             self.logger.info(f"debug       : {debug}")
+            self.logger.info(f"format      : {output_format}")
 
-            args_err_response = self.check_args_not_null(text=text, schema=schema_str)
+            args_err_response = self.check_args_not_null(
+                text=text, schema=schema_str
+            ) or self.check_format(output_format)
             if args_err_response:
                 return args_err_response
 
@@ -256,7 +341,12 @@ class MiningServer(Flask):
             df_all, etypes_na = self.mine_texts(
                 texts=texts, schema_df=schema_df, debug=debug
             )
-            response = self.create_response(df_all, etypes_na)
+            if output_format == "json":
+                response = self.create_response(df_all, etypes_na)
+            else:
+                response = self.create_streaming_response(
+                    [df_all], etypes_na, output_format, list(df_all.columns)
+                )
         else:
             self.logger.info("Request is not JSON. Not processing.")
             response = self.create_error_response(
@@ -265,6 +355,99 @@ class MiningServer(Flask):
 
         return response
 
+    def iter_paragraphs(self, identifiers):
+        """Iterate over the paragraphs of the database to mine.
+
+        Parameters
+        ----------
+        identifiers : list of tuple
+            Tuples of form (article_id, paragraph_pos_in_article). If
+            `paragraph_pos_in_article` is -1 then all the paragraphs of the
+            article are considered.
+
+        Yields
+        ------
+        paragraphs : pd.DataFrame
+            First, the single paragraphs, then the articles one by one. The
+            articles are streamed so that only their paragraph texts are kept
+            in memory.
+        """
+        all_article_ids = []
+        all_paragraphs = pd.DataFrame()
+        for (article_id, paragraph_pos) in identifiers:
+            if paragraph_pos == -1:
+                all_article_ids += [article_id]
+            else:
+                paragraph = retrieve_paragraph(
+                    article_id, paragraph_pos, engine=self.connection
+                )
+                all_paragraphs = all_paragraphs.append(paragraph)
+
+        yield all_paragraphs
+        yield from iter_articles(article_ids=all_article_ids, engine=self.connection)
+
+    @staticmethod
+    def get_texts(paragraphs):
+        """Get the texts to mine of paragraphs, with their paper ids."""
+        return [
+            (
+                row["text"],
+                {
+                    "paper_id": f'{row["article_id"]}:{row["section_name"]}'
+                    f':{row["paragraph_pos_in_article"]}'
+                },
+            )
+            for _, row in paragraphs.iterrows()
+        ]
+
+    def iter_extractions(self, identifiers, schema_df, debug, use_cache):
+        """Iterate over the extractions of paragraphs of the database.
+
+        Parameters
+        ----------
+        identifiers : list of tuple
+            Tuples of form (article_id, paragraph_pos_in_article). If
+            `paragraph_pos_in_article` is -1 then all the paragraphs of the
+            article are considered.
+        schema_df : pd.DataFrame
+            The schema of the extractions.
+        debug : bool
+            If True, the columns are not necessarily matching `SPECS`.
+        use_cache : bool
+            If True, the extractions are read from the mining cache chunk by
+            chunk. Otherwise, the paragraphs are mined article by article.
+
+        Yields
+        ------
+        df_extractions : pd.DataFrame
+            The extractions of one chunk. Within a chunk, the extractions are
+            sorted by paragraph and by position in the paragraph.
+        """
+        etypes, _ = self.get_available_etypes(schema_df)
+        if not etypes:
+            self.logger.info("No requested entity type has a model, nothing to mine.")
+            return
+
+        n_extractions = 0
+        if use_cache:
+            for df_chunk in iter_mining_cache(identifiers, etypes, self.connection):
+                df_chunk = self.add_ontology_column(df_chunk, schema_df)
+                if not debug:
+                    df_chunk = pd.DataFrame(df_chunk, columns=SPECS)
+                n_extractions += len(df_chunk)
+                yield df_chunk
+        else:
+            for paragraphs in self.iter_paragraphs(identifiers):
+                texts = self.get_texts(paragraphs)
+                if texts:
+                    df_chunk, _ = self.mine_texts(
+                        texts=texts, schema_df=schema_df, debug=debug
+                    )
+                    n_extractions += len(df_chunk)
+                    yield df_chunk
+
+        self.logger.info(f"Mining completed, streamed {n_extractions} elements.")
+
     def mine_texts(self, texts, schema_df, debug):
         """Run mining pipeline on a given list of texts."""
         self.logger.info("Running the mining pipeline...")
@@ -286,6 +469,36 @@ class MiningServer(Flask):
             etypes_na,
         )
 
+    def check_format(self, output_format):
+        """Check that the output format is supported.
+
+        Returns a response with the error if it is not, and False otherwise.
+        """
+        if output_format != "json" and output_format not in self.streaming_output_fn:
+            self.logger.info(f'The format "{output_format}" is not supported.')
+            return self.create_error_response(
+                f'The format "{output_format}" is not supported.'
+            )
+        return False
+
+    def check_identifiers(self, identifiers):
+        """Check that the identifiers are pairs of integers.
+
+        Returns a response with the error if they are not, and False otherwise.
+        """
+        if not isinstance(identifiers, list) or not all(
+            isinstance(identifier, list)
+            and len(identifier) == 2
+            and all(isinstance(n, int) for n in identifier)
+            for identifier in identifiers
+        ):
+            self.logger.info("The identifiers are not valid. Stopping.")
+            return self.create_error_response(
+                'The request "identifiers" has to be a list of '
+                "[article_id, paragraph_pos_in_article] pairs."
+            )
+        return False
+
     def check_args_not_null(self, **kwargs):
         """Sanity check that arguments provided are not null.
 
@@ -358,3 +571,101 @@ class MiningServer(Flask):
         ]
 
         return jsonify(csv_extractions=csv_extractions, warnings=warnings), 200
+
+    @staticmethod
+    def stream_csv(df_chunks, columns=SPECS):
+        """Convert chunks of extractions into a CSV table, chunk by chunk.
+
+        Parameters
+        ----------
+        df_chunks : Iterable[pd.DataFrame]
+            Chunks of the extractions.
+        columns : list of str
+            The columns of the table. The columns of the chunks which are not
+            in it are dropped and the missing ones are left empty, so that
+            all the rows are aligned with the header.
+
+        Yields
+        ------
+        str
+            The header and the rows of the chunks. If there are no chunks,
+            only the header.
+        """
+        header = True
+        for df_chunk in df_chunks:
+            yield df_chunk.reindex(columns=columns).to_csv(index=False, header=header)
+            header = False
+
+        if header:
+            yield pd.DataFrame(columns=columns).to_csv(index=False)
+
+    @staticmethod
+    def stream_ndjson(df_chunks, columns=SPECS):
+        """Convert chunks of extractions into JSON objects, one per line.
+
+        Parameters
+        ----------
+        df_chunks : Iterable[pd.DataFrame]
+            Chunks of the extractions.
+        columns : list of str
+            The keys of the JSON objects, as the columns of `stream_csv`.
+
+        Yields
+        ------
+        str
+            The rows of the chunks, each one as a JSON object followed by a
+            newline.
+        """
+        for df_chunk in df_chunks:
+            if len(df_chunk) > 0:
+                df_chunk = df_chunk.reindex(columns=columns)
+                lines = df_chunk.to_json(orient="records", lines=True)
+                yield lines.rstrip("\n") + "\n"
+
+    def create_streaming_response(
+        self, df_chunks, etypes_na, output_format, columns=SPECS
+    ):
+        """Create a response streaming the extractions as they are produced.
+
+        The whole result never needs to be held in memory and the first
+        extractions are sent before the last ones are retrieved or mined.
+        The first chunk is produced before the status is sent, so that an
+        error in the request, e.g. in the database query, gives an error
+        response. Later errors truncate the response.
+
+        Parameters
+        ----------
+        df_chunks : Iterable[pd.DataFrame]
+            Chunks of the extractions. They are only produced while the
+            response is sent.
+        etypes_na : Iterable[str]
+            Entity types found in the request CSV file for which no available
+            model was found in the library.
+        output_format : str, {"csv", "ndjson"}
+            The format of the response.
+        columns : list of str
+            The columns of the extractions. They are the same in all the
+            chunks, see `stream_csv`.
+
+        Returns
+        -------
+        response : flask.Response
+            Response with the extractions in a CSV table or with one JSON
+            object per extraction and per line. The warnings are in the
+            "Mining-Warnings" header, as a JSON list.
+        """
+        warnings = [
+            f'No text mining model was found in the library for "{etype}".'
+            for etype in etypes_na
+        ]
+        mimetypes = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+        df_chunks = iter(df_chunks)
+        first_chunks = list(itertools.islice(df_chunks, 1))
+
+        return Response(
+            self.streaming_output_fn[output_format](
+                itertools.chain(first_chunks, df_chunks), columns
+            ),
+            mimetype=mimetypes[output_format],
+            headers={"Mining-Warnings": json.dumps(warnings)},
+        )
@@ -18,15 +18,24 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import pathlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from flask import Flask, jsonify, request
 
 import bluesearch
+from bluesearch.embedding_cache import CachedEmbeddingModel
 from bluesearch.embedding_models import EmbeddingModel, get_embedding_model
 from bluesearch.search import SearchEngine
+from bluesearch.sql import discard_connections, get_pool_stats
 from bluesearch.utils import H5
 
+WARMUP_QUERIES = (
+    "Glucose is a risk factor for COVID-19.",
+    "Which drugs reduce the mortality of the hospitalized patients?",
+)
+
 
 class SearchServer(Flask):
     """The BBS search server.
@@ -43,6 +52,12 @@ class SearchServer(Flask):
         1D array containing sentence_ids to be considered for precomputed embeddings.
     models : list_like
         A list of model names of the embedding models to load.
+    normalization_chunk_size : int
+        Number of rows of the precomputed embeddings normalized at a time.
+        It bounds the size of the temporary buffers of the normalization.
+    embedding_cache : bluesearch.embedding_cache.EmbeddingCache or None
+        If not None, the embeddings of the queries are looked up in this
+        persistent cache before being computed, see `CachedEmbeddingModel`.
     """
 
     def __init__(
@@ -52,6 +67,8 @@ class SearchServer(Flask):
         indices,
         connection,
         models,
+        normalization_chunk_size=100_000,
+        embedding_cache=None,
     ):
         package_name, *_ = __name__.partition(".")
         super().__init__(import_name=package_name)
@@ -76,25 +93,31 @@ class SearchServer(Flask):
         self.embedding_models = {
             model_name: self._get_model(model_name) for model_name in models
         }
+        if embedding_cache is not None:
+            self.logger.info(f"Caching the query embeddings in {embedding_cache.path}")
+            self.embedding_models = {
+                model_name: CachedEmbeddingModel(model, embedding_cache, model_name)
+                for model_name, model in self.embedding_models.items()
+            }
 
         self.logger.info("Loading precomputed embeddings...")
-        # here we're assuming that all embeddings (up to the 0th row)
-        # are correctly populated, note the `[1:]` slice.
+        # The datasets are loaded and normalized concurrently. The reads of
+        # h5py are serialized, but they overlap with the conversion and the
+        # normalization of the other datasets.
+        self.normalization_chunk_size = normalization_chunk_size
+        with ThreadPoolExecutor(max_workers=max(len(self.models), 1)) as executor:
+            results = dict(
+                zip(
+                    self.embedding_models,
+                    executor.map(self._load_embeddings, self.embedding_models),
+                )
+            )
         self.precomputed_embeddings = {
-            model_name: H5.load(
-                self.embeddings_h5_path,
-                model_name,
-            )[1:]
-            for model_name in self.embedding_models
+            model_name: embeddings for model_name, (embeddings, _) in results.items()
+        }
+        self.loading_times = {
+            model_name: timings for model_name, (_, timings) in results.items()
         }
-
-        self.logger.info("Normalizing precomputed embeddings...")
-        for model_name, embeddings in self.precomputed_embeddings.items():
-            embeddings_t = torch.from_numpy(embeddings)
-            norm = torch.norm(input=embeddings_t, dim=1, keepdim=True)
-            norm[norm == 0] = 1
-            embeddings_t /= norm
-            self.precomputed_embeddings[model_name] = embeddings_t
 
         self.logger.info("Constructing the search engine...")
         self.search_engine = SearchEngine(
@@ -105,10 +128,98 @@ class SearchServer(Flask):
         )
 
         self.add_url_rule("/help", view_func=self.help, methods=["POST"])
+        self.add_url_rule("/stats", view_func=self.stats, methods=["POST"])
         self.add_url_rule("/", view_func=self.query, methods=["POST"])
 
         self.logger.info("Initialization done.")
 
+    def after_fork(self):
+        """Prepare the server for a worker process forked after its creation.
+
+        The connections to the database and to the embedding caches inherited
+        from the parent process are discarded, the worker opens its own.
+        """
+        discard_connections(self.connection)
+        for model in self.embedding_models.values():
+            if isinstance(model, CachedEmbeddingModel):
+                discard_connections(model.cache.engine)
+
+    def warmup(self, queries=WARMUP_QUERIES):
+        """Warm up the search with representative queries.
+
+        The embedding models are warmed up, see `EmbeddingModel.warmup`, and
+        the queries are run by the search engine. This initializes the
+        kernels computing the similarities and the database connections.
+
+        Parameters
+        ----------
+        queries : sequence of str
+            The raw queries.
+
+        Returns
+        -------
+        dict
+            The keys are the model names and the values are the durations
+            of their warmup in seconds.
+        """
+        timings = {}
+        for model_name, model in self.embedding_models.items():
+            start = time.perf_counter()
+            model.warmup(queries)
+            for query in queries:
+                self.search_engine.query(
+                    which_model=model_name, k=10, query_text=query, verbose=False
+                )
+            timings[model_name] = time.perf_counter() - start
+            self.logger.info(
+                f"Warmed up the model {model_name} in {timings[model_name]:.1f} seconds"
+            )
+
+        return timings
+
+    def _load_embeddings(self, model_name):
+        """Load and normalize the precomputed embeddings of a model.
+
+        Parameters
+        ----------
+        model_name : str
+            The name of the model, which is also the name of the dataset.
+
+        Returns
+        -------
+        embeddings : torch.Tensor
+            The normalized embeddings, without the 0th row.
+        timings : dict
+            The seconds spent on loading and on normalizing the embeddings.
+        """
+        start = time.perf_counter()
+        # here we're assuming that all embeddings (up to the 0th row)
+        # are correctly populated, note the `[1:]` slice. Embeddings stored
+        # with a lower precision are upcast to float32 while being read.
+        embeddings = H5.load(self.embeddings_h5_path, model_name, dtype="f4")
+        # A view, the rows are not copied
+        embeddings = torch.from_numpy(embeddings)[1:]
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for chunk in torch.split(embeddings, self.normalization_chunk_size):
+            norm = torch.norm(input=chunk, dim=1, keepdim=True)
+            norm[norm == 0] = 1
+            chunk /= norm
+        normalize_time = time.perf_counter() - start
+
+        self.logger.info(
+            f"Loaded {model_name} embeddings of shape {tuple(embeddings.shape)} "
+            f"in {load_time:.1f} seconds, normalized them in "
+            f"{normalize_time:.1f} seconds"
+        )
+        timings = {
+            "load_seconds": round(load_time, 3),
+            "normalize_seconds": round(normalize_time, 3),
+        }
+
+        return embeddings, timings
+
     def _get_model(self, model_name: str) -> EmbeddingModel:
         """Construct an embedding model from its name.
 
@@ -151,12 +262,17 @@ class SearchServer(Flask):
             "version": self.version,
             "database": self.connection.url.database,
             "supported_models": self.models,
+            "loading_times": self.loading_times,
             "description": "Run the BBS text search for a given sentence.",
             "POST": {
                 "/help": {
                     "description": "Get this help.",
                     "response_content_type": "application/json",
                 },
+                "/stats": {
+                    "description": "Get the database connection pool statistics.",
+                    "response_content_type": "application/json",
+                },
                 "/": {
                     "description": "Compute search through database"
                     "and give back most similar sentences to the query.",
@@ -187,6 +303,18 @@ class SearchServer(Flask):
 
         return jsonify(response)
 
+    def stats(self):
+        """Send the statistics of the database connection pool."""
+        self.logger.info("Stats called")
+
+        response = {
+            "name": self.server_name,
+            "version": self.version,
+            "database_pool": get_pool_stats(self.connection),
+        }
+
+        return jsonify(response)
+
     def query(self):
         """Respond to a query.
 
@@ -20,6 +20,7 @@
 from __future__ import annotations
 
 import json
+import os
 import pathlib
 import re
 import time
@@ -28,6 +29,7 @@ from typing import Any, Dict, List, Set, Union
 
 import h5py
 import numpy as np
+import scipy.sparse
 import spacy
 
 
@@ -198,6 +200,36 @@ class Timer:
 class H5:
     """H5 utilities."""
 
+    @staticmethod
+    def _layout_kwargs(chunks, compression, compression_opts, shuffle):
+        """Get the keyword arguments of `create_dataset` for a storage layout.
+
+        See `create` for the description of the parameters.
+        """
+        if compression == "blosc":
+            try:
+                import hdf5plugin
+            except ImportError as err:
+                raise ModuleNotFoundError(
+                    "The blosc compression requires hdf5plugin, please install "
+                    "it using    $ pip install hdf5plugin"
+                ) from err
+
+            layout = dict(hdf5plugin.Blosc(**(compression_opts or {})))
+        elif compression is not None:
+            layout = {"compression": compression}
+            if compression_opts is not None:
+                layout["compression_opts"] = compression_opts
+        else:
+            layout = {}
+
+        if chunks is not None:
+            layout["chunks"] = chunks
+        if shuffle:
+            layout["shuffle"] = True
+
+        return layout
+
     @staticmethod
     def clear(h5_path, dataset_name, indices):
         """Set selected rows to the fillvalue.
@@ -218,9 +250,19 @@ class H5:
 
             h5_dset[np.sort(indices)] = np.ones((len(indices), dim)) * fillvalue
 
+            populated_name = H5.populated_name(dataset_name)
+            if populated_name in f:
+                f[populated_name][np.sort(indices)] = not np.isnan(fillvalue)
+
     @staticmethod
     def concatenate(
-        h5_path_output, dataset_name, h5_paths_temp, delete_inputs=True, batch_size=2000
+        h5_path_output,
+        dataset_name,
+        h5_paths_temp,
+        delete_inputs=True,
+        batch_size=2000,
+        append=False,
+        dtype=None,
     ):
         """Concatenate multiple h5 files into one h5 file.
 
@@ -239,6 +281,14 @@ class H5:
             If True, then all input h5 files are deleted once the concatenation is done.
         batch_size : int
             Batch size to be used for transfers from the input h5 to the final one.
+        append : bool
+            If True and the dataset already exists in `h5_path_output`, then the
+            rows of the input files are written into it. Otherwise, the dataset
+            is created.
+        dtype : None or str
+            The dtype of the created dataset. If None, then it is the dtype of
+            the first input file. When appending, the rows are converted to the
+            dtype of the existing dataset.
         """
         if not h5_paths_temp:
             raise ValueError("No temporary h5 files provided.")
@@ -249,6 +299,8 @@ class H5:
             with h5py.File(path_temp, "r") as f:
                 current_indices_set: Set[int] = set(f[f"{dataset_name}_indices"][:, 0])
                 current_dim = f[f"{dataset_name}"].shape[1]
+                if dtype is None:
+                    dtype = f[f"{dataset_name}"].dtype
 
                 if dim is None:
                     dim = current_dim
@@ -267,7 +319,23 @@ class H5:
                 all_indices |= current_indices_set
 
         final_length = max(all_indices) + 1
-        H5.create(h5_path_output, dataset_name, shape=(final_length, dim))
+        existing_shape = None
+        if append and h5_path_output.is_file():
+            with h5py.File(h5_path_output, "r") as f:
+                if dataset_name in f:
+                    existing_shape = f[dataset_name].shape
+
+        if existing_shape is None:
+            H5.create(
+                h5_path_output, dataset_name, shape=(final_length, dim), dtype=dtype
+            )
+        elif existing_shape[0] < final_length and existing_shape[1] == dim:
+            H5.resize(h5_path_output, dataset_name, final_length)
+        elif existing_shape[1] != dim:
+            raise ValueError(
+                f"The existing dataset of shape {existing_shape} cannot hold rows "
+                f"up to {final_length - 1} of dimension {dim}"
+            )
 
         for path_temp in h5_paths_temp:
             with h5py.File(path_temp, "r") as f:
@@ -292,7 +360,156 @@ class H5:
                 path_temp.unlink()
 
     @staticmethod
-    def create(h5_path, dataset_name, shape, dtype="f4"):
+    def concatenate_sparse(
+        h5_path_output, dataset_name, h5_paths_temp, delete_inputs=True
+    ):
+        """Concatenate multiple h5 files with sparse embeddings into one h5 file.
+
+        The rows of the output sparse dataset are the sentence ids. The rows
+        of sentences that are not in any input file are empty.
+
+        Parameters
+        ----------
+        h5_path_output : pathlib.Path
+            Path to the h5 file. Note that this file can already exist and contain other
+            datasets.
+        dataset_name : str
+            Name of the dataset.
+        h5_paths_temp : list
+            Paths to the input h5 files. Note that each of them will have 2 datasets.
+                - `{dataset_name}` - sparse dataset of shape (length, dim), see
+                  `write_sparse`
+                - `{dataset_name}_indices` - dtype = int and shape (length, 1)
+        delete_inputs : bool
+            If True, then all input h5 files are deleted once the concatenation is done.
+        """
+        if not h5_paths_temp:
+            raise ValueError("No temporary h5 files provided.")
+
+        matrices: List[scipy.sparse.csr_matrix] = []
+        all_indices = []
+        for path_temp in h5_paths_temp:
+            matrix = H5.load_sparse(path_temp, dataset_name)
+            if matrices and matrix.shape[1] != matrices[0].shape[1]:
+                raise ValueError(f"The dimension of {path_temp} is inconsistent")
+
+            with h5py.File(path_temp, "r") as f:
+                all_indices.append(f[f"{dataset_name}_indices"][:, 0])
+            matrices.append(matrix)
+
+        indices = np.concatenate(all_indices)
+        unique_indices, counts = np.unique(indices, return_counts=True)
+        if np.any(counts > 1):
+            inters = set(unique_indices[counts > 1])
+            raise ValueError(f"The input files have overlapping indices: {inters}")
+
+        # Move the row i of the stacked matrices to the row indices[i]
+        n_rows = len(indices)
+        permutation = scipy.sparse.csr_matrix(
+            (np.ones(n_rows, dtype=np.int8), (indices, np.arange(n_rows))),
+            shape=(indices.max() + 1, n_rows),
+        )
+        final_matrix = permutation @ scipy.sparse.vstack(matrices, format="csr")
+
+        H5.write_sparse(h5_path_output, dataset_name, final_matrix)
+
+        if delete_inputs:
+            for path_temp in h5_paths_temp:
+                path_temp.unlink()
+
+    @staticmethod
+    def concatenate_virtual(h5_path_output, dataset_name, h5_paths_temp):
+        """Concatenate multiple h5 files into a virtual dataset.
+
+        Contrary to `concatenate`, no data is copied. The output dataset is an
+        HDF5 virtual dataset mapping each of its rows to a row of one of the
+        input files. Therefore, the input files must be kept next to the
+        output file.
+
+        Parameters
+        ----------
+        h5_path_output : pathlib.Path
+            Path to the h5 file. Note that this file can already exist and contain other
+            datasets.
+        dataset_name : str
+            Name of the dataset.
+        h5_paths_temp : list
+            Paths to the input h5 files. Note that each of them will have 2 datasets.
+                - `{dataset_name}` - dtype = float and shape (length, dim)
+                - `{dataset_name}_indices` - dtype = int and shape (length, 1)
+
+        References
+        ----------
+        [1] https://docs.h5py.org/en/stable/vds.html
+        """
+        if not h5_paths_temp:
+            raise ValueError("No temporary h5 files provided.")
+
+        mappings = []
+        all_indices: Set[int] = set()
+        dim = None
+        dtype = None
+        for path_temp in h5_paths_temp:
+            with h5py.File(path_temp, "r") as f:
+                current_indices = f[f"{dataset_name}_indices"][:, 0]
+                current_shape = f[dataset_name].shape
+                current_dtype = f[dataset_name].dtype
+
+            if dim is None:
+                dim, dtype = current_shape[1], current_dtype
+            elif current_shape[1] != dim:
+                raise ValueError(f"The dimension of {path_temp} is inconsistent")
+
+            current_indices_set: Set[int] = set(current_indices)
+            if all_indices & current_indices_set:
+                inters = all_indices & current_indices_set
+                raise ValueError(
+                    f"{path_temp} introduces an overlapping index: {inters}"
+                )
+            all_indices |= current_indices_set
+
+            # One mapping per run of consecutive indices
+            source = h5py.VirtualSource(
+                os.path.relpath(path_temp, h5_path_output.parent),
+                dataset_name,
+                shape=current_shape,
+            )
+            run_starts = np.flatnonzero(np.diff(current_indices) != 1) + 1
+            run_bounds = zip(
+                np.concatenate([[0], run_starts]),
+                np.concatenate([run_starts, [len(current_indices)]]),
+            )
+            for start, end in run_bounds:
+                first_index = current_indices[start]
+                mappings.append(
+                    (first_index, first_index + end - start, source[start:end])
+                )
+
+        layout = h5py.VirtualLayout(shape=(max(all_indices) + 1, dim), dtype=dtype)
+        for first_index, last_index, source_rows in mappings:
+            layout[first_index:last_index] = source_rows
+
+        populated = np.zeros(max(all_indices) + 1, dtype=bool)
+        populated[list(all_indices)] = True
+
+        with h5py.File(h5_path_output, "a") as f:
+            if dataset_name in f.keys():
+                raise ValueError("The {} dataset already exists.".format(dataset_name))
+            f.create_virtual_dataset(dataset_name, layout, fillvalue=np.nan)
+            f.create_dataset(H5.populated_name(dataset_name), data=populated)
+
+    @staticmethod
+    def create(
+        h5_path,
+        dataset_name,
+        shape,
+        dtype="f4",
+        chunks=None,
+        compression=None,
+        compression_opts=None,
+        shuffle=False,
+        resizable=False,
+    ):
         """Create a dataset (and potentially also a h5 file).
 
         Parameters
@@ -305,15 +522,37 @@ class H5:
             Two element tuple representing rows and columns.
         dtype : str
             Dtype of the h5 array. See references for all the details.
+        chunks : None, True or tuple of int
+            Shape of the chunks of the dataset. If None, the dataset is
+            contiguous unless `compression` or `resizable` are used. If True,
+            the shape is guessed by h5py.
+        compression : None or str, {"gzip", "lzf", "blosc"}
+            Compression filter of the dataset. The "blosc" filter requires
+            the `hdf5plugin` package.
+        compression_opts : None, int or dict
+            Options of the compression filter, e.g. the level for "gzip" or
+            the keyword arguments of `hdf5plugin.Blosc` for "blosc".
+        shuffle : bool
+            If True, the byte shuffle filter is applied before the
+            compression. This often improves the compression of floats.
+        resizable : bool
+            If True, the number of rows of the dataset can grow later on.
 
         Notes
         -----
-        Unpopulated rows will be filled with `np.nan`.
+        Unpopulated rows will be filled with `np.nan`. For floating point
+        datasets, the populated rows are also tracked in the boolean dataset
+        `H5.populated_name(dataset_name)`, see `find_unpopulated_rows`.
 
         References
         ----------
         [1] http://docs.h5py.org/en/stable/faq.html#faq
+        [2] https://docs.h5py.org/en/stable/high/dataset.html#chunked-storage
         """
+        layout = H5._layout_kwargs(chunks, compression, compression_opts, shuffle)
+        if resizable:
+            layout["maxshape"] = (None, *shape[1:])
+
         if h5_path.is_file():
             with h5py.File(h5_path, "a") as f:
                 if dataset_name in f.keys():
@@ -322,19 +561,61 @@ class H5:
                     )
 
                 f.create_dataset(
-                    dataset_name, shape=shape, dtype=dtype, fillvalue=np.nan
+                    dataset_name, shape=shape, dtype=dtype, fillvalue=np.nan, **layout
                 )
 
         else:
             with h5py.File(h5_path, "w") as f:
                 f.create_dataset(
-                    dataset_name, shape=shape, dtype=dtype, fillvalue=np.nan
+                    dataset_name, shape=shape, dtype=dtype, fillvalue=np.nan, **layout
+                )
+
+        if np.issubdtype(np.dtype(dtype), np.floating):
+            with h5py.File(h5_path, "a") as f:
+                f.create_dataset(
+                    H5.populated_name(dataset_name),
+                    shape=shape[:1],
+                    dtype=bool,
+                    maxshape=(None,) if resizable else None,
                 )
 
+    @staticmethod
+    def create_populated_bitmap(h5_path, dataset_name, batch_size=2000):
+        """Track the populated rows of an existing dataset.
+
+        This is only needed for datasets created before the populated rows
+        were tracked. The dataset is scanned once.
+
+        Parameters
+        ----------
+        h5_path : pathlib.Path
+            Path to the h5 file.
+        dataset_name : str
+            Name of the dataset.
+        batch_size : int
+            Number of rows to be loaded at a time.
+        """
+        n_rows = H5.get_shape(h5_path, dataset_name)[0]
+        unpop_rows = H5.find_unpopulated_rows(
+            h5_path, dataset_name, batch_size=batch_size
+        )
+        populated = np.ones(n_rows, dtype=bool)
+        populated[unpop_rows] = False
+
+        with h5py.File(h5_path, "a") as f:
+            populated_name = H5.populated_name(dataset_name)
+            if populated_name in f:
+                del f[populated_name]
+            f.create_dataset(populated_name, data=populated)
+
     @staticmethod
     def find_unpopulated_rows(h5_path, dataset_name, batch_size=2000, verbose=False):
         """Return the indices of rows that are unpopulated.
 
+        If the dataset has a populated rows bitmap, see `create`, it is used
+        instead of scanning the dataset. All the rows of a sparse dataset, see
+        `write_sparse`, are populated.
+
         Parameters
         ----------
         h5_path : pathlib.Path
@@ -351,10 +632,17 @@ class H5:
         unpop_rows : np.ndarray
             1D numpy array of ints representing row indices of unpopulated rows (nan).
         """
+        if H5.is_sparse(h5_path, dataset_name):
+            return np.array([], dtype=np.int64)
+
         with h5py.File(h5_path, "r") as f:
+            populated_name = H5.populated_name(dataset_name)
+            if populated_name in f:
+                return np.flatnonzero(~f[populated_name][:])
+
             dset = f[dataset_name]
             n_rows = len(dset)
-            unpop_rows = []
+            unpop_rows = [np.array([], dtype=np.int64)]
 
             for i in range(0, n_rows, batch_size):
                 if verbose:
@@ -364,16 +652,19 @@ class H5:
                     )
                 row = dset[i : i + batch_size]
                 is_unpop = np.isnan(row).any(axis=1)  # (batch_size,)
-                unpop_rows.extend(list(np.where(is_unpop)[0] + i))
+                unpop_rows.append(np.flatnonzero(is_unpop) + i)
 
-            print("\rFinding unpopulated rows: 100% done", end="")
+            if verbose:
+                print("\rFinding unpopulated rows: 100% done", end="")
 
-        return np.array(unpop_rows)
+        return np.concatenate(unpop_rows)
 
     @staticmethod
     def find_populated_rows(h5_path, dataset_name, batch_size=2000, verbose=False):
         """Identify rows that are populated (= not nan vectors).
 
+        All the rows of a sparse dataset, see `write_sparse`, are populated.
+
         Parameters
         ----------
         h5_path : pathlib.Path
@@ -391,8 +682,11 @@ class H5:
             1D numpy array of ints representing row indices of populated rows (not nan).
         """
         with h5py.File(h5_path, "r") as f:
-            dset = f[dataset_name]
-            n_rows = len(dset)  # 7
+            populated_name = H5.populated_name(dataset_name)
+            if populated_name in f:
+                return np.flatnonzero(f[populated_name][:])
+
+        n_rows, *_ = H5.get_shape(h5_path, dataset_name)  # 7
 
         unpop_rows = H5.find_unpopulated_rows(
             h5_path, dataset_name, batch_size=batch_size, verbose=verbose
@@ -414,14 +708,49 @@ class H5:
             Name of the dataset.
         """
         with h5py.File(h5_path, "r") as f:
-            shape = f[dataset_name].shape
+            if isinstance(f[dataset_name], h5py.Group):
+                shape = tuple(f[dataset_name].attrs["shape"])
+            else:
+                shape = f[dataset_name].shape
 
         return shape
 
     @staticmethod
-    def load(h5_path, dataset_name, batch_size=500, indices=None, verbose=False):
+    def is_sparse(h5_path, dataset_name):
+        """Check whether a dataset was written with `write_sparse`.
+
+        Parameters
+        ----------
+        h5_path : pathlib.Path
+            Path to the h5 file.
+        dataset_name : str
+            Name of the dataset.
+
+        Returns
+        -------
+        bool
+            True if the dataset holds a sparse matrix.
+        """
+        with h5py.File(h5_path, "r") as f:
+            return isinstance(f[dataset_name], h5py.Group)
+
+    @staticmethod
+    def load(
+        h5_path,
+        dataset_name,
+        batch_size=500,
+        indices=None,
+        verbose=False,
+        max_gap=32,
+        dtype=None,
+    ):
         """Load an h5 file in memory.
 
+        The selected rows are sorted and grouped into runs of close rows.
+        Each run is read as a slice, which is much faster than a point
+        selection, and the rows that were not selected are dropped. Sparse
+        datasets, see `write_sparse`, are loaded with `load_sparse`.
+
         Parameters
         ----------
         h5_path : pathlib.Path
@@ -429,46 +758,235 @@ class H5:
         dataset_name : str
             Name of the dataset.
         batch_size : int
-            Number of rows to be loaded at a time.
+            Maximum number of rows to be loaded at a time.
         indices : None or np.ndarray
             If None then we load all the rows from the dataset. If ``np.ndarray``
             then the loading only selected indices.
         verbose : bool
             Controls verbosity.
+        max_gap : int
+            Maximum number of rows not selected between two selected rows
+            for them to be read in the same slice.
+        dtype : None or str
+            If None then the rows are returned with the dtype of the dataset.
+            Otherwise, they are converted to this dtype while being read, for
+            example to upcast float16 embeddings to float32.
 
         Returns
         -------
-        res : np.ndarray
+        res : np.ndarray or scipy.sparse.csr_matrix
             Numpy array of shape `(len(indices), ...)` holding the loaded rows.
+            Sparse matrix in the CSR format if the dataset is sparse.
         """
-        with h5py.File(h5_path, "r") as f:
+        if H5.is_sparse(h5_path, dataset_name):
+            res = H5.load_sparse(h5_path, dataset_name, indices=indices)
+            return res if dtype is None else res.astype(dtype)
+
+        # The default chunk cache (1 MiB) is smaller than a chunk of a few
+        # hundred embeddings, so compressed chunks would be decompressed again
+        # for every slice reading them.
+        with h5py.File(h5_path, "r", rdcc_nbytes=64 * 1024 * 1024) as f:
             dset = f[dataset_name]
+            if dtype is None:
+                dtype = dset.dtype
+                source = dset
+            else:
+                # HDF5 converts the values while reading them, there is no
+                # copy of the loaded rows in the dtype of the dataset.
+                source = dset.astype(dtype)
 
             if indices is None:
-                return dset[:]
-
-            if len(set(indices)) != len(indices):
-                raise ValueError("There cannot be duplicates inside of the indices")
+                return source[:]
 
+            indices = np.asarray(indices)
             argsort = indices.argsort()  # [3, 1, 0, 2]
-
             sorted_indices = indices[argsort]  # [1, 9, 10, 12]
-            unargsort = np.empty_like(argsort)
-            unargsort[argsort] = np.arange(len(argsort))  # [2, 1, 3, 0]
 
-            final_res_l = []
+            if np.any(sorted_indices[1:] == sorted_indices[:-1]):
+                raise ValueError("There cannot be duplicates inside of the indices")
 
+            # Runs of close rows, with at most `batch_size` selected rows
             n_indices = len(sorted_indices)
+            gaps = np.diff(sorted_indices) - 1  # [7, 0, 1]
+            breaks = np.flatnonzero(gaps > max_gap) + 1  # [1] if max_gap = 1
+            breaks = np.union1d(breaks, np.arange(batch_size, n_indices, batch_size))
+            starts = np.concatenate([[0], breaks]).astype(int)  # [0, 1]
+            ends = np.concatenate([breaks, [n_indices]]).astype(int)  # [1, 4]
+
+            final_res = np.empty((n_indices, *dset.shape[1:]), dtype=dtype)
+            if n_indices == 0:
+                return final_res
 
-            for i in range(0, n_indices, batch_size):
+            for start, end in zip(starts, ends):
                 if verbose:
-                    print(f"\rLoading H5: {round(100*i/n_indices):>3d}% done", end="")
-                subarray = dset[sorted_indices[i : i + batch_size]]  # (batch_size, dim)
-                final_res_l.append(subarray)
+                    print(
+                        f"\rLoading H5: {round(100*start/n_indices):>3d}% done", end=""
+                    )
+                first_row = sorted_indices[start]
+                rows = source[first_row : sorted_indices[end - 1] + 1]
+                final_res[start:end] = rows[sorted_indices[start:end] - first_row]
 
-            final_res = np.concatenate(final_res_l, axis=0)
-            print("\rLoading H5: 100% done", end="")
-            return final_res[unargsort]
+            if verbose:
+                print("\rLoading H5: 100% done", end="")
+
+        unargsort = np.empty_like(argsort)
+        unargsort[argsort] = np.arange(len(argsort))  # [2, 1, 3, 0]
+        return final_res[unargsort]
+
+    @staticmethod
+    def load_sparse(h5_path, dataset_name, indices=None):
+        """Load a sparse dataset in memory.
+
+        Parameters
+        ----------
+        h5_path : pathlib.Path
+            Path to the h5 file.
+        dataset_name : str
+            Name of the dataset.
+        indices : None or np.ndarray
+            If None then we load all the rows from the dataset. If ``np.ndarray``
+            then the loading only selected indices.
+
+        Returns
+        -------
+        res : scipy.sparse.csr_matrix
+            Sparse matrix of shape `(len(indices), dim)` holding the loaded rows.
+        """
+        with h5py.File(h5_path, "r") as f:
+            group = f[dataset_name]
+            matrix = scipy.sparse.csr_matrix(
+                (group["data"][:], group["indices"][:], group["indptr"][:]),
+                shape=tuple(group.attrs["shape"]),
+            )
+
+        if indices is None:
+            return matrix
+
+        return matrix[indices]
+
+    @staticmethod
+    def populated_name(dataset_name):
+        """Get the name of the dataset tracking the populated rows.
+
+        Parameters
+        ----------
+        dataset_name : str
+            Name of the dataset.
+
+        Returns
+        -------
+        str
+            Name of the boolean dataset whose i-th element is True if the
+            i-th row of `dataset_name` is populated.
+        """
+        return f"{dataset_name}_populated"
+
+    @staticmethod
+    def repack(
+        h5_path,
+        h5_path_output,
+        batch_size=2000,
+        chunks=True,
+        compression=None,
+        compression_opts=None,
+        shuffle=False,
+        resizable=False,
+    ):
+        """Rewrite an h5 file with another storage layout.
+
+        The embedding datasets, i.e. the 2D floating point datasets, are
+        created with the given layout, see `create`, and copied row batch by
+        row batch. The other datasets and groups are copied as they are.
+        Virtual datasets are materialized.
+
+        Parameters
+        ----------
+        h5_path : pathlib.Path
+            Path to the input h5 file.
+        h5_path_output : pathlib.Path
+            Path to the output h5 file. It must not exist.
+        batch_size : int
+            Number of rows to be copied at a time.
+        chunks, compression, compression_opts, shuffle, resizable
+            Storage layout of the embedding datasets, see `create`.
+        """
+        if h5_path_output.exists():
+            raise ValueError(f"The output file {h5_path_output} already exists")
+
+        with h5py.File(h5_path, "r") as f_in:
+            embedding_names = [
+                name
+                for name, obj in f_in.items()
+                if isinstance(obj, h5py.Dataset)
+                and obj.ndim == 2
+                and np.issubdtype(obj.dtype, np.floating)
+            ]
+            populated_names = {H5.populated_name(name) for name in embedding_names}
+
+            with h5py.File(h5_path_output, "w") as f_out:
+                for name, obj in f_in.items():
+                    if name not in embedding_names and name not in populated_names:
+                        f_in.copy(obj, f_out)
+
+        for name in embedding_names:
+            shape = H5.get_shape(h5_path, name)
+            with h5py.File(h5_path, "r") as f_in:
+                dtype = f_in[name].dtype
+            H5.create(
+                h5_path_output,
+                name,
+                shape=shape,
+                dtype=dtype,
+                chunks=chunks,
+                compression=compression,
+                compression_opts=compression_opts,
+                shuffle=shuffle,
+                resizable=resizable,
+            )
+
+            with h5py.File(h5_path, "r") as f_in, h5py.File(
+                h5_path_output, "a"
+            ) as f_out:
+                dset_in = f_in[name]
+                dset_out = f_out[name]
+                populated_out = f_out[H5.populated_name(name)]
+                populated_in = f_in.get(H5.populated_name(name))
+
+                for i in range(0, shape[0], batch_size):
+                    rows = dset_in[i : i + batch_size]
+                    dset_out[i : i + batch_size] = rows
+                    if populated_in is None:
+                        populated = ~np.isnan(rows).any(axis=1)
+                    else:
+                        populated = populated_in[i : i + batch_size]
+                    populated_out[i : i + batch_size] = populated
+
+    @staticmethod
+    def resize(h5_path, dataset_name, n_rows):
+        """Change the number of rows of a resizable dataset.
+
+        Parameters
+        ----------
+        h5_path : pathlib.Path
+            Path to the h5 file.
+        dataset_name : str
+            Name of the dataset. It must have been created with
+            `resizable=True`, see `create`.
+        n_rows : int
+            New number of rows. New rows are unpopulated.
+        """
+        with h5py.File(h5_path, "a") as f:
+            dset = f[dataset_name]
+            if dset.maxshape[0] is not None and n_rows > dset.maxshape[0]:
+                raise ValueError(
+                    f"The dataset {dataset_name} of shape {dset.shape} cannot hold "
+                    f"{n_rows} rows, it is not resizable"
+                )
+
+            dset.resize(n_rows, axis=0)
+            populated_name = H5.populated_name(dataset_name)
+            if populated_name in f:
+                f[populated_name].resize((n_rows,))
 
     @staticmethod
     def write(h5_path, dataset_name, data, indices):
@@ -491,6 +1009,41 @@ class H5:
             argsort = indices.argsort()
             h5_dset[indices[argsort]] = data[argsort]
 
+            populated_name = H5.populated_name(dataset_name)
+            if populated_name in f:
+                is_populated = ~np.isnan(data[argsort]).any(axis=1)
+                f[populated_name][indices[argsort]] = is_populated
+
+    @staticmethod
+    def write_sparse(h5_path, dataset_name, matrix):
+        """Write a sparse matrix into an h5 file.
+
+        The matrix is stored in the CSR format as a group holding the
+        `data`, `indices` and `indptr` datasets. Its shape is an attribute
+        of the group.
+
+        Parameters
+        ----------
+        h5_path : pathlib.Path
+            Path to the h5 file. Note that this file can already exist and contain other
+            datasets.
+        dataset_name : str
+            Name of the dataset.
+        matrix : scipy.sparse.spmatrix
+            2D sparse matrix to be written into the h5 file.
+        """
+        matrix = scipy.sparse.csr_matrix(matrix)
+
+        with h5py.File(h5_path, "a") as f:
+            if dataset_name in f.keys():
+                raise ValueError("The {} dataset already exists.".format(dataset_name))
+
+            group = f.create_group(dataset_name)
+            group.attrs["shape"] = matrix.shape
+            group.create_dataset("data", data=matrix.data.astype("f4"))
+            group.create_dataset("indices", data=matrix.indices)
+            group.create_dataset("indptr", data=matrix.indptr)
+
 
 class JSONL:
     """Collection of utility static functions handling `jsonl` files."""
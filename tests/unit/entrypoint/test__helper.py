@@ -1,9 +1,23 @@
 import argparse
+import gc
+import logging
+import multiprocessing as mp
+import socket
+import time
 from typing import Dict, Sequence
+from unittest.mock import Mock
 
+import numpy as np
 import pytest
+import requests
 
-from bluesearch.entrypoint._helper import parse_args_or_environment
+from bluesearch.entrypoint._helper import (
+    configure_threads,
+    parse_args_or_environment,
+    run_prefork_server,
+    run_server,
+)
+from bluesearch.server.embedding_server import EmbeddingServer, ModelRegistry
 
 
 def test_parse_args_or_environment(monkeypatch):
@@ -66,3 +80,143 @@ def test_parse_args_or_environment(monkeypatch):
     with pytest.raises(SystemExit) as pytest_wrapped_e:
         parse_args_or_environment(parser, env_variable_names, argv)
     assert pytest_wrapped_e.value.code == 1
+
+
+def test_configure_threads(monkeypatch):
+    fake_torch = Mock()
+    fake_torch.set_num_interop_threads.side_effect = RuntimeError
+    fake_threadpool_limits = Mock()
+    monkeypatch.setattr("torch.set_num_threads", fake_torch.set_num_threads)
+    monkeypatch.setattr(
+        "torch.set_num_interop_threads", fake_torch.set_num_interop_threads
+    )
+    monkeypatch.setattr("threadpoolctl.threadpool_limits", fake_threadpool_limits)
+
+    configure_threads(0)
+    fake_torch.set_num_threads.assert_not_called()
+    fake_threadpool_limits.assert_not_called()
+
+    configure_threads(2)
+    fake_torch.set_num_threads.assert_called_once_with(2)
+    fake_threadpool_limits.assert_called_once_with(limits=2)
+
+
+def test_run_server(monkeypatch):
+    fake_run_prefork_server = Mock()
+    monkeypatch.setattr(
+        "bluesearch.entrypoint._helper.run_prefork_server", fake_run_prefork_server
+    )
+    app_factory = Mock()
+
+    # Development server
+    run_server(app_factory, "test", ["--port", "1234"])
+    app_factory.return_value.run.assert_called_once_with(
+        host="localhost", port=1234, threaded=True, debug=True
+    )
+    fake_run_prefork_server.assert_not_called()
+
+    # Production server
+    run_server(app_factory, "test", ["--workers", "4", "--threads", "2"])
+    fake_run_prefork_server.assert_called_once_with(
+        app_factory, "localhost", 8080, 4, threads=2, timeout=180
+    )
+
+
+def test_run_prefork_server(monkeypatch):
+    pytest.importorskip("gunicorn")
+    applications = []
+
+    def fake_run(self):
+        applications.append(self)
+
+    monkeypatch.setattr("gunicorn.app.base.BaseApplication.run", fake_run)
+    # The reload clears the handlers of the root logger
+    root_logger = logging.getLogger()
+    monkeypatch.setattr(root_logger, "handlers", list(root_logger.handlers))
+    app_factory = Mock()
+
+    run_prefork_server(app_factory, "0.0.0.0", 1234, 3, timeout=60)
+
+    (application,) = applications
+    assert application.cfg.bind == ["0.0.0.0:1234"]
+    assert application.cfg.workers == 3
+    assert application.cfg.timeout == 60
+    assert application.cfg.preload_app
+
+    # The app is loaded once and frozen
+    try:
+        assert application.wsgi() is app_factory.return_value
+        assert application.wsgi() is app_factory.return_value
+        app_factory.assert_called_once()
+        assert gc.get_freeze_count() > 0
+
+        # The app is loaded again after a reload
+        application.reload()
+        application.wsgi()
+        assert app_factory.call_count == 2
+    finally:
+        gc.unfreeze()
+
+    # The forked workers prepare the app
+    fake_threadpool_limits = Mock()
+    monkeypatch.setattr("threadpoolctl.threadpool_limits", fake_threadpool_limits)
+    application.cfg.post_fork(Mock(), Mock(app=application))
+    fake_threadpool_limits.assert_called_once_with(limits=1)
+    app_factory.return_value.after_fork.assert_called_once_with()
+
+
+def test_run_prefork_server_forked_workers():
+    pytest.importorskip("gunicorn")
+
+    def app_factory():
+        model = Mock()
+        model.preprocess.side_effect = lambda text: text
+        model.embed_many.side_effect = lambda sentences: np.ones((len(sentences), 2))
+        registry = ModelRegistry({"lazy": lambda: model}, idle_timeout=60)
+        models = {"batched": model, "lazy": registry.models["lazy"]}
+        embedding_server_app = EmbeddingServer(
+            models, max_batch_size=8, max_wait_ms=1, model_registry=registry
+        )
+        # The background threads are started in the master process
+        embedding_server_app.embed_text("batched", "hello")
+        embedding_server_app.embed_text("lazy", "hello")
+        return embedding_server_app
+
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+
+    ctx = mp.get_context("fork")
+    process = ctx.Process(
+        target=run_prefork_server,
+        args=(app_factory, "localhost", port, 2),
+        kwargs={"timeout": 10},
+    )
+    process.start()
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                requests.post(f"http://localhost:{port}/help", timeout=5)
+                break
+            except requests.ConnectionError:
+                assert time.monotonic() < deadline, "The server did not start"
+                time.sleep(0.1)
+
+        # The forked workers do not wait for the threads of the master
+        for model_name in ["batched", "lazy", "batched", "lazy"]:
+            response = requests.post(
+                f"http://localhost:{port}/v1/embed/json",
+                json={"model": model_name, "text": "hello"},
+                timeout=5,
+            )
+            assert response.status_code == 200
+            assert response.json() == {"embedding": [1, 1]}
+    finally:
+        # Workers still booting can miss the signal of the master, which then
+        # waits for its graceful timeout of 30 seconds before killing them
+        time.sleep(1)
+        process.terminate()
+        process.join(timeout=60)
+        if process.is_alive():
+            process.kill()
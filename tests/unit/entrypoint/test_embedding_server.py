@@ -20,11 +20,16 @@
 import pathlib
 from unittest.mock import Mock
 
+import pytest
+
+from bluesearch.embedding_cache import CachedEmbeddingModel
+from bluesearch.embedding_models import LazyEmbeddingModel
 from bluesearch.entrypoint.embedding_server import get_embedding_app
-from bluesearch.server.embedding_server import EmbeddingServer
+from bluesearch.server.embedding_server import EmbeddingServer, ModelRegistry
 
 
-def test_environment_reading(monkeypatch, tmpdir):
+@pytest.mark.parametrize("quantize", [0, 1])
+def test_environment_reading(monkeypatch, tmpdir, quantize):
     tmpdir = pathlib.Path(str(tmpdir))
     logfile = tmpdir / "log.txt"
     logfile.touch()
@@ -40,16 +45,77 @@ def test_environment_reading(monkeypatch, tmpdir):
     # Mock all of our embedding models
     embedding_models = ["SentTransformer"]
 
-    for model in embedding_models:
-        monkeypatch.setattr(f"bluesearch.embedding_models.{model}", Mock())
+    fake_models = {model: Mock() for model in embedding_models}
+    fake_models["SentTransformer"].return_value.sparse = False
+    for model, fake_model in fake_models.items():
+        monkeypatch.setattr(f"bluesearch.embedding_models.{model}", fake_model)
 
     monkeypatch.setenv("BBS_EMBEDDING_LOG_FILE", str(logfile))
+    monkeypatch.setenv("BBS_EMBEDDING_QUANTIZE", str(quantize))
+    monkeypatch.setenv("BBS_EMBEDDING_MAX_BATCH_SIZE", "16")
+    monkeypatch.setenv("BBS_EMBEDDING_CACHE_PATH", str(tmpdir / "cache.db"))
+    monkeypatch.setenv("BBS_EMBEDDING_N_THREADS", "2")
+    fake_configure_threads = Mock()
+    monkeypatch.setattr(
+        "bluesearch.entrypoint.embedding_server.configure_threads",
+        fake_configure_threads,
+    )
 
     embedding_app = get_embedding_app()
 
     assert embedding_app is fake_embedding_server_inst
+    fake_configure_threads.assert_called_once_with(2)
+    fake_embedding_server_inst.warmup.assert_called_once()
 
-    args, _ = fake_embedding_server_class.call_args
+    args, kwargs = fake_embedding_server_class.call_args
 
     assert len(args) == 1
     assert isinstance(args[0], dict)
+    assert kwargs == {
+        "max_batch_size": 16,
+        "max_wait_ms": 5.0,
+        "model_registry": None,
+    }
+    for model_name, model in args[0].items():
+        assert isinstance(model, CachedEmbeddingModel)
+        assert model.model_name == model_name
+
+    for call in fake_models["SentTransformer"].call_args_list:
+        assert call.args[2] is bool(quantize)
+
+
+def test_lazy_loading(monkeypatch, tmpdir):
+    fake_embedding_server_class = Mock()
+    monkeypatch.setattr(
+        "bluesearch.server.embedding_server.EmbeddingServer",
+        fake_embedding_server_class,
+    )
+    fake_sent_transformer = Mock()
+    monkeypatch.setattr(
+        "bluesearch.embedding_models.SentTransformer", fake_sent_transformer
+    )
+
+    logfile = pathlib.Path(str(tmpdir)) / "log.txt"
+    monkeypatch.setenv("BBS_EMBEDDING_LOG_FILE", str(logfile))
+    monkeypatch.setenv("BBS_EMBEDDING_LAZY_LOADING", "1")
+    monkeypatch.setenv("BBS_EMBEDDING_IDLE_TIMEOUT", "30")
+    monkeypatch.setenv("BBS_EMBEDDING_MAX_LOADED_MODELS", "1")
+
+    get_embedding_app()
+
+    # No model is loaded at startup
+    fake_sent_transformer.assert_not_called()
+
+    args, kwargs = fake_embedding_server_class.call_args
+    model_registry = kwargs["model_registry"]
+    assert isinstance(model_registry, ModelRegistry)
+    assert model_registry.idle_timeout == 30
+    assert model_registry.max_loaded_models == 1
+    assert model_registry.warmup_texts
+    assert args[0] == model_registry.models
+    assert all(isinstance(model, LazyEmbeddingModel) for model in args[0].values())
+
+    args[0]["SBioBERT"].embed("hello")
+    fake_sent_transformer.assert_called_once()
+    # The model is warmed up when it is loaded
+    assert fake_sent_transformer.return_value.warmup.call_count == 1
@@ -117,6 +117,7 @@ def test_send_through(
     assert kwargs["batch_size_transfer"] == batch_size_transfer
     assert kwargs["n_processes"] == n_processes
     assert kwargs["gpus"] == gpus
+    assert kwargs["dtype"] == "float32"
 
 
 @pytest.mark.slow
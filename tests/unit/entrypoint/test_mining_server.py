@@ -50,7 +50,9 @@ def test_send_through(
     monkeypatch.setenv("BBS_MINING_DB_URL", str(db_path))
     monkeypatch.setenv("BBS_MINING_MYSQL_USER", "some_user")
     monkeypatch.setenv("BBS_MINING_MYSQL_PASSWORD", "some_pwd")
+    monkeypatch.setenv("BBS_MINING_DB_MAX_OVERFLOW", "3")
     monkeypatch.setenv("BBS_DATA_AND_MODELS_DIR", str(spacy_model_path))
+    monkeypatch.setenv("BBS_MINING_N_THREADS", "2")
 
     fake_sqlalchemy = Mock()
     fake_mining_server_inst = Mock()
@@ -62,6 +64,11 @@ def test_send_through(
     monkeypatch.setattr(
         "bluesearch.entrypoint.mining_server.sqlalchemy", fake_sqlalchemy
     )
+    fake_configure_threads = Mock()
+    monkeypatch.setattr(
+        "bluesearch.entrypoint.mining_server.configure_threads",
+        fake_configure_threads,
+    )
 
     if db_type not in {"mysql", "sqlite"}:
         with pytest.raises(ValueError):
@@ -71,10 +78,19 @@ def test_send_through(
 
         fake_mining_server_class.assert_called_once()
         assert mining_app == fake_mining_server_inst
+        fake_configure_threads.assert_called_once_with(2)
+        fake_mining_server_inst.warmup.assert_called_once()
 
         args, kwargs = fake_mining_server_class.call_args
         assert not args
         assert kwargs["connection"] == fake_sqlalchemy.create_engine.return_value
+        _, engine_kwargs = fake_sqlalchemy.create_engine.call_args
+        if db_type == "mysql":
+            assert engine_kwargs["pool_size"] == 5
+            assert engine_kwargs["max_overflow"] == 3
+            assert engine_kwargs["pool_pre_ping"] is False
+        else:
+            assert not engine_kwargs
         assert "ee" in kwargs["models_libs"]
         assert isinstance(kwargs["models_libs"]["ee"], dict)
         assert len(kwargs["models_libs"]["ee"]) == len(entity_types)
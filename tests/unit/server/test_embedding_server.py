@@ -17,12 +17,22 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
+import io
+import json
+import multiprocessing as mp
+import threading
+import time
 from unittest.mock import Mock
 
 import numpy as np
 import pytest
 
-from bluesearch.server.embedding_server import EmbeddingServer
+from bluesearch.embedding_cache import CachedEmbeddingModel
+from bluesearch.server.embedding_server import (
+    EmbeddingServer,
+    MicroBatcher,
+    ModelRegistry,
+)
 
 
 @pytest.fixture(scope="session")
@@ -32,6 +42,10 @@ def embedding_client():
     sbiobert = Mock()
     sbiobert.preprocess.return_value = "This is a dummy sentence"
     sbiobert.embed.return_value = np.ones((2,))
+    sbiobert.preprocess_many.side_effect = lambda texts: texts
+    sbiobert.embed_many.side_effect = lambda texts: np.array(
+        [[len(text), 1] for text in texts], dtype=np.float32
+    )
     embedding_models = {"sbiobert": sbiobert}
 
     embedding_server_app = EmbeddingServer(embedding_models=embedding_models)
@@ -74,3 +88,252 @@ class TestEmbeddingServer:
 
         response = embedding_client.post("/v1/embed/invalid_format", data="not json")
         assert response.status_code == 400
+
+    def test_embedding_server_embed_batch(self, embedding_client):
+        texts = ["hello", "hi", "good morning"]
+        expected = np.array([[5, 1], [2, 1], [12, 1]], dtype=np.float32)
+
+        request_json = {"model": "sbiobert", "texts": texts}
+        response = embedding_client.post("/v1/embed_batch/json", json=request_json)
+        assert response.status_code == 200
+        np.testing.assert_array_equal(response.json["embeddings"], expected)
+
+        response = embedding_client.post("/v1/embed_batch/npy", json=request_json)
+        assert response.status_code == 200
+        assert response.headers["Content-type"] == "application/octet-stream"
+        embeddings = np.load(io.BytesIO(response.data))
+        assert embeddings.dtype == np.float32
+        np.testing.assert_array_equal(embeddings, expected)
+
+        for invalid_json in [
+            {"model": "sbiobert"},
+            {"model": "sbiobert", "texts": "hello"},
+            {"model": "sbiobert", "texts": []},
+            {"model": "sbiobert", "texts": ["hello", 1]},
+            {"model": "invalid_model", "texts": texts},
+        ]:
+            response = embedding_client.post("/v1/embed_batch/npy", json=invalid_json)
+            assert response.status_code == 400
+
+        response = embedding_client.post("/v1/embed_batch/npy", data="not json")
+        assert response.status_code == 400
+
+        response = embedding_client.post("/v1/embed_batch/csv", json=request_json)
+        assert response.status_code == 400
+
+    def test_after_fork(self):
+        cached_model = CachedEmbeddingModel(Mock(sparse=False), Mock(), "cached", "v1")
+        registry = ModelRegistry({"lazy": Mock()}, idle_timeout=60)
+        embedding_server_app = EmbeddingServer(
+            embedding_models={"cached": cached_model, "lazy": registry.models["lazy"]},
+            max_batch_size=8,
+            model_registry=registry,
+        )
+
+        pool = cached_model.cache.engine.pool
+        embedding_server_app.after_fork()
+        assert all(batcher.thread for batcher in embedding_server_app.batchers.values())
+        assert registry.thread is not None
+        assert cached_model.cache.engine.pool is pool.recreate.return_value
+
+    def test_warmup(self):
+        model = Mock()
+        embedding_server_app = EmbeddingServer(embedding_models={"model": model})
+
+        timings = embedding_server_app.warmup(texts=["hello"])
+
+        assert set(timings) == {"model"}
+        model.warmup.assert_called_once_with(["hello"])
+
+
+class TestMicroBatcher:
+    def test_batching(self):
+        model = Mock()
+        model.embed_many.side_effect = lambda sentences: np.array(
+            [[len(sentence)] for sentence in sentences]
+        )
+        batcher = MicroBatcher(model, max_batch_size=4, max_wait_ms=100)
+
+        sentences = [i * "a" for i in range(10)]
+        results = {}
+
+        def embed(sentence):
+            results[sentence] = batcher.embed(sentence)
+
+        threads = [threading.Thread(target=embed, args=(s,)) for s in sentences]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Each request gets its own result
+        for sentence in sentences:
+            np.testing.assert_array_equal(results[sentence], [len(sentence)])
+
+        # The requests were batched
+        batch_sizes = [len(call.args[0]) for call in model.embed_many.call_args_list]
+        assert sum(batch_sizes) == len(sentences)
+        assert max(batch_sizes) <= 4
+        assert len(batch_sizes) < len(sentences)
+
+    def test_fork(self):
+        model = Mock()
+        model.embed_many.side_effect = lambda sentences: np.ones((len(sentences), 2))
+        batcher = MicroBatcher(model, max_batch_size=4, max_wait_ms=1)
+
+        # The thread is started by the first request
+        assert batcher.thread is None
+        batcher.embed("hello")
+        assert batcher.thread is not None
+
+        def embed_in_child(results):
+            results.put(batcher.embed("hello").tolist())
+
+        ctx = mp.get_context("fork")
+        results = ctx.Queue()
+        process = ctx.Process(target=embed_in_child, args=(results,))
+        process.start()
+        try:
+            # The child starts its own thread instead of waiting forever for
+            # the one of the parent
+            assert results.get(timeout=10) == [1, 1]
+        finally:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.kill()
+        assert process.exitcode == 0
+
+    def test_errors(self):
+        with pytest.raises(ValueError):
+            MicroBatcher(Mock(), max_batch_size=0)
+
+        model = Mock()
+        model.embed_many.side_effect = RuntimeError("Inference failed")
+        batcher = MicroBatcher(model, max_batch_size=4, max_wait_ms=1)
+        with pytest.raises(RuntimeError, match="Inference failed"):
+            batcher.embed("hello")
+
+    def test_embedding_server(self):
+        model = Mock()
+        model.preprocess.side_effect = lambda text: text
+        model.embed_many.side_effect = lambda sentences: np.ones((len(sentences), 2))
+        embedding_server_app = EmbeddingServer(
+            embedding_models={"sbiobert": model}, max_batch_size=8, max_wait_ms=1
+        )
+        embedding_server_app.config["TESTING"] = True
+
+        with embedding_server_app.test_client() as client:
+            request_json = {"model": "sbiobert", "text": "hello"}
+            response = client.post("/v1/embed/json", json=request_json)
+
+        assert response.status_code == 200
+        assert json.loads(response.data)["embedding"] == [1, 1]
+        model.embed.assert_not_called()
+        model.embed_many.assert_called_once_with(["hello"])
+
+
+class TestModelRegistry:
+    @staticmethod
+    def fake_factories(model_names):
+        def factory():
+            model = Mock()
+            model.preprocess.side_effect = lambda text: text
+            model.embed.return_value = np.ones(2)
+            return model
+
+        return {model_name: Mock(side_effect=factory) for model_name in model_names}
+
+    def test_budget(self):
+        factories = self.fake_factories(["a", "b", "c"])
+        registry = ModelRegistry(factories, max_loaded_models=2)
+        assert not any(state["loaded"] for state in registry.state().values())
+
+        registry.models["a"].embed("hello")
+        registry.models["b"].embed("hello")
+        registry.models["a"].embed("hello")
+        registry.models["c"].embed("hello")
+
+        # "b" is the least recently used model
+        state = registry.state()
+        assert {name for name in state if state[name]["loaded"]} == {"a", "c"}
+        assert state["b"]["idle_seconds"] is None
+        assert state["b"]["load_seconds"] is not None
+        assert factories["a"].call_count == 1
+
+        with pytest.raises(ValueError):
+            ModelRegistry(factories, max_loaded_models=0)
+
+    def test_warmup(self):
+        factories = self.fake_factories(["a", "b"])
+        registry = ModelRegistry(factories, warmup_texts=["hello"])
+        embedding_server_app = EmbeddingServer(
+            embedding_models=registry.models, model_registry=registry
+        )
+
+        # The models which are not loaded are not warmed up
+        registry.models["a"].embed("hello")
+        registry.models["a"].load().warmup.assert_called_once_with(["hello"])
+        assert embedding_server_app.warmup(texts=["bye"]).keys() == {"a"}
+        registry.models["a"].load().warmup.assert_called_with(["bye"])
+        assert not registry.models["b"].is_loaded
+
+    def test_idle(self):
+        registry = ModelRegistry(self.fake_factories(["a", "b"]), idle_timeout=60)
+        registry.models["a"].embed("hello")
+        registry.models["b"].embed("hello")
+
+        registry.evict_idle()
+        assert registry.models["a"].is_loaded
+
+        registry.models["a"].last_used -= 61
+        registry.evict_idle()
+        assert not registry.models["a"].is_loaded
+        assert registry.models["b"].is_loaded
+
+    def test_fork(self):
+        registry = ModelRegistry(self.fake_factories(["a", "b"]), idle_timeout=0.2)
+
+        # The thread is started by the first load
+        assert registry.thread is None
+        registry.models["a"].embed("hello")
+        assert registry.thread is not None
+
+        def evict_in_child(results):
+            registry.models["b"].embed("hello")
+            deadline = time.monotonic() + 5
+            while registry.models["b"].is_loaded and time.monotonic() < deadline:
+                time.sleep(0.05)
+            results.put(registry.models["b"].is_loaded)
+
+        ctx = mp.get_context("fork")
+        results = ctx.Queue()
+        process = ctx.Process(target=evict_in_child, args=(results,))
+        process.start()
+        try:
+            # The child unloads its idle models with its own thread
+            assert results.get(timeout=10) is False
+        finally:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.kill()
+        assert process.exitcode == 0
+
+    def test_embedding_server(self):
+        factories = self.fake_factories(["sbiobert"])
+        registry = ModelRegistry(factories)
+        embedding_server_app = EmbeddingServer(
+            embedding_models=registry.models, model_registry=registry
+        )
+        embedding_server_app.config["TESTING"] = True
+
+        with embedding_server_app.test_client() as client:
+            response = client.post("/help")
+            assert json.loads(response.data)["models"]["sbiobert"]["loaded"] is False
+            factories["sbiobert"].assert_not_called()
+
+            request_json = {"model": "sbiobert", "text": "hello"}
+            response = client.post("/v1/embed/json", json=request_json)
+            assert response.status_code == 200
+
+            response = client.post("/help")
+            assert json.loads(response.data)["models"]["sbiobert"]["loaded"] is True
@@ -16,6 +16,7 @@
 #
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
+import json
 from io import StringIO
 from pathlib import Path
 from unittest.mock import Mock
@@ -53,6 +54,21 @@ class TestMiningServer:
         response = mining_client.post("/help")
         assert response.json["name"] == "MiningServer"
 
+    def test_mining_server_warmup(self, mining_client, entity_types):
+        timings = mining_client.application.warmup()
+        assert set(timings) == set(entity_types)
+
+    def test_mining_server_after_fork(self, mining_client, fake_sqlalchemy_engine):
+        pool = fake_sqlalchemy_engine.pool
+
+        mining_client.application.after_fork()
+        assert fake_sqlalchemy_engine.pool is not pool
+
+    def test_mining_server_stats(self, mining_client):
+        response = mining_client.post("/stats")
+        assert response.status_code == 200
+        assert "pool_class" in response.json["database_pool"]
+
     def test_mining_server_pipeline(self, mining_client):
         schema_file = TESTS_PATH / "data" / "mining" / "request" / "request.csv"
         with open(schema_file, "r") as f:
@@ -90,6 +106,16 @@ class TestMiningServer:
         )
         assert expected_columns_names == extracted_columns_names
 
+        # Test a streaming request
+        request_json = {"text": "hello", "schema": schema_request, "format": "csv"}
+        response = mining_client.post("/text", json=request_json)
+        assert response.status_code == 200
+        assert response.mimetype == "text/csv"
+        extracted_columns_names = sorted(
+            response.get_data(as_text=True).split("\n")[0].split(",")
+        )
+        assert expected_columns_names == extracted_columns_names
+
         # Test request with a missing text
         request_json = {}
         response = mining_client.post("/text", json=request_json)
@@ -169,6 +195,140 @@ class TestMiningServer:
         )
         assert expected_columns_names == extracted_columns_names
 
+    @pytest.mark.parametrize("output_format", ["csv", "ndjson"])
+    @pytest.mark.parametrize(
+        "use_cache", [True, False], ids=["with_cache", "without_cache"]
+    )
+    def test_mining_server_streaming(self, mining_client, use_cache, output_format):
+        schema_file = TESTS_PATH / "data" / "mining" / "request" / "request.csv"
+        with open(schema_file, "r") as f:
+            schema_request = f.read()
+
+        request_json = {
+            "identifiers": [(1, 0), (2, -1), (3, 1)],
+            "schema": schema_request,
+            "use_cache": use_cache,
+        }
+        response = mining_client.post("/database", json=request_json)
+        expected_df = pd.read_csv(StringIO(response.json["csv_extractions"]))
+        expected_warnings = response.json["warnings"]
+
+        request_json["format"] = output_format
+        response = mining_client.post("/database", json=request_json)
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert json.loads(response.headers["Mining-Warnings"]) == expected_warnings
+        if output_format == "csv":
+            assert response.mimetype == "text/csv"
+            df = pd.read_csv(StringIO(response.get_data(as_text=True)))
+        else:
+            assert response.mimetype == "application/x-ndjson"
+            lines = response.get_data(as_text=True).splitlines()
+            df = pd.DataFrame([json.loads(line) for line in lines], columns=SPECS)
+            df = pd.read_csv(StringIO(df.to_csv(index=False)))
+
+        # Without the cache, the articles are sorted one by one
+        pd.testing.assert_frame_equal(
+            df.sort_values(by=SPECS, ignore_index=True),
+            expected_df.sort_values(by=SPECS, ignore_index=True),
+        )
+
+        # Test an unsupported format
+        request_json["format"] = "xml"
+        response = mining_client.post("/database", json=request_json)
+        assert response.status_code == 400
+        assert response.json == {"error": 'The format "xml" is not supported.'}
+
+        # Test invalid identifiers
+        request_json["format"] = output_format
+        for invalid_identifiers in [[1, 2], [(1, "a")], [(1, 2, 3)], "1,2"]:
+            request_json["identifiers"] = invalid_identifiers
+            response = mining_client.post("/database", json=request_json)
+            assert response.status_code == 400
+            assert "identifiers" in response.json["error"]
+
+    @pytest.mark.parametrize("output_format", ["csv", "ndjson"])
+    @pytest.mark.parametrize(
+        "use_cache", [True, False], ids=["with_cache", "without_cache"]
+    )
+    def test_mining_server_streaming_no_etypes(
+        self, mining_client, use_cache, output_format
+    ):
+        request_json = {
+            "identifiers": [(1, 0), (2, -1)],
+            "schema": "entity_type,property,property_type,property_value_type,"
+            "ontology_source\nUNKNOWN_TYPE,,,,\n",
+            "use_cache": use_cache,
+            "format": output_format,
+        }
+        response = mining_client.post("/database", json=request_json)
+        assert response.status_code == 200
+        assert json.loads(response.headers["Mining-Warnings"]) == [
+            'No text mining model was found in the library for "UNKNOWN_TYPE".'
+        ]
+        if output_format == "csv":
+            df = pd.read_csv(StringIO(response.get_data(as_text=True)))
+            assert df.empty
+        else:
+            assert response.get_data(as_text=True) == ""
+
+    @pytest.mark.parametrize(
+        "use_cache", [True, False], ids=["with_cache", "without_cache"]
+    )
+    def test_mining_server_streaming_debug(self, mining_client, use_cache):
+        schema_file = TESTS_PATH / "data" / "mining" / "request" / "request.csv"
+        with open(schema_file, "r") as f:
+            schema_request = f.read()
+
+        request_json = {
+            "identifiers": [(1, 0), (2, -1), (3, 1)],
+            "schema": schema_request,
+            "use_cache": use_cache,
+            "debug": True,
+        }
+        response = mining_client.post("/database", json=request_json)
+        expected_df = pd.read_csv(StringIO(response.json["csv_extractions"]))
+
+        request_json["format"] = "csv"
+        response = mining_client.post("/database", json=request_json)
+        assert response.status_code == 200
+        df = pd.read_csv(StringIO(response.get_data(as_text=True)))
+        if use_cache:
+            assert set(df.columns) > set(SPECS)
+        else:
+            assert list(df.columns) == SPECS
+        assert len(df) == len(expected_df)
+        pd.testing.assert_frame_equal(
+            df[expected_df.columns].sort_values(by=["paper_id", "start_char"]),
+            expected_df.sort_values(by=["paper_id", "start_char"]),
+            check_like=True,
+            check_index_type=False,
+            check_dtype=False,
+        )
+
+    def test_stream_csv_columns(self):
+        df_chunks = [
+            pd.DataFrame({"entity": [], "entity_type": []}),
+            pd.DataFrame({"entity_type": ["CHEMICAL"], "entity": ["water"]}),
+            pd.DataFrame({"entity": ["mouse"], "start_char": [3], "debug": [1]}),
+        ]
+        csv = "".join(MiningServer.stream_csv(df_chunks, ["entity", "entity_type"]))
+        assert csv.splitlines() == ["entity,entity_type", "water,CHEMICAL", "mouse,"]
+
+        csv = "".join(MiningServer.stream_csv([], ["entity", "entity_type"]))
+        assert csv.splitlines() == ["entity,entity_type"]
+
+    def test_mining_server_streaming_first_chunk(self, mining_client):
+        def failing_chunks():
+            raise RuntimeError("The query failed")
+            yield  # pragma: no cover
+
+        # The error is raised before the status is sent
+        with pytest.raises(RuntimeError, match="The query failed"):
+            mining_client.application.create_streaming_response(
+                failing_chunks(), [], "csv"
+            )
+
     @pytest.mark.parametrize("debug", [True, False], ids=["debug", "specs"])
     def test_mining_cache_detailed(self, mining_client, test_parameters, debug):
         """Test exact count of found entities.
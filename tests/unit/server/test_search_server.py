@@ -21,7 +21,9 @@ from unittest.mock import Mock
 
 import numpy as np
 import pytest
+import torch
 
+from bluesearch.embedding_cache import CachedEmbeddingModel, EmbeddingCache
 from bluesearch.server.search_server import SearchServer
 from bluesearch.utils import H5
 
@@ -63,6 +65,14 @@ class TestSearchServer:
         response = search_client.post("/help")
         assert response.status_code == 200
         assert response.json["name"] == "SearchServer"
+        loading_times = response.json["loading_times"]
+        assert set(loading_times) == {"SBioBERT"}
+        assert set(loading_times["SBioBERT"]) == {"load_seconds", "normalize_seconds"}
+
+        # Test the stats request
+        response = search_client.post("/stats")
+        assert response.status_code == 200
+        assert "pool_class" in response.json["database_pool"]
 
         # Test a valid JSON request
         k = 3
@@ -79,3 +89,111 @@ class TestSearchServer:
         json_response = response.json
         assert json_response["sentence_ids"] is None
         assert json_response["similarities"] is None
+
+    def test_warmup(self, search_client):
+        search_server_app = search_client.application
+
+        timings = search_server_app.warmup(queries=["hello"])
+
+        assert set(timings) == {"SBioBERT"}
+        model = search_server_app.embedding_models["SBioBERT"]
+        model.warmup.assert_called_once_with(["hello"])
+
+    def test_float16_embeddings(
+        self, monkeypatch, tmp_path, embeddings_h5_path, fake_sqlalchemy_engine
+    ):
+        monkeypatch.setattr(
+            "bluesearch.server.search_server.get_embedding_model",
+            lambda *args, **kwargs: Mock(),
+        )
+        embeddings = H5.load(embeddings_h5_path, "SBioBERT")
+        h5_path = tmp_path / "embeddings_f2.h5"
+        H5.create(h5_path, "SBioBERT", shape=embeddings.shape, dtype="f2")
+        H5.write(h5_path, "SBioBERT", embeddings, np.arange(len(embeddings)))
+
+        search_server_app = SearchServer(
+            trained_models_path="",
+            embeddings_h5_path=h5_path,
+            indices=H5.find_populated_rows(h5_path, "SBioBERT"),
+            connection=fake_sqlalchemy_engine,
+            models=["SBioBERT"],
+        )
+
+        precomputed_embeddings = search_server_app.precomputed_embeddings["SBioBERT"]
+        assert precomputed_embeddings.dtype == torch.float32
+
+    @pytest.mark.parametrize("normalization_chunk_size", [1, 3, 100_000])
+    def test_normalization(
+        self,
+        monkeypatch,
+        embeddings_h5_path,
+        fake_sqlalchemy_engine,
+        normalization_chunk_size,
+    ):
+        monkeypatch.setattr(
+            "bluesearch.server.search_server.get_embedding_model",
+            lambda *args, **kwargs: Mock(),
+        )
+        models = ["SBioBERT", "SBERT"]
+        search_server_app = SearchServer(
+            trained_models_path="",
+            embeddings_h5_path=embeddings_h5_path,
+            indices=H5.find_populated_rows(embeddings_h5_path, "SBioBERT"),
+            connection=fake_sqlalchemy_engine,
+            models=models,
+            normalization_chunk_size=normalization_chunk_size,
+        )
+
+        assert set(search_server_app.loading_times) == set(models)
+        for model_name in models:
+            embeddings = H5.load(embeddings_h5_path, model_name)[1:]
+            precomputed_embeddings = search_server_app.precomputed_embeddings[
+                model_name
+            ]
+            expected = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+            np.testing.assert_allclose(
+                precomputed_embeddings.numpy(), expected, rtol=1e-5
+            )
+
+    def test_embedding_cache(
+        self, monkeypatch, tmp_path, embeddings_h5_path, fake_sqlalchemy_engine
+    ):
+        fake_embedding_model = Mock()
+        fake_embedding_model.sparse = False
+        monkeypatch.setattr(
+            "bluesearch.server.search_server.get_embedding_model",
+            lambda *args, **kwargs: fake_embedding_model,
+        )
+        embedding_cache = EmbeddingCache(tmp_path / "cache.db")
+
+        search_server_app = SearchServer(
+            trained_models_path="",
+            embeddings_h5_path=embeddings_h5_path,
+            indices=H5.find_populated_rows(embeddings_h5_path, "SBioBERT"),
+            connection=fake_sqlalchemy_engine,
+            models=["SBioBERT"],
+            embedding_cache=embedding_cache,
+        )
+
+        model = search_server_app.embedding_models["SBioBERT"]
+        assert isinstance(model, CachedEmbeddingModel)
+        assert model.model is fake_embedding_model
+        assert model.cache is embedding_cache
+
+    def test_after_fork(self, monkeypatch, embeddings_h5_path, fake_sqlalchemy_engine):
+        monkeypatch.setattr(
+            "bluesearch.server.search_server.get_embedding_model",
+            lambda *args, **kwargs: Mock(),
+        )
+        search_server_app = SearchServer(
+            trained_models_path="",
+            embeddings_h5_path=embeddings_h5_path,
+            indices=H5.find_populated_rows(embeddings_h5_path, "SBioBERT"),
+            connection=fake_sqlalchemy_engine,
+            models=["SBioBERT"],
+        )
+        pool = fake_sqlalchemy_engine.pool
+
+        # The connections of the parent process are not closed, but forgotten
+        search_server_app.after_fork()
+        assert fake_sqlalchemy_engine.pool is not pool
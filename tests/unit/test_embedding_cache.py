@@ -0,0 +1,245 @@
+"""Tests covering the persistent cache of embeddings."""
+
+# Blue Brain Search is a text mining toolbox focused on scientific use cases.
+#
+# Copyright (C) 2020  Blue Brain Project, EPFL.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import pickle
+import threading
+from unittest.mock import Mock
+
+import numpy as np
+import pytest
+import sqlalchemy
+
+from bluesearch.embedding_cache import (
+    CachedEmbeddingModel,
+    EmbeddingCache,
+    compute_fingerprint,
+    get_model_fingerprint,
+)
+from bluesearch.embedding_models import (
+    EmbeddingModel,
+    LazyEmbeddingModel,
+    SklearnVectorizer,
+)
+
+
+@pytest.fixture
+def fake_model():
+    model = Mock(spec=EmbeddingModel)
+    model.dim = 2
+    model.preprocess.side_effect = lambda text: text.lower()
+    model.preprocess_many.side_effect = lambda texts: [t.lower() for t in texts]
+    model.embed_many.side_effect = lambda texts: np.array(
+        [[len(text), 1] for text in texts], dtype=np.float64
+    )
+    return model
+
+
+def test_compute_fingerprint(tmp_path):
+    assert compute_fingerprint("gsarti/biobert-nli") == "gsarti/biobert-nli"
+
+    checkpoint_path = tmp_path / "model.pkl"
+    checkpoint_path.write_bytes(b"weights")
+    fingerprint = compute_fingerprint(checkpoint_path)
+    assert len(fingerprint) == 64
+    assert compute_fingerprint(checkpoint_path) == fingerprint
+    checkpoint_path.write_bytes(b"other weights")
+    assert compute_fingerprint(checkpoint_path) != fingerprint
+
+    # Directories
+    (tmp_path / "config.json").write_text("{}")
+    fingerprint = compute_fingerprint(tmp_path)
+    assert len(fingerprint) == 64
+    (tmp_path / "config.json").write_text('{"layers": 12}')
+    assert compute_fingerprint(tmp_path) != fingerprint
+
+
+def test_get_model_fingerprint(tmp_path, fake_model):
+    checkpoint_path = tmp_path / "model.pkl"
+    with checkpoint_path.open("wb") as f:
+        pickle.dump({"some": "model"}, f)
+    model = SklearnVectorizer(checkpoint_path)
+
+    assert get_model_fingerprint(model) == compute_fingerprint(checkpoint_path)
+    lazy_model = LazyEmbeddingModel(lambda: model)
+    assert get_model_fingerprint(lazy_model) == compute_fingerprint(checkpoint_path)
+    assert get_model_fingerprint(fake_model) == "EmbeddingModel"
+
+
+class TestEmbeddingCache:
+    def test_get_put(self, tmp_path):
+        cache = EmbeddingCache(tmp_path / "cache.db")
+        assert len(cache) == 0
+        assert cache.get_many("model", "v1", []) == {}
+
+        cache.put_many("model", "v1", ["a", "bb"], np.array([[1, 2], [3, 4]]))
+        assert len(cache) == 2
+
+        res = cache.get_many("model", "v1", ["bb", "c", "a"])
+        assert set(res) == {"a", "bb"}
+        assert res["a"].dtype == np.float32
+        np.testing.assert_array_equal(res["bb"], [3, 4])
+
+        # The model name and the fingerprint are part of the key
+        assert cache.get_many("model", "v2", ["a"]) == {}
+        assert cache.get_many("other_model", "v1", ["a"]) == {}
+
+        # Overwrite
+        cache.put_many("model", "v1", ["a"], np.array([[5, 6]]))
+        np.testing.assert_array_equal(cache.get_many("model", "v1", ["a"])["a"], [5, 6])
+        assert len(cache) == 2
+
+        # The cache is persistent
+        cache = EmbeddingCache(tmp_path / "cache.db")
+        assert len(cache) == 2
+
+    def test_many_texts(self, tmp_path):
+        cache = EmbeddingCache(tmp_path / "cache.db")
+        texts = [str(i) for i in range(1200)]
+        embeddings = np.arange(2400).reshape(1200, 2)
+        cache.put_many("model", "v1", texts, embeddings)
+
+        res = cache.get_many("model", "v1", texts)
+        assert len(res) == 1200
+        np.testing.assert_array_equal(res["1100"], [2200, 2201])
+
+    def test_eviction(self, tmp_path, monkeypatch):
+        now = [0.0]
+        monkeypatch.setattr("bluesearch.embedding_cache.time.time", lambda: now[0])
+        cache = EmbeddingCache(tmp_path / "cache.db", max_entries=3, touch_interval=0)
+
+        cache.put_many("model", "v1", ["a", "b", "c"], np.ones((3, 2)))
+        now[0] = 1
+        cache.get_many("model", "v1", ["a"])  # "a" is used recently
+        now[0] = 2
+        cache.put_many("model", "v1", ["d"], np.ones((1, 2)))
+
+        assert len(cache) == cache.n_entries == 3
+        res = cache.get_many("model", "v1", ["a", "b", "c", "d"])
+        assert "a" in res
+        assert "d" in res
+
+        # Overwriting an embedding does not add an entry
+        cache.put_many("model", "v1", ["a"], np.ones((1, 2)))
+        assert len(cache) == cache.n_entries == 3
+
+        # The number of entries is read when the cache is opened
+        cache = EmbeddingCache(tmp_path / "cache.db", max_entries=3)
+        assert cache.n_entries == 3
+
+    def test_eviction_shared(self, tmp_path):
+        # Two processes sharing the cache, each one counts its insertions
+        cache_1 = EmbeddingCache(tmp_path / "cache.db", max_entries=3)
+        cache_2 = EmbeddingCache(tmp_path / "cache.db", max_entries=3)
+
+        cache_1.put_many("model", "v1", ["a", "b"], np.ones((2, 2)))
+        cache_2.put_many("model", "v1", ["c", "d"], np.ones((2, 2)))
+        assert cache_1.n_entries == cache_2.n_entries == 2
+        assert len(cache_1) == 4
+
+        # The eviction counts the embeddings added by the other process
+        cache_2.put_many("model", "v1", ["e", "f"], np.ones((2, 2)))
+        assert len(cache_1) == cache_2.n_entries == 3
+
+    def test_concurrent_put(self, tmp_path):
+        cache = EmbeddingCache(tmp_path / "cache.db", max_entries=1000)
+        texts = [str(i) for i in range(50)]
+
+        def put(thread_texts):
+            for text in thread_texts:
+                cache.put_many("model", "v1", [text], np.ones((1, 2)))
+
+        # The threads insert the same sentences
+        threads = [threading.Thread(target=put, args=(texts,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(cache) == cache.n_entries == 50
+
+    def test_touch_interval(self, tmp_path, monkeypatch):
+        now = [0.0]
+        monkeypatch.setattr("bluesearch.embedding_cache.time.time", lambda: now[0])
+        cache = EmbeddingCache(tmp_path / "cache.db", max_entries=10)
+        cache.put_many("model", "v1", ["a", "b"], np.ones((2, 2)))
+
+        statements = []
+        sqlalchemy.event.listen(
+            cache.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(statement),
+        )
+
+        # Recently used embeddings are read without writing
+        now[0] = 30
+        assert cache.get_many("model", "v1", ["a"]).keys() == {"a"}
+        assert not any(s.startswith("UPDATE") for s in statements)
+
+        now[0] = 61
+        cache.get_many("model", "v1", ["a"])
+        assert sum(s.startswith("UPDATE") for s in statements) == 1
+
+        # The entries are not counted by scanning the table on insertion
+        statements.clear()
+        cache.put_many("model", "v1", ["c"], np.ones((1, 2)))
+        assert cache.n_entries == 3
+        assert not any("FROM embeddings" in s and "WHERE" not in s for s in statements)
+
+
+class TestCachedEmbeddingModel:
+    def test_embed(self, tmp_path, fake_model):
+        cache = EmbeddingCache(tmp_path / "cache.db")
+        model = CachedEmbeddingModel(fake_model, cache, "fake", fingerprint="v1")
+
+        assert model.dim == 2
+        assert model.preprocess("Hello") == "hello"
+        assert model.preprocess_many(["Hello"]) == ["hello"]
+
+        embeddings = model.embed_many(["a", "bb", "a"])
+        assert embeddings.dtype == np.float32
+        np.testing.assert_array_equal(embeddings, [[1, 1], [2, 1], [1, 1]])
+        fake_model.embed_many.assert_called_once_with(["a", "bb"])
+
+        # Only the missing sentences are embedded
+        embeddings = model.embed_many(["bb", "ccc"])
+        np.testing.assert_array_equal(embeddings, [[2, 1], [3, 1]])
+        fake_model.embed_many.assert_called_with(["ccc"])
+
+        # A new model instance uses the same cache
+        model = CachedEmbeddingModel(fake_model, cache, "fake", fingerprint="v1")
+        np.testing.assert_array_equal(model.embed("ccc"), [3, 1])
+        assert fake_model.embed_many.call_count == 2
+
+        assert model.embed_many([]).shape == (0, 2)
+
+    def test_warmup(self, tmp_path, fake_model):
+        cache = EmbeddingCache(tmp_path / "cache.db")
+        model = CachedEmbeddingModel(fake_model, cache, "fake", fingerprint="v1")
+
+        model.warmup(["a", "bb"])
+
+        # The cache is bypassed
+        fake_model.warmup.assert_called_once_with(["a", "bb"])
+        assert len(cache) == 0
+
+    def test_sparse(self, tmp_path, fake_model):
+        fake_model.sparse = True
+        cache = EmbeddingCache(tmp_path / "cache.db")
+        with pytest.raises(ValueError, match="Sparse"):
+            CachedEmbeddingModel(fake_model, cache, "fake")
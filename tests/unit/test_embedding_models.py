@@ -18,7 +18,11 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import importlib
+import logging
 import pickle
+import queue
+import threading
+import time
 from pathlib import Path
 from unittest.mock import Mock
 
@@ -26,17 +30,21 @@ import h5py
 import numpy as np
 import pandas as pd
 import pytest
+import scipy.sparse
 import torch
 from sentence_transformers import SentenceTransformer
 
 from bluesearch.embedding_models import (
     EmbeddingModel,
+    LazyEmbeddingModel,
     MPEmbedder,
     SentTransformer,
     SklearnVectorizer,
     compute_database_embeddings,
     get_embedding_model,
+    iter_database_embeddings,
 )
+from bluesearch.utils import H5
 
 GPU_IS_AVAILABLE = torch.cuda.is_available()
 
@@ -147,6 +155,28 @@ class TestEmbeddingModels:
         else:
             assert embedding.shape == (n_sentences, skl_vectorizer.dim)
 
+    def test_sklearnvectorizer_sparse(self, tmpdir):
+        model = importlib.import_module("sklearn.feature_extraction.text")
+        model = model.TfidfVectorizer().fit(["A first sentence.", "A second one."])
+        save_file = Path(tmpdir) / "model.pkl"
+        with open(save_file, "wb") as f:
+            pickle.dump(model, f)
+
+        dense_vectorizer = SklearnVectorizer(checkpoint_path=save_file)
+        sparse_vectorizer = SklearnVectorizer(checkpoint_path=save_file, sparse=True)
+        sentences = ["A third sentence.", "Nothing known."]
+
+        embeddings = sparse_vectorizer.embed_many(sentences)
+        assert scipy.sparse.isspmatrix_csr(embeddings)
+        assert embeddings.dtype == np.float32
+        assert embeddings.shape == (2, sparse_vectorizer.dim)
+        np.testing.assert_allclose(
+            embeddings.toarray(), dense_vectorizer.embed_many(sentences), rtol=1e-6
+        )
+
+        embedding = sparse_vectorizer.embed(sentences[0])
+        assert embedding.shape == (1, sparse_vectorizer.dim)
+
     def test_default_preprocess_many(self, monkeypatch):
         class NewModel(EmbeddingModel):
             @property
@@ -189,6 +219,27 @@ class TestEmbeddingModels:
         assert embeddings.shape == (3, model.dim)
         assert fake_embed.call_count == 3
 
+    def test_default_warmup(self, monkeypatch):
+        class NewModel(EmbeddingModel):
+            @property
+            def dim(self):
+                return 2
+
+            # just to be able to instantiate
+            def embed(self, preprocessed_sentence):
+                return np.ones(self.dim)
+
+        model = NewModel()
+        fake_embed_many = Mock()
+        monkeypatch.setattr(model, "embed_many", fake_embed_many)
+        fake_embed = Mock()
+        monkeypatch.setattr(model, "embed", fake_embed)
+
+        model.warmup(("A", "B"))
+
+        assert fake_embed.call_count == 2
+        fake_embed_many.assert_called_once_with(["A", "B"])
+
 
 # There's a warning/exception raised about unclosed docker sockets. Seems
 # it could be coming from the fake_sqlalchemy_engine fixture where a docker
@@ -233,6 +284,150 @@ def test_compute_database(
     )
 
 
+@pytest.mark.parametrize("chunk_size", [1, 4, 1000])
+def test_iter_database(fake_sqlalchemy_engine, test_parameters, chunk_size):
+    fake_embedder = Mock(spec=SentTransformer)
+    fake_embedder.preprocess_many.side_effect = lambda raw_sentences: raw_sentences
+    fake_embedder.embed_many.side_effect = lambda preprocessed_sentences: np.ones(
+        (len(preprocessed_sentences), 768)
+    )
+
+    # 0 and 10 ** 6 are not in the database
+    indices = np.array([0, 2, 3, 5, 8, 9, 10 ** 6])
+    results = list(
+        iter_database_embeddings(
+            fake_sqlalchemy_engine,
+            fake_embedder,
+            indices,
+            batch_size=2,
+            chunk_size=chunk_size,
+        )
+    )
+
+    for embeddings, retrieved_indices in results:
+        assert len(retrieved_indices) <= min(2, chunk_size)
+        assert embeddings.shape == (len(retrieved_indices), 768)
+
+    all_retrieved_indices = np.concatenate([ids for _, ids in results])
+    np.testing.assert_array_equal(all_retrieved_indices, [2, 3, 5, 8, 9])
+
+
+def test_iter_database_sort_by_length(monkeypatch):
+    texts = {i: "x" * ((7 * i) % 11 + 1) for i in range(1, 30)}
+
+    def fake_retrieve(sentence_ids, connection):
+        return pd.DataFrame(
+            {
+                "sentence_id": list(sentence_ids),
+                "text": [texts[i] for i in sentence_ids],
+            }
+        )
+
+    monkeypatch.setattr(
+        "bluesearch.embedding_models.retrieve_sentences_from_sentence_ids",
+        fake_retrieve,
+    )
+
+    batch_lengths = []
+
+    def embed_many(preprocessed_sentences):
+        lengths = [len(sentence) for sentence in preprocessed_sentences]
+        batch_lengths.append(lengths)
+        return np.array([[length, 2 * length] for length in lengths])
+
+    fake_embedder = Mock(spec=SentTransformer)
+    fake_embedder.preprocess_many.side_effect = lambda raw_sentences: raw_sentences
+    fake_embedder.embed_many.side_effect = embed_many
+
+    indices = np.arange(1, 30)
+    expected, expected_indices = compute_database_embeddings(
+        None, fake_embedder, indices, batch_size=4
+    )
+
+    batch_lengths.clear()
+    results = list(
+        iter_database_embeddings(
+            None,
+            fake_embedder,
+            indices,
+            batch_size=4,
+            chunk_size=10,
+            sort_by_length=True,
+        )
+    )
+
+    # One result per chunk, batches of increasing lengths within each chunk
+    assert len(results) == 3
+    assert [len(lengths) for lengths in batch_lengths] == [4, 4, 2, 4, 4, 2, 4, 4, 1]
+    for start, end in [(0, 3), (3, 6), (6, 9)]:
+        chunk_lengths = sum(batch_lengths[start:end], [])
+        assert chunk_lengths == sorted(chunk_lengths)
+
+    # The output is identical to the one in the database order
+    embeddings = np.concatenate([emb for emb, _ in results])
+    retrieved_indices = np.concatenate([ids for _, ids in results])
+    np.testing.assert_array_equal(retrieved_indices, expected_indices)
+    np.testing.assert_array_equal(embeddings, expected)
+
+
+@pytest.mark.parametrize("sort_by_length", [False, True])
+def test_iter_database_deduplicate(monkeypatch, caplog, sort_by_length):
+    texts = {i: ["A", "BB", "A", "CCC", "BB", "A"][i % 6] for i in range(1, 13)}
+
+    def fake_retrieve(sentence_ids, connection):
+        return pd.DataFrame(
+            {
+                "sentence_id": list(sentence_ids),
+                "text": [texts[i] for i in sentence_ids],
+            }
+        )
+
+    monkeypatch.setattr(
+        "bluesearch.embedding_models.retrieve_sentences_from_sentence_ids",
+        fake_retrieve,
+    )
+
+    fake_embedder = Mock(spec=SentTransformer)
+    fake_embedder.preprocess_many.side_effect = lambda raw_sentences: [
+        sentence.lower() for sentence in raw_sentences
+    ]
+    fake_embedder.embed_many.side_effect = lambda preprocessed_sentences: np.array(
+        [[len(sentence), ord(sentence[0])] for sentence in preprocessed_sentences]
+    )
+
+    indices = np.arange(1, 13)
+    expected, _ = compute_database_embeddings(
+        None, fake_embedder, indices, batch_size=2
+    )
+
+    fake_embedder.embed_many.reset_mock()
+    with caplog.at_level(logging.INFO, logger="bluesearch.embedding_models"):
+        results = list(
+            iter_database_embeddings(
+                None,
+                fake_embedder,
+                indices,
+                batch_size=2,
+                chunk_size=6,
+                sort_by_length=sort_by_length,
+                deduplicate=True,
+            )
+        )
+
+    # 3 distinct sentences per chunk, so 2 batches per chunk
+    assert fake_embedder.embed_many.call_count == 4
+    n_embedded = sum(
+        len(call.args[0]) for call in fake_embedder.embed_many.call_args_list
+    )
+    assert n_embedded == 6
+    assert "3 distinct sentences out of 6 (50.0% saved)" in caplog.text
+
+    embeddings = np.concatenate([emb for emb, _ in results])
+    retrieved_indices = np.concatenate([ids for _, ids in results])
+    np.testing.assert_array_equal(retrieved_indices, indices)
+    np.testing.assert_array_equal(embeddings, expected)
+
+
 @pytest.mark.slow
 class TestSentTransformer:
     @pytest.mark.parametrize(
@@ -277,11 +472,112 @@ class TestSentTransformer:
             assert p.device == device
 
 
+class TestSentTransformerQuantize:
+    # Recent versions of torch deprecate the creation of quantized tensors
+    @pytest.mark.filterwarnings("ignore:torch.quantize_per_tensor:UserWarning")
+    def test_quantize(self, monkeypatch):
+        fake_model = torch.nn.Sequential(torch.nn.Linear(4, 3))
+        monkeypatch.setattr(
+            "bluesearch.embedding_models.sentence_transformers.SentenceTransformer",
+            Mock(return_value=fake_model),
+        )
+
+        model = SentTransformer("some_model", device="cpu", quantize=True)
+
+        assert model.quantize
+        assert isinstance(model.senttransf_model[0], torch.nn.quantized.dynamic.Linear)
+        # The original model is left untouched
+        assert isinstance(fake_model[0], torch.nn.Linear)
+
+    def test_quantize_gpu(self, monkeypatch):
+        fake_class = Mock()
+        monkeypatch.setattr(
+            "bluesearch.embedding_models.sentence_transformers.SentenceTransformer",
+            fake_class,
+        )
+
+        with pytest.raises(ValueError, match="only run on CPU"):
+            SentTransformer("some_model", device="cuda:0", quantize=True)
+        fake_class.assert_not_called()
+
+
+class TestLazyEmbeddingModel:
+    def test_load_on_use(self):
+        fake_model = Mock()
+        fake_model.dim = 3
+        fake_model.embed_many.return_value = np.ones((2, 3))
+        factory = Mock(return_value=fake_model)
+        on_load = Mock()
+
+        model = LazyEmbeddingModel(factory, on_load=on_load)
+        assert not model.is_loaded
+        factory.assert_not_called()
+
+        assert model.dim == 3
+        np.testing.assert_array_equal(model.embed_many(["a", "b"]), np.ones((2, 3)))
+        model.preprocess("a")
+        model.preprocess_many(["a"])
+        model.embed("a")
+        model.warmup(["a"])
+        fake_model.warmup.assert_called_once_with(["a"])
+        assert model.is_loaded
+        factory.assert_called_once()
+        on_load.assert_called_once_with(model)
+
+        assert model.unload()
+        assert not model.is_loaded
+        assert not model.unload()
+
+        model.embed("a")
+        assert factory.call_count == 2
+
+    def test_concurrent_load(self):
+        loading = threading.Event()
+
+        def factory():
+            loading.set()
+            time.sleep(0.1)
+            return Mock()
+
+        factory_mock = Mock(side_effect=factory)
+        model = LazyEmbeddingModel(factory_mock)
+
+        threads = [threading.Thread(target=model.embed, args=("a",)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # The model cannot be unloaded while it is loading
+        loading.wait()
+        assert not model.unload()
+        for thread in threads:
+            thread.join()
+
+        factory_mock.assert_called_once()
+
+    def test_no_unload_when_used(self):
+        fake_model = Mock()
+        model = LazyEmbeddingModel(lambda: fake_model)
+        results = []
+        fake_model.embed.side_effect = lambda _: results.append(model.unload())
+
+        model.embed("a")
+
+        assert results == [False]
+        assert model.is_loaded
+
+
 class TestGetEmbeddingModel:
     def test_invalid_key(self):
         with pytest.raises(ValueError):
             get_embedding_model("wrong_model_name")
 
+    def test_sparse_transformer(self):
+        with pytest.raises(ValueError, match="scikit-learn"):
+            get_embedding_model("SBERT", sparse=True)
+
+    def test_quantize_sklearn(self):
+        with pytest.raises(ValueError, match="Transformer"):
+            get_embedding_model("SklearnVectorizer", "model.pkl", quantize=True)
+
     @pytest.mark.parametrize(
         "name, underlying_class",
         [
@@ -304,12 +600,27 @@ class TestGetEmbeddingModel:
 
         assert returned_instance is fake_instance
 
+        if underlying_class == "SentTransformer":
+            get_embedding_model(name, quantize=True)
+            args, _ = fake_class.call_args
+            assert args[-1] is True
+
 
 class TestMPEmbedder:
     @pytest.mark.parametrize("dim", [2, 5])
     @pytest.mark.parametrize("batch_size", [1, 2, 10])
+    @pytest.mark.parametrize(
+        "sort_by_length, deduplicate", [(False, False), (True, False), (True, True)]
+    )
     def test_run_embedding_worker(
-        self, fake_sqlalchemy_engine, monkeypatch, tmpdir, dim, batch_size
+        self,
+        fake_sqlalchemy_engine,
+        monkeypatch,
+        tmpdir,
+        dim,
+        batch_size,
+        sort_by_length,
+        deduplicate,
     ):
         class Random(EmbeddingModel):
             def __init__(self, _dim):
@@ -331,17 +642,31 @@ class TestMPEmbedder:
             "bluesearch.embedding_models.get_embedding_model", fake_get_embedding_model
         )
 
+        task_queue: queue.Queue = queue.Queue()
+        done_queue: queue.Queue = queue.Queue()
+        task_queue.put((3, indices, temp_h5_path))
+        task_queue.put(None)
+
         MPEmbedder.run_embedding_worker(
             database_url=fake_sqlalchemy_engine.url,
             model_name_or_class="some_model",
-            indices=indices,
-            temp_h5_path=temp_h5_path,
+            task_queue=task_queue,
+            done_queue=done_queue,
             batch_size=batch_size,
             gpu=3,
             checkpoint_path=None,
             h5_dataset_name="some_model",
+            sort_by_length=sort_by_length,
+            deduplicate=deduplicate,
         )
 
+        assert done_queue.get_nowait() == 3
+        assert done_queue.empty()
+        assert task_queue.empty()
+        assert not temp_h5_path.with_name("temp.h5.part").exists()
+        assert MPEmbedder.is_chunk_done(temp_h5_path, "some_model", indices)
+        assert not MPEmbedder.is_chunk_done(temp_h5_path, "some_model", indices[1:])
+
         assert temp_h5_path.exists()
         with h5py.File(temp_h5_path, "r") as f:
             assert "some_model" in f.keys()
@@ -359,20 +684,24 @@ class TestMPEmbedder:
 
             assert not np.any(np.isnan(f["some_model_indices"][:]))
 
+        task_queue.put((4, indices, temp_h5_path))
+        task_queue.put(None)
         with pytest.raises(FileExistsError):
             MPEmbedder.run_embedding_worker(
                 database_url=fake_sqlalchemy_engine.url,
                 model_name_or_class="some_model",
-                indices=indices,
-                temp_h5_path=temp_h5_path,
+                task_queue=task_queue,
+                done_queue=done_queue,
                 batch_size=batch_size,
                 gpu=None,
                 checkpoint_path=None,
                 h5_dataset_name="some_model",
             )
+        assert done_queue.empty()
 
     @pytest.mark.parametrize("n_processes", [1, 2, 5])
-    def test_do_embedding(self, monkeypatch, tmp_path, n_processes):
+    @pytest.mark.parametrize("chunk_size", [1, 3, 100])
+    def test_do_embedding(self, monkeypatch, tmp_path, n_processes, chunk_size):
         # test 1 gpu per process or not specified
         with pytest.raises(ValueError):
             MPEmbedder(
@@ -384,15 +713,57 @@ class TestMPEmbedder:
                 gpus=[1, 4, 8],
             )
 
+        # only floating point storage, and sparse embeddings are float32
+        with pytest.raises(ValueError, match="floating point"):
+            MPEmbedder("some_url", "some_model", np.array([2]), tmp_path, dtype="i4")
+        with pytest.raises(ValueError, match="float32"):
+            MPEmbedder(
+                "some_url",
+                "some_model",
+                np.array([2]),
+                tmp_path,
+                sparse=True,
+                dtype="f2",
+            )
+
+        indices = np.array([2, 5, 11, 523, 523523, 3243223, 23424234])
         mpe = MPEmbedder(
             "some_url",
             "some_model",
-            np.array([2, 5, 11, 523, 523523, 3243223, 23424234]),
-            tmp_path,
+            indices,
+            tmp_path / "out.h5",
             n_processes=n_processes,
+            chunk_size=chunk_size,
         )
 
+        processed_chunks = []
+
+        def fake_worker(task_queue, done_queue, **kwargs):
+            while True:
+                task = task_queue.get()
+                if task is None:
+                    break
+                chunk_ix, chunk, temp_h5_path = task
+                processed_chunks.append(chunk)
+                done_queue.put(chunk_ix)
+
+        class FakeProcess:
+            def __init__(self, target, kwargs, **_):
+                self.target = target
+                self.kwargs = kwargs
+
+            def start(self):
+                self.target(**self.kwargs)
+
+            def is_alive(self):
+                return False
+
+            def join(self):
+                pass
+
         fake_multiprocessing = Mock()
+        fake_multiprocessing.Queue = queue.Queue
+        fake_multiprocessing.Process = Mock(side_effect=FakeProcess)
         fake_h5 = Mock()
         fake_get_embedding_model = Mock()
         monkeypatch.setattr("bluesearch.embedding_models.mp", fake_multiprocessing)
@@ -400,13 +771,217 @@ class TestMPEmbedder:
         monkeypatch.setattr(
             "bluesearch.embedding_models.get_embedding_model", fake_get_embedding_model
         )
+        monkeypatch.setattr(mpe, "run_embedding_worker", fake_worker)
 
         mpe.do_embedding()
 
         # checks
+        n_chunks = -(-len(indices) // chunk_size)
         fake_multiprocessing.set_start_method.asset_called_once()
-        assert fake_multiprocessing.Process.call_count == n_processes
+        assert fake_multiprocessing.Process.call_count == min(n_processes, n_chunks)
         fake_h5.concatenate.assert_called_once()
 
         args, _ = fake_h5.concatenate.call_args
-        assert len(args[2]) == n_processes
+        assert args[2] == [tmp_path / f"out_temp{i}.h5" for i in range(n_chunks)]
+        np.testing.assert_array_equal(np.concatenate(processed_chunks), indices)
+        assert all(len(chunk) <= chunk_size for chunk in processed_chunks)
+
+    @pytest.mark.parametrize("storage", ["sparse", "virtual", "float16"])
+    def test_do_embedding_storage(
+        self, fake_sqlalchemy_engine, monkeypatch, tmp_path, storage
+    ):
+        text_module = importlib.import_module("sklearn.feature_extraction.text")
+        sentences = pd.read_sql("SELECT text FROM sentences", fake_sqlalchemy_engine)
+        vectorizer = text_module.TfidfVectorizer().fit(sentences["text"])
+        checkpoint_path = tmp_path / "model.pkl"
+        with checkpoint_path.open("wb") as f:
+            pickle.dump(vectorizer, f)
+
+        class FakeProcess:
+            def __init__(self, target, kwargs, **_):
+                self.target = target
+                self.kwargs = kwargs
+
+            def start(self):
+                self.target(**self.kwargs)
+
+            def is_alive(self):
+                return False
+
+            def join(self):
+                pass
+
+        fake_multiprocessing = Mock()
+        fake_multiprocessing.Queue = queue.Queue
+        fake_multiprocessing.Process = FakeProcess
+        fake_multiprocessing.current_process.return_value.name = "worker"
+        monkeypatch.setattr("bluesearch.embedding_models.mp", fake_multiprocessing)
+
+        indices = np.array([1, 2, 3, 4, 5, 6, 9, 10])
+        sparse = storage == "sparse"
+        mpe = MPEmbedder(
+            fake_sqlalchemy_engine.url,
+            "SklearnVectorizer",
+            indices,
+            tmp_path / "out.h5",
+            checkpoint_path=checkpoint_path,
+            chunk_size=3,
+            h5_dataset_name="tfidf",
+            sparse=sparse,
+            dtype="f2" if storage == "float16" else "f4",
+            virtual=storage == "virtual",
+        )
+        mpe.do_embedding()
+
+        model = SklearnVectorizer(checkpoint_path, sparse=sparse)
+        expected, _ = compute_database_embeddings(
+            fake_sqlalchemy_engine, model, indices
+        )
+
+        assert H5.is_sparse(tmp_path / "out.h5", "tfidf") is sparse
+        if sparse:
+            embeddings = H5.load_sparse(tmp_path / "out.h5", "tfidf")
+            assert embeddings.shape == (11, len(vectorizer.vocabulary_))
+            np.testing.assert_allclose(
+                embeddings[indices].toarray(), expected.toarray(), rtol=1e-6
+            )
+            assert embeddings[[0, 7, 8]].nnz == 0
+            assert not list(tmp_path.glob("out_temp*"))
+        elif storage == "float16":
+            embeddings = H5.load(tmp_path / "out.h5", "tfidf")
+            assert embeddings.dtype == np.float16
+            np.testing.assert_allclose(embeddings[indices], expected, atol=1e-3)
+            assert np.isnan(embeddings[[0, 7, 8]]).all()
+            embeddings = H5.load(tmp_path / "out.h5", "tfidf", dtype="f4")
+            assert embeddings.dtype == np.float32
+            assert not list(tmp_path.glob("out_temp*"))
+        else:
+            with h5py.File(tmp_path / "out.h5", "r") as f:
+                assert f["tfidf"].is_virtual
+            embeddings = H5.load(tmp_path / "out.h5", "tfidf")
+            assert embeddings.shape == (11, len(vectorizer.vocabulary_))
+            np.testing.assert_allclose(embeddings[indices], expected, rtol=1e-6)
+            unpopulated = H5.find_unpopulated_rows(tmp_path / "out.h5", "tfidf")
+            np.testing.assert_array_equal(unpopulated, [0, 7, 8])
+            # The temporary files hold the data
+            assert len(list(tmp_path.glob("out_temp*.h5"))) == 3
+
+        # Sparse and virtual datasets cannot be resumed
+        if storage != "float16":
+            mpe.resume = True
+            with pytest.raises(ValueError, match="cannot be resumed"):
+                mpe.do_embedding()
+
+    def test_do_embedding_missing_chunk(self, monkeypatch, tmp_path):
+        mpe = MPEmbedder(
+            "some_url",
+            "some_model",
+            np.array([2, 5, 11]),
+            tmp_path / "out.h5",
+            n_processes=1,
+            chunk_size=1,
+        )
+
+        def fake_worker(task_queue, done_queue, **kwargs):
+            # the worker fails after the first chunk
+            chunk_ix, _, _ = task_queue.get()
+            done_queue.put(chunk_ix)
+
+        fake_process = Mock()
+        fake_process.is_alive.return_value = False
+
+        def fake_process_class(target, kwargs, **_):
+            fake_process.start.side_effect = lambda: target(**kwargs)
+            return fake_process
+
+        fake_multiprocessing = Mock()
+        fake_multiprocessing.Queue = queue.Queue
+        fake_multiprocessing.Process = fake_process_class
+        fake_h5 = Mock()
+        monkeypatch.setattr("bluesearch.embedding_models.mp", fake_multiprocessing)
+        monkeypatch.setattr("bluesearch.embedding_models.H5", fake_h5)
+        monkeypatch.setattr("bluesearch.embedding_models.get_embedding_model", Mock())
+        monkeypatch.setattr(mpe, "run_embedding_worker", fake_worker)
+
+        with pytest.raises(RuntimeError, match=r"\[1, 2\]"):
+            mpe.do_embedding()
+
+        fake_h5.concatenate.assert_not_called()
+
+    def test_do_embedding_resume(self, monkeypatch, tmp_path):
+        indices = np.array([1, 2, 3, 4, 5, 6])
+        h5_path_output = tmp_path / "out.h5"
+
+        def create_temp_h5(path, chunk):
+            H5.create(path, "some_model", shape=(len(chunk), 2))
+            H5.create(path, "some_model_indices", shape=(len(chunk), 1), dtype="int32")
+            H5.write(
+                path, "some_model", np.ones((len(chunk), 2)), np.arange(len(chunk))
+            )
+            H5.write(
+                path, "some_model_indices", chunk.reshape(-1, 1), np.arange(len(chunk))
+            )
+
+        # chunk 0 is done, chunk 1 is from a run with other parameters
+        create_temp_h5(tmp_path / "out_temp0.h5", indices[:2])
+        create_temp_h5(tmp_path / "out_temp1.h5", indices[3:5])
+
+        processed_chunks = {}
+
+        def fake_worker(task_queue, done_queue, **kwargs):
+            while True:
+                task = task_queue.get()
+                if task is None:
+                    break
+                chunk_ix, chunk, temp_h5_path = task
+                processed_chunks[chunk_ix] = chunk
+                create_temp_h5(temp_h5_path, chunk)
+                done_queue.put(chunk_ix)
+
+        fake_multiprocessing = Mock()
+        fake_multiprocessing.Queue = queue.Queue
+        fake_multiprocessing.Process.side_effect = lambda target, kwargs, **_: Mock(
+            start=lambda: target(**kwargs)
+        )
+        monkeypatch.setattr("bluesearch.embedding_models.mp", fake_multiprocessing)
+        monkeypatch.setattr("bluesearch.embedding_models.get_embedding_model", Mock())
+
+        def make_mpe(resume):
+            mpe = MPEmbedder(
+                "some_url",
+                "some_model",
+                indices,
+                h5_path_output,
+                n_processes=2,
+                chunk_size=2,
+                resume=resume,
+            )
+            monkeypatch.setattr(mpe, "run_embedding_worker", fake_worker)
+            return mpe
+
+        with pytest.raises(FileExistsError):
+            make_mpe(resume=False).do_embedding()
+
+        make_mpe(resume=True).do_embedding()
+
+        assert set(processed_chunks) == {1, 2}
+        np.testing.assert_array_equal(processed_chunks[1], [3, 4])
+        np.testing.assert_array_equal(processed_chunks[2], [5, 6])
+        np.testing.assert_array_equal(
+            H5.find_populated_rows(h5_path_output, "some_model"), indices
+        )
+
+        # Resuming with an existing output only embeds the missing rows
+        H5.clear(h5_path_output, "some_model", np.array([2, 5]))
+        processed_chunks.clear()
+
+        with pytest.raises(ValueError, match="already exists"):
+            make_mpe(resume=False).do_embedding()
+
+        make_mpe(resume=True).do_embedding()
+
+        assert set(processed_chunks) == {0}
+        np.testing.assert_array_equal(processed_chunks[0], [2, 5])
+        np.testing.assert_array_equal(
+            H5.find_populated_rows(h5_path_output, "some_model"), indices
+        )
@@ -21,6 +21,8 @@ from unittest.mock import Mock
 
 import numpy as np
 import pytest
+import scipy.sparse
+import sqlalchemy
 import torch
 
 from bluesearch.search import SearchEngine
@@ -120,3 +122,70 @@ class TestSearchEngine:
                                                              ({sentences_ids})"""
             ).fetchall()
             assert len(articles_id) == k
+
+    @pytest.mark.parametrize("sparse_query", [False, True])
+    def test_sparse_embeddings(
+        self, fake_sqlalchemy_engine, embeddings_h5_path, sparse_query
+    ):
+        model = "SBERT"
+        query_embeddings = {"query": np.array([1.0, 0.5]), "vegetables": np.ones(2)}
+
+        emb_mod = Mock()
+        emb_mod.preprocess.side_effect = lambda text: text
+        if sparse_query:
+            emb_mod.embed.side_effect = lambda text: scipy.sparse.csr_matrix(
+                query_embeddings[text]
+            )
+        else:
+            emb_mod.embed.side_effect = lambda text: query_embeddings[text]
+
+        precomputed_embeddings = H5.load(embeddings_h5_path, model)[1:]
+        precomputed_embeddings = np.nan_to_num(precomputed_embeddings)
+        norm = np.linalg.norm(precomputed_embeddings, axis=1, keepdims=True)
+        norm[norm == 0] = 1
+        precomputed_embeddings /= norm
+
+        results = {}
+        for sparse in (False, True):
+            if sparse:
+                embeddings = scipy.sparse.csr_matrix(precomputed_embeddings)
+            else:
+                embeddings = torch.from_numpy(precomputed_embeddings)
+            search_engine = SearchEngine(
+                {model: emb_mod},
+                {model: embeddings},
+                np.arange(1, len(precomputed_embeddings) + 1),
+                fake_sqlalchemy_engine,
+            )
+            results[sparse] = search_engine.query(
+                which_model=model,
+                query_text="query",
+                deprioritize_text="vegetables",
+                deprioritize_strength="Mild",
+                k=5,
+            )
+
+        np.testing.assert_array_equal(results[True][0], results[False][0])
+        np.testing.assert_allclose(results[True][1], results[False][1], rtol=1e-6)
+
+    def test_sentences_scanned_once(self, fake_sqlalchemy_engine):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(
+            fake_sqlalchemy_engine, "before_cursor_execute", before_cursor_execute
+        )
+        try:
+            search_engine = SearchEngine({}, {}, np.array([]), fake_sqlalchemy_engine)
+        finally:
+            sqlalchemy.event.remove(
+                fake_sqlalchemy_engine, "before_cursor_execute", before_cursor_execute
+            )
+
+        # The year index reuses the article IDs of all the sentences
+        assert sum("FROM sentences" in statement for statement in statements) == 1
+        assert set(search_engine.year_index.sorted_sentence_ids) == set(
+            search_engine.all_article_ids
+        )
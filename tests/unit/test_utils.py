@@ -25,6 +25,7 @@ from typing import Any
 import h5py
 import numpy as np
 import pytest
+import scipy.sparse
 import spacy
 
 from bluesearch.utils import (
@@ -243,6 +244,130 @@ class TestH5:
             == np.array(sorted(indices_1 + indices_2))
         )
 
+    def test_concatenate_append(self, tmpdir):
+        tmpdir = pathlib.Path(str(tmpdir))
+        temp_path = tmpdir / "temp.h5"
+        final_path = tmpdir / "final.h5"
+        dataset_name = "some_dataset"
+
+        indices = np.array([[1], [4]], dtype="int32")
+        array = np.random.random((2, 3))
+        H5.create(temp_path, dataset_name, shape=(2, 3))
+        H5.create(temp_path, f"{dataset_name}_indices", shape=(2, 1), dtype="int32")
+        H5.write(temp_path, dataset_name, array, np.array([0, 1]))
+        H5.write(temp_path, f"{dataset_name}_indices", indices, np.array([0, 1]))
+
+        H5.create(final_path, dataset_name, shape=(6, 3))
+        H5.write(final_path, dataset_name, np.ones((1, 3)), np.array([2]))
+
+        # The dataset exists already
+        with pytest.raises(ValueError):
+            H5.concatenate(final_path, dataset_name, [temp_path], delete_inputs=False)
+
+        H5.concatenate(
+            final_path, dataset_name, [temp_path], delete_inputs=False, append=True
+        )
+
+        with h5py.File(final_path, "r") as f:
+            data = f[dataset_name][:]
+
+        assert data.shape == (6, 3)
+        np.testing.assert_array_almost_equal(data[[1, 4]], array)
+        np.testing.assert_array_equal(data[2], np.ones(3))
+        np.testing.assert_array_equal(
+            H5.find_populated_rows(final_path, dataset_name), [1, 2, 4]
+        )
+
+        # The existing dataset is too small
+        small_path = tmpdir / "small.h5"
+        H5.create(small_path, dataset_name, shape=(3, 3))
+        with pytest.raises(ValueError, match="cannot hold"):
+            H5.concatenate(small_path, dataset_name, [temp_path], append=True)
+
+        # Unless it is resizable
+        resizable_path = tmpdir / "resizable.h5"
+        H5.create(resizable_path, dataset_name, shape=(3, 3), resizable=True)
+        H5.concatenate(
+            resizable_path, dataset_name, [temp_path], append=True, delete_inputs=False
+        )
+        assert H5.get_shape(resizable_path, dataset_name) == (5, 3)
+        np.testing.assert_array_equal(
+            H5.find_populated_rows(resizable_path, dataset_name), [1, 4]
+        )
+
+    @pytest.mark.parametrize("delete_inputs", [True, False])
+    def test_concatenate_sparse(self, tmpdir, delete_inputs):
+        tmpdir = pathlib.Path(str(tmpdir))
+        dataset_name = "sparse"
+        h5_path_output = tmpdir / "output.h5"
+
+        rng = np.random.default_rng(2)
+        chunks = {"a.h5": np.array([1, 6, 3]), "b.h5": np.array([9, 2])}
+        expected = np.zeros((10, 6), dtype="f4")
+        for name, indices in chunks.items():
+            dense = rng.random((len(indices), 6)) * (
+                rng.random((len(indices), 6)) > 0.5
+            )
+            expected[indices] = dense
+            H5.write_sparse(tmpdir / name, dataset_name, scipy.sparse.csr_matrix(dense))
+            with h5py.File(tmpdir / name, "a") as f:
+                f.create_dataset(f"{dataset_name}_indices", data=indices.reshape(-1, 1))
+
+        h5_paths_temp = [tmpdir / name for name in chunks]
+        H5.concatenate_sparse(
+            h5_path_output, dataset_name, h5_paths_temp, delete_inputs=delete_inputs
+        )
+
+        assert H5.is_sparse(h5_path_output, dataset_name)
+        assert H5.get_shape(h5_path_output, dataset_name) == (10, 6)
+        loaded = H5.load_sparse(h5_path_output, dataset_name)
+        np.testing.assert_allclose(loaded.toarray(), expected)
+        assert all(path.exists() != delete_inputs for path in h5_paths_temp)
+
+        if not delete_inputs:
+            with pytest.raises(ValueError, match="overlapping"):
+                H5.concatenate_sparse(
+                    tmpdir / "other.h5", dataset_name, h5_paths_temp + h5_paths_temp
+                )
+
+    def test_concatenate_virtual(self, tmp_path, monkeypatch):
+        dataset_name = "emb"
+        output_folder = tmp_path / "output"
+        output_folder.mkdir()
+        h5_path_output = output_folder / "output.h5"
+
+        chunks = {"a.h5": np.array([1, 2, 3, 7, 8]), "b.h5": np.array([4, 5, 10])}
+        expected = np.full((11, 2), np.nan, dtype="f4")
+        h5_paths_temp = []
+        for i, (name, indices) in enumerate(chunks.items()):
+            data = np.arange(2 * len(indices), dtype="f4").reshape(-1, 2) + 100 * i
+            expected[indices] = data
+            with h5py.File(output_folder / name, "w") as f:
+                f.create_dataset(dataset_name, data=data)
+                f.create_dataset(f"{dataset_name}_indices", data=indices[:, None])
+            h5_paths_temp.append(output_folder / name)
+
+        H5.concatenate_virtual(h5_path_output, dataset_name, h5_paths_temp)
+
+        with h5py.File(h5_path_output, "r") as f:
+            assert f[dataset_name].is_virtual
+            # One mapping per run of consecutive indices
+            assert len(f[dataset_name].virtual_sources()) == 4
+
+        # The input files are found relatively to the output file
+        monkeypatch.chdir(tmp_path)
+        np.testing.assert_array_equal(H5.load(h5_path_output, dataset_name), expected)
+        np.testing.assert_array_equal(
+            H5.find_unpopulated_rows(h5_path_output, dataset_name), [0, 6, 9]
+        )
+
+        with pytest.raises(ValueError, match="already exists"):
+            H5.concatenate_virtual(h5_path_output, dataset_name, h5_paths_temp)
+        with pytest.raises(ValueError, match="overlapping"):
+            H5.concatenate_virtual(
+                output_folder / "other.h5", dataset_name, h5_paths_temp * 2
+            )
+
     def test_create(self, tmpdir):
         h5_path = pathlib.Path(str(tmpdir)) / "to_be_created.h5"
 
@@ -266,6 +391,85 @@ class TestH5:
         with pytest.raises(ValueError):
             H5.create(h5_path, "a", (20, 10))
 
+    @pytest.mark.parametrize(
+        "layout, expected",
+        [
+            ({}, {"chunks": None, "compression": None, "shuffle": False}),
+            ({"chunks": (2, 3)}, {"chunks": (2, 3)}),
+            ({"compression": "lzf"}, {"compression": "lzf"}),
+            (
+                {"compression": "gzip", "compression_opts": 7, "shuffle": True},
+                {"compression": "gzip", "compression_opts": 7, "shuffle": True},
+            ),
+            ({"resizable": True}, {"maxshape": (None, 3)}),
+        ],
+    )
+    def test_create_layout(self, tmp_path, layout, expected):
+        h5_path = tmp_path / "layout.h5"
+        H5.create(h5_path, "a", shape=(10, 3), **layout)
+
+        with h5py.File(h5_path, "r") as f:
+            for attribute, value in expected.items():
+                assert getattr(f["a"], attribute) == value
+
+        data = np.random.random((2, 3))
+        H5.write(h5_path, "a", data, np.array([7, 2]))
+        np.testing.assert_allclose(
+            H5.load(h5_path, "a", indices=np.array([7, 2])), data, rtol=1e-6
+        )
+
+    def test_create_blosc(self, tmp_path):
+        try:
+            import hdf5plugin  # noqa: F401
+        except ImportError:
+            with pytest.raises(ModuleNotFoundError, match="hdf5plugin"):
+                H5.create(tmp_path / "blosc.h5", "a", (10, 3), compression="blosc")
+        else:
+            H5.create(tmp_path / "blosc.h5", "a", (10, 3), compression="blosc")
+            with h5py.File(tmp_path / "blosc.h5", "r") as f:
+                assert f["a"].chunks is not None
+
+    @pytest.mark.parametrize("resizable", [False, True])
+    def test_repack(self, tmp_path, embeddings_h5_path, resizable):
+        input_path = tmp_path / "input.h5"
+        input_path.write_bytes(embeddings_h5_path.read_bytes())
+        H5.create(input_path, "other_indices", shape=(4, 1), dtype="int32")
+        H5.create_populated_bitmap(input_path, "SBioBERT")
+        output_path = tmp_path / "output.h5"
+
+        H5.repack(
+            input_path,
+            output_path,
+            batch_size=3,
+            compression="gzip",
+            shuffle=True,
+            resizable=resizable,
+        )
+
+        with h5py.File(input_path, "r") as f_in, h5py.File(output_path, "r") as f_out:
+            assert set(f_out.keys()) == {
+                "SBERT",
+                "SBERT_populated",
+                "SBioBERT",
+                "SBioBERT_populated",
+                "other_indices",
+            }
+            for name in ["SBERT", "SBioBERT"]:
+                assert f_out[name].compression == "gzip"
+                assert f_out[name].shuffle
+                assert f_out[name].maxshape[0] == (
+                    None if resizable else len(f_in[name])
+                )
+                np.testing.assert_array_equal(f_out[name][:], f_in[name][:])
+                np.testing.assert_array_equal(
+                    H5.find_populated_rows(output_path, name),
+                    H5.find_populated_rows(input_path, name),
+                )
+            assert f_out["other_indices"].compression is None
+
+        with pytest.raises(ValueError, match="already exists"):
+            H5.repack(input_path, output_path)
+
     @pytest.mark.parametrize("verbose", [True, False])
     @pytest.mark.parametrize("batch_size", [1, 2, 5])
     @pytest.mark.parametrize("model", ["SBERT"])
@@ -296,6 +500,47 @@ class TestH5:
 
         assert np.all(unpop_rows_computed == unpop_rows_true)
 
+    def test_find_unpopulated_rows_quiet(self, embeddings_h5_path, capsys):
+        H5.find_unpopulated_rows(embeddings_h5_path, "SBERT", verbose=False)
+
+        assert capsys.readouterr().out == ""
+
+    def test_populated_bitmap(self, tmp_path, embeddings_h5_path):
+        h5_path = tmp_path / "embeddings.h5"
+        populated_name = H5.populated_name("a")
+
+        H5.create(h5_path, "a", shape=(6, 3))
+        H5.create(h5_path, "a_indices", shape=(6, 1), dtype="int32")
+        with h5py.File(h5_path, "r") as f:
+            assert populated_name in f
+            assert H5.populated_name("a_indices") not in f
+
+        np.testing.assert_array_equal(H5.find_unpopulated_rows(h5_path, "a"), range(6))
+
+        data = np.random.random((3, 3))
+        data[1, 2] = np.nan
+        H5.write(h5_path, "a", data, np.array([4, 1, 2]))
+        np.testing.assert_array_equal(H5.find_populated_rows(h5_path, "a"), [2, 4])
+
+        H5.clear(h5_path, "a", np.array([4]))
+        np.testing.assert_array_equal(H5.find_populated_rows(h5_path, "a"), [2])
+
+        # The bitmap is used instead of the dataset
+        with h5py.File(h5_path, "a") as f:
+            f["a"][0] = np.ones(3)
+        np.testing.assert_array_equal(H5.find_populated_rows(h5_path, "a"), [2])
+
+        # Datasets created before the bitmap
+        legacy_path = tmp_path / "legacy.h5"
+        legacy_path.write_bytes(embeddings_h5_path.read_bytes())
+        expected = H5.find_unpopulated_rows(legacy_path, "SBERT")
+        H5.create_populated_bitmap(legacy_path, "SBERT")
+        with h5py.File(legacy_path, "r") as f:
+            assert H5.populated_name("SBERT") in f
+        np.testing.assert_array_equal(
+            H5.find_unpopulated_rows(legacy_path, "SBERT"), expected
+        )
+
     def test_get_shape(self, tmpdir):
         h5_path = pathlib.Path(str(tmpdir)) / "to_be_created.h5"
 
@@ -317,18 +562,23 @@ class TestH5:
             [1, 2],
             [6, 5, 4, 3, 2, 1, 0],
             [1, 5, 2, 6, 11, 12, 14],
+            [],
         ],
     )
-    def test_load(self, embeddings_h5_path, model, verbose, batch_size, indices):
+    @pytest.mark.parametrize("max_gap", [0, 1, 32])
+    def test_load(
+        self, embeddings_h5_path, model, verbose, batch_size, indices, max_gap
+    ):
         with h5py.File(embeddings_h5_path, "r") as f:
             dset_np = f[model][:]
 
         res_loaded = H5.load(
             embeddings_h5_path,
             model,
-            indices=np.array(indices),
+            indices=np.array(indices, dtype=int),
             verbose=verbose,
             batch_size=batch_size,
+            max_gap=max_gap,
         )
 
         res_true = dset_np[indices]
@@ -343,6 +593,64 @@ class TestH5:
         nonnan_mask = ~np.isnan(res_loaded)
         assert np.allclose(res_loaded[nonnan_mask], res_true[nonnan_mask])
 
+    def test_load_sparse(self, tmpdir):
+        h5_path = pathlib.Path(str(tmpdir)) / "sparse.h5"
+        dense = np.array([[0, 1.5, 0], [0, 0, 0], [2, 0, 3]], dtype="f4")
+        H5.create(h5_path, "dense", shape=(3, 3))
+
+        H5.write_sparse(h5_path, "sparse", scipy.sparse.csr_matrix(dense))
+
+        assert H5.is_sparse(h5_path, "sparse")
+        assert not H5.is_sparse(h5_path, "dense")
+        assert H5.get_shape(h5_path, "sparse") == (3, 3)
+
+        loaded = H5.load_sparse(h5_path, "sparse")
+        assert scipy.sparse.isspmatrix_csr(loaded)
+        np.testing.assert_array_equal(loaded.toarray(), dense)
+
+        loaded = H5.load_sparse(h5_path, "sparse", indices=np.array([2, 0]))
+        np.testing.assert_array_equal(loaded.toarray(), dense[[2, 0]])
+
+        # The generic functions handle the sparse datasets too
+        np.testing.assert_array_equal(
+            H5.find_populated_rows(h5_path, "sparse"), [0, 1, 2]
+        )
+        assert len(H5.find_unpopulated_rows(h5_path, "sparse")) == 0
+        loaded = H5.load(h5_path, "sparse", indices=np.array([2, 0]), dtype="f8")
+        assert scipy.sparse.isspmatrix_csr(loaded)
+        assert loaded.dtype == np.float64
+        np.testing.assert_array_equal(loaded.toarray(), dense[[2, 0]])
+        np.testing.assert_array_equal(H5.load(h5_path, "sparse").toarray(), dense)
+
+        with pytest.raises(ValueError, match="already exists"):
+            H5.write_sparse(h5_path, "sparse", scipy.sparse.csr_matrix(dense))
+
+    @pytest.mark.parametrize("indices", [None, [4, 0, 2]])
+    def test_load_float16(self, tmp_path, indices):
+        temp_path = tmp_path / "temp.h5"
+        final_path = tmp_path / "final.h5"
+        array = np.random.random((2, 3)).astype("f4")
+        H5.create(temp_path, "x", shape=(2, 3), dtype="f2")
+        H5.create(temp_path, "x_indices", shape=(2, 1), dtype="int32")
+        H5.write(temp_path, "x", array, np.array([0, 1]))
+        H5.write(temp_path, "x_indices", np.array([[1], [4]]), np.array([0, 1]))
+
+        # The dtype of the temporary files is kept
+        H5.concatenate(final_path, "x", [temp_path])
+
+        res_f2 = H5.load(final_path, "x")
+        assert res_f2.dtype == np.float16
+        np.testing.assert_allclose(res_f2[[1, 4]], array, atol=1e-3)
+        assert np.isnan(res_f2[[0, 2, 3]]).all()
+        np.testing.assert_array_equal(H5.find_populated_rows(final_path, "x"), [1, 4])
+
+        if indices is not None:
+            indices = np.array(indices)
+        res_f4 = H5.load(final_path, "x", indices=indices, dtype="f4")
+        expected = res_f2 if indices is None else res_f2[indices]
+        assert res_f4.dtype == np.float32
+        np.testing.assert_array_equal(res_f4, expected.astype("f4"))
+
     def test_load_duplicates(self, embeddings_h5_path):
         with pytest.raises(ValueError):
             H5.load(embeddings_h5_path, "SBERT", indices=np.array([1, 2, 2]))